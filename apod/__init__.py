@@ -0,0 +1 @@
+version = '1.0.0'
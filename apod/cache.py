@@ -0,0 +1,139 @@
+"""
+Bounded, thread-safe in-memory cache of parsed APOD entries.
+"""
+
+from collections import OrderedDict
+from types import MappingProxyType
+import threading
+import time
+
+
+class _Item(object):
+    __slots__ = ('data', 'expires', 'fields', 'body', 'hits')
+
+    def __init__(self, data, expires, fields=None):
+        self.data = data
+        self.expires = expires
+        # the fields data holds, if only some; see put
+        self.fields = fields
+        # the encoded form of data, made on first use; see get_body
+        self.body = None
+        # lookups answered by this entry; see entries
+        self.hits = 0
+
+
+class ResultCache(object):
+    """
+    An LRU cache of parsed entries, safe to share between serving threads.
+
+    Entries are frozen on the way in so that no caller can change what the
+    next caller will be served; build a new dict from an entry to extend it.
+    An entry may be given a time-to-live, which is used for the current
+    day's entry since that can still change at the upstream rollover, and
+    may be recorded as holding only some fields, in which case it is only
+    returned to lookups needing no others.
+    """
+
+    def __init__(self, max_entries=4096, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, fields=None):
+        """
+        Returns the entry held for key, or None if there is none or it has
+        expired. Given a set of fields, an entry holding only some fields is
+        returned if it holds those; otherwise only a whole one is.
+        """
+        with self._lock:
+            item = self._live(key)
+            if item is not None and item.fields is not None and (fields is None or not fields <= item.fields):
+                item = None
+            if item is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                item.hits += 1
+                return item.data
+            self.misses += 1
+            return None
+
+    def get_body(self, key, encode):
+        """
+        Returns the encoded form of the entry held for key, or None if there
+        is none or it is only part of one. It is made by encode(entry) on
+        first use and kept with the entry, so that it is only ever encoded
+        once.
+        """
+        with self._lock:
+            item = self._live(key)
+        if item is None or item.fields is not None:
+            return None
+        if item.body is None:
+            # encoding twice in a race is harmless
+            item.body = encode(item.data)
+        return item.body
+
+    def _live(self, key):
+        # with the lock held: returns the item for key unless it has expired
+        item = self._entries.get(key)
+        if item is not None and item.expires is not None and item.expires <= self._clock():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        return item
+
+    def put(self, key, data, ttl=None, fields=None):
+        """
+        Stores a frozen copy of data under key, optionally expiring after
+        ttl seconds, and returns that copy. Given fields, the set of fields
+        data holds, it does not replace a whole entry held for key.
+        """
+        frozen = data if isinstance(data, MappingProxyType) else MappingProxyType(dict(data))
+        expires = None if ttl is None else self._clock() + ttl
+        with self._lock:
+            if fields is not None:
+                item = self._live(key)
+                if item is not None and item.fields is None:
+                    return frozen
+            self._entries[key] = _Item(frozen, expires, fields)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return frozen
+
+    def entries(self):
+        """
+        Returns a list of (key, entry, hits) of the whole entries held which
+        do not expire, least recently used first, with the lookups each has
+        answered.
+        """
+        with self._lock:
+            return [(key, item.data, item.hits) for key, item in self._entries.items()
+                    if item.expires is None and item.fields is None]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the size of the cache and its hit/miss/eviction counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,58 @@
+"""
+Encoded JSON response bodies, with their compressed forms made once and
+kept alongside.
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content codings the service can send, most preferred first
+CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def compress(data, coding):
+    """
+    Returns data compressed with the given content coding, or unchanged if
+    the coding is None.
+    """
+    if coding is None:
+        return data
+    if coding == 'gzip':
+        # no timestamp, so that every process makes the same bytes
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+    if coding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError('unsupported content coding: ' + str(coding))
+
+
+class EncodedBody(object):
+    """
+    The encoded bytes of a JSON document, and its compressed forms, each
+    made the first time it is asked for.
+    """
+
+    __slots__ = ('identity', '_compressed')
+
+    def __init__(self, identity):
+        self.identity = identity
+        self._compressed = {}
+
+    def encoded(self, coding=None):
+        """
+        Returns the body in the given content coding, or as is for None.
+        """
+        if coding is None:
+            return self.identity
+        body = self._compressed.get(coding)
+        if body is None:
+            body = self._compressed[coding] = compress(self.identity, coding)
+        return body
+
+    def __len__(self):
+        return len(self.identity)
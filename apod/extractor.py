@@ -0,0 +1,403 @@
+"""
+Single-pass extraction of the characteristics of an APOD page.
+
+BeautifulSoup builds a full tree of Tag objects for each page, which the
+helpers in apod.utility then search over again for every field. Here the
+page is tokenized once, building only a lightweight tree and indexing the
+few elements the extractors look at as they go by. The tree is built by the
+same rules as BeautifulSoup's html.parser builder (unclosed <p> elements
+nest, whitespace-only strings collapse, and so on) so that text comes out of
+it identically. Anything unexpected raises, and apod.utility then falls
+back to the BeautifulSoup parse.
+"""
+
+from html.entities import html5
+from html.parser import HTMLParser
+import datetime
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# elements which never have content, as BeautifulSoup's html builder knows them
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed',
+    'frame', 'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link',
+    'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'])
+# elements whose strings are not part of the text of their ancestors
+STRING_CONTAINERS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+PRESERVE_WHITESPACE = frozenset(['pre', 'textarea'])
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# kinds of string held in the tree; only TEXT and CDATA count as text
+TEXT = 'text'
+CDATA = 'cdata'
+COMMENT = 'comment'
+DECLARATION = 'declaration'
+
+# elements indexed in document order as the page is scanned
+INDEXED = ('a', 'b', 'center', 'p')
+FIRST = ('img', 'iframe', 'title')
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december']
+
+
+class _Element(object):
+    __slots__ = ('name', 'attrs', 'parent', 'children', 'first_b')
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        # child elements, and strings as (kind, value) tuples
+        self.children = []
+        # for <center> elements only: the first <b> within it
+        self.first_b = None
+
+
+def _text(element):
+    """
+    Returns the text of an element, as the .text of the equivalent
+    BeautifulSoup Tag would.
+    """
+    if element.name in STRING_CONTAINERS:
+        kinds = (element.name,)
+    else:
+        kinds = (TEXT, CDATA)
+    parts = []
+    pending = [iter(element.children)]
+    while pending:
+        for child in pending[-1]:
+            if child.__class__ is tuple:
+                if child[0] in kinds:
+                    parts.append(child[1])
+            else:
+                pending.append(iter(child.children))
+                break
+        else:
+            pending.pop()
+    return ''.join(parts)
+
+
+def _string(element):
+    """
+    Returns the lone string within an element, as the .string of the
+    equivalent BeautifulSoup Tag would, or None.
+    """
+    while len(element.children) == 1:
+        child = element.children[0]
+        if child.__class__ is tuple:
+            return child[1]
+        element = child
+    return None
+
+
+class _Scanner(HTMLParser):
+    """
+    Builds the lightweight tree for a page, mirroring what BeautifulSoup's
+    html.parser tree builder does with each parser event.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.root = _Element('[document]', {}, None)
+        self.stack = [self.root]
+        self.open_counts = {}
+        self.data = []
+        self.preserving = []
+        self.containers = []
+        self.already_closed = []
+        self.indexed = dict((name, []) for name in INDEXED)
+        self.bold_or_anchor = []
+        self.first = {}
+        self.image_link = None
+
+    def _end_data(self, kind=TEXT):
+        if self.data:
+            data = ''.join(self.data)
+            self.data = []
+            if not self.preserving and not data.strip(ASCII_SPACES):
+                data = '\n' if '\n' in data else ' '
+            if kind == TEXT and self.containers:
+                kind = self.containers[-1].name
+            self.stack[-1].children.append((kind, data))
+
+    def _push(self, element):
+        name = element.name
+        self.stack[-1].children.append(element)
+        self.stack.append(element)
+        self.open_counts[name] = self.open_counts.get(name, 0) + 1
+        if name in PRESERVE_WHITESPACE:
+            self.preserving.append(element)
+        if name in STRING_CONTAINERS:
+            self.containers.append(element)
+
+        if name in self.indexed:
+            self.indexed[name].append(element)
+            if name == 'a':
+                self.bold_or_anchor.append(element)
+                href = element.attrs.get('href')
+                if self.image_link is None and href and href.startswith('image'):
+                    self.image_link = href
+            elif name == 'b':
+                self.bold_or_anchor.append(element)
+                for open_element in self.stack:
+                    if open_element.name == 'center' and open_element.first_b is None:
+                        open_element.first_b = element
+        elif name in FIRST and name not in self.first:
+            self.first[name] = element
+
+    def _pop(self):
+        element = self.stack.pop()
+        self.open_counts[element.name] -= 1
+        if self.preserving and element is self.preserving[-1]:
+            self.preserving.pop()
+        if self.containers and element is self.containers[-1]:
+            self.containers.pop()
+
+    def handle_starttag(self, name, attrs, handle_empty_element=True):
+        attr_dict = {}
+        for key, value in attrs:
+            attr_dict[key] = '' if value is None else value
+        self._end_data()
+        self._push(_Element(name, attr_dict, self.stack[-1]))
+        if handle_empty_element and name in VOID_ELEMENTS:
+            self.handle_endtag(name, check_already_closed=False)
+            self.already_closed.append(name)
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, handle_empty_element=False)
+        self.handle_endtag(name)
+
+    def handle_endtag(self, name, check_already_closed=True):
+        if check_already_closed and name in self.already_closed:
+            self.already_closed.remove(name)
+            return
+        self._end_data()
+        if not self.open_counts.get(name):
+            return
+        while len(self.stack) > 1:
+            popped = self.stack[-1].name
+            self._pop()
+            if popped == name:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith('x') or name.startswith('X'):
+            number = int(name.lstrip('xX'), 16)
+        else:
+            number = int(name)
+        data = None
+        if number < 256:
+            # numeric references in the Windows-1252 range are taken as such
+            try:
+                data = bytearray([number]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(number)
+            except (ValueError, OverflowError):
+                pass
+        self.data.append(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = html5.get(name + ';')
+        self.data.append(character if character is not None else '&' + name)
+
+    def handle_comment(self, data):
+        self._end_data()
+        self.data.append(data)
+        self._end_data(COMMENT)
+
+    def handle_decl(self, data):
+        self._end_data()
+        self.data.append(data[len('DOCTYPE '):])
+        self._end_data(DECLARATION)
+
+    def unknown_decl(self, data):
+        kind = DECLARATION
+        if data.upper().startswith('CDATA['):
+            kind = CDATA
+            data = data[len('CDATA['):]
+        self._end_data()
+        self.data.append(data)
+        self._end_data(kind)
+
+    def handle_pi(self, data):
+        self._end_data()
+        self.data.append(data)
+        self._end_data(DECLARATION)
+
+    def scan(self, html):
+        self.feed(html)
+        self.close()
+        self._end_data()
+        while len(self.stack) > 1:
+            self._pop()
+        return self
+
+
+class Page(object):
+    """
+    An APOD page, scanned once. The methods return what the corresponding
+    helpers in apod.utility return for a BeautifulSoup parse of the page.
+    """
+
+    def __init__(self, html):
+        scanner = _Scanner().scan(html)
+        self.root = scanner.root
+        self.indexed = scanner.indexed
+        self.bold_or_anchor = scanner.bold_or_anchor
+        self.first = scanner.first
+        self.image_link = scanner.image_link
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = _text(self.root)
+        return self._text
+
+    def media(self, base):
+        """
+        Returns the media type, URL and high-resolution URL of the page.
+        """
+        img = self.first.get('img')
+        if img is not None:
+            data = base + img.attrs['src']
+            if self.image_link is not None:
+                return 'image', data, base + self.image_link
+            return 'image', data, data
+        iframe = self.first.get('iframe')
+        if iframe is not None:
+            return 'video', iframe.attrs['src'], None
+        return 'other', '', None
+
+    def title(self):
+        LOG.debug('getting the title')
+        centers = self.indexed['center']
+        if len(centers) >= 2:
+            bold = centers[0 if len(centers) == 2 else 1].first_b
+            if bold is not None:
+                return fix_cp1252(_text(bold).strip(' '))
+        # Handler for early APOD entries
+        return fix_cp1252(_text(self.first['title']).split(' - ')[-1].strip())
+
+    def copyright(self):
+        LOG.debug('getting the copyright')
+        copyright_text = None
+        use_next = False
+        for element in self.indexed['a']:
+            if _string(element) is None:
+                continue
+            text = _text(element)
+            if use_next:
+                copyright_text = text.strip(' ')
+                break
+            if 'Copyright' in text:
+                use_next = True
+
+        if not copyright_text:
+            for element in self.bold_or_anchor:
+                if _string(element) is None or 'Copyright' not in _text(element):
+                    continue
+                # pull the copyright from whatever follows
+                siblings = element.parent.children
+                stuff = ''
+                for sibling in siblings[siblings.index(element) + 1:]:
+                    if sibling.__class__ is not tuple:
+                        stuff += _text(sibling)
+                    elif not sibling[1]:
+                        break
+                    elif sibling[0] in (TEXT, CDATA):
+                        stuff += sibling[1]
+                if stuff:
+                    copyright_text = stuff.strip(' ')
+
+        return fix_cp1252(copyright_text)
+
+    def explanation(self):
+        LOG.debug('getting the explanation')
+        s = clean_explanation(_text(self.indexed['p'][2]))
+        if s == '':
+            s = early_explanation(self.text)
+        return fix_cp1252(s)
+
+    def date(self):
+        LOG.debug('getting the date from page text.')
+        return find_date(self.text)
+
+
+def fix_cp1252(text):
+    """
+    Re-decodes text which was mis-decoded as Latin-1 from Windows-1252, as
+    the APOD pages often are. Text which cannot be is returned unchanged.
+    """
+    try:
+        return text.encode('latin1').decode('cp1252')
+    except Exception as ex:
+        LOG.error(str(ex))
+        return text
+
+
+def clean_explanation(text):
+    """
+    Accepts the text of the explanation paragraph of a later APOD page and
+    returns the explanation alone.
+    """
+    s = text.replace('\n', ' ')
+    s = s.replace('  ', ' ')
+    s = s.strip(' ').strip('Explanation: ')
+    s = s.split(' Tomorrow\'s picture')[0]
+    return s.strip(' ')
+
+
+def early_explanation(text):
+    """
+    Accepts the whole text of an early APOD page and returns the
+    explanation, which runs from the 'Explanation:' line to the next blank
+    line.
+    """
+    texts = [x.strip() for x in text.split('\n')]
+    try:
+        begin_idx = texts.index('Explanation:') + 1
+    except ValueError as e:
+        # Rare case where "Explanation:" is not on its own line
+        explanation_line = [x for x in texts if "Explanation:" in x]
+        if len(explanation_line) == 1:
+            begin_idx = texts.index(explanation_line[0])
+            texts[begin_idx] = texts[begin_idx][12:].strip()
+        else:
+            raise e
+
+    idx = texts[begin_idx:].index('')
+    return ' '.join(texts[begin_idx:begin_idx + idx])
+
+
+def find_date(text):
+    """
+    Accepts the whole text of an APOD page and returns the date it is for.
+    """
+    _today = datetime.date.today()
+    for line in text.split('\n'):
+        today_year = str(_today.year)
+        yesterday_year = str((_today-datetime.timedelta(days=1)).year)
+        # Looks for the first line that starts with the current year.
+        # This also checks yesterday's year so it doesn't break on January 1st at 00:00 UTC
+        # before apod.nasa.gov uploads a new image.
+        if line.startswith(today_year) or line.startswith(yesterday_year):
+            LOG.debug('found possible date match: ' + line)
+            # takes apart the date string and turns it into a datetime
+            try:
+                year, month, day = line.split()
+                year = int(year)
+                month = MONTHS.index(month.lower()) + 1
+                day = int(day)
+                return datetime.date(year=year, month=month, day=day).strftime('%Y-%m-%d')
+            except:
+                LOG.debug('unable to retrieve date from line: ' + line)
+    raise Exception('Date not found in soup data.')
@@ -0,0 +1,57 @@
+"""
+Bounded-concurrency fetch engine used to fan out upstream APOD requests.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class FetchEngine(object):
+    """
+    Runs blocking fetches on a shared thread pool. The size of the pool caps
+    how many upstream fetches the whole process has in flight, while
+    per_request caps how many of those any one request may hold at a time.
+    """
+
+    def __init__(self, max_workers=16, per_request=8):
+        self.max_workers = max_workers
+        self.per_request = per_request
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='apod-fetch')
+
+    def imap(self, fn, items, parallelism=None):
+        """
+        Applies fn to each of items concurrently, yielding the results in
+        the order of items as soon as each is available. An exception raised
+        by fn is re-raised here when its result is reached.
+        """
+        items = list(items)
+        window = max(1, min(parallelism or self.per_request, self.max_workers))
+        futures = {}
+        in_flight = set()
+        next_submit = 0
+        try:
+            for i in range(len(items)):
+                while True:
+                    in_flight = set(f for f in in_flight if not f.done())
+                    while next_submit < len(items) and len(in_flight) < window:
+                        future = self._executor.submit(fn, items[next_submit])
+                        futures[next_submit] = future
+                        in_flight.add(future)
+                        next_submit += 1
+                    if futures[i].done():
+                        break
+                    wait(in_flight, return_when=FIRST_COMPLETED)
+
+                yield futures.pop(i).result()
+        finally:
+            # the caller stopped early or a fetch failed
+            for future in futures.values():
+                future.cancel()
+
+    def map(self, fn, items, parallelism=None):
+        """
+        Like imap, but returns all of the results as a list.
+        """
+        return list(self.imap(fn, items, parallelism))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,200 @@
+"""
+Offline bulk ingest of the APOD archive into a local ArchiveStore.
+
+Crawls every date in a range through parse_apod and stores the entries, so
+that a node started with the resulting archive serves history without
+scraping apod.nasa.gov, and keeps serving it through an upstream outage.
+
+Each entry is committed to the archive as soon as it is parsed, which makes
+the archive its own checkpoint: an interrupted run picks up where it left
+off when started again, and a daily run against an existing archive only
+fetches the dates it does not hold yet. Settled dates which apod.nasa.gov
+has no entry for are recorded in the archive too, and only asked for again
+with --recheck-absent.
+"""
+
+from datetime import datetime, date, timedelta
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+from apod.fetch import FetchEngine
+from apod.store import open_store
+from apod.thumbs import ThumbnailError
+from apod.utility import parse_apod
+
+LOG = logging.getLogger(__name__)
+
+# first APOD image date
+FIRST_DATE = date(1995, 6, 16)
+# how often progress is logged, in dates
+PROGRESS_EVERY = 100
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() at least 1/rate seconds apart across every
+    thread sharing the limiter, so that any number of workers together stay
+    under a polite request rate.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self._clock()
+            slot = now if self._next is None else max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            self._sleep(slot - now)
+
+
+def settled_through():
+    """
+    Returns the latest date whose entry can no longer change upstream; see
+    _is_settled in application.py.
+    """
+    return datetime.utcnow().date() - timedelta(days=2)
+
+
+def pending_dates(store, variant, start, end, recheck_absent=False):
+    """
+    Returns the dates from start to end, inclusive, for which the store
+    holds no entry of the given variant, less those recorded as having no
+    entry upstream unless recheck_absent is set.
+    """
+    held = store.dates(variant)
+    if not recheck_absent:
+        held |= store.absent_dates()
+    days = (end - start).days + 1
+    return [dt for dt in (start + timedelta(days=i) for i in range(days)) if dt not in held]
+
+
+def ingest(store, dates, thumbs=False, workers=4, rate=2.0, errors=None):
+    """
+    Fetches and parses the entry for each of dates and stores it. Dates for
+    which parsing fails are logged and, if errors is given, recorded there
+    as JSON lines; they are left out of the store so that the next run tries
+    them again. Settled dates without an entry upstream are recorded as
+    absent in the store.
+
+    Returns a dict counting the dates stored, found to have no entry
+    upstream, and failed.
+    """
+    variant = (False, bool(thumbs))
+    limiter = RateLimiter(rate)
+    engine = FetchEngine(workers, workers)
+    counts = {'stored': 0, 'absent': 0, 'failed': 0}
+
+    def fetch(dt):
+        limiter.wait()
+        try:
+            data = parse_apod(dt, thumbs='true' if thumbs else False)
+        except Exception as ex:
+            return None, ex
+        if thumbs and data and data.get('media_type') == 'video' and 'thumbnail_url' not in data:
+            # left to a later ingest rather than stored without it
+            return None, ThumbnailError('no thumbnail for the video of ' + dt.isoformat())
+        return data, None
+
+    try:
+        for i, (dt, (data, error)) in enumerate(zip(dates, engine.imap(fetch, dates))):
+            if error is not None:
+                counts['failed'] += 1
+                LOG.warning('failed to ingest ' + dt.isoformat() + ': ' + str(error))
+                if errors is not None:
+                    errors.write(json.dumps({'date': dt.isoformat(),
+                                             'error': type(error).__name__ + ': ' + str(error),
+                                             'at': datetime.utcnow().isoformat() + 'Z'}) + '\n')
+                    errors.flush()
+            elif not data:
+                counts['absent'] += 1
+                LOG.info('no entry upstream for ' + dt.isoformat())
+                if dt <= settled_through():
+                    # a later date may simply not be published yet
+                    store.mark_absent(dt)
+            else:
+                store.put(dt, variant, data)
+                counts['stored'] += 1
+                LOG.debug('stored ' + dt.isoformat())
+
+            if (i + 1) % PROGRESS_EVERY == 0:
+                LOG.info('ingested %d of %d dates (%s)' % (i + 1, len(dates), dt.isoformat()))
+    finally:
+        engine.shutdown()
+
+    return counts
+
+
+def _date_arg(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a date in YYYY-MM-DD format: ' + value)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='apod-ingest',
+        description='Mirror the APOD archive into a local SQLite archive, fetching only '
+                    'the dates it does not hold yet.')
+    parser.add_argument('--archive', default=os.environ.get('APOD_ARCHIVE'),
+                        help='path of the SQLite archive to fill (default: $APOD_ARCHIVE)')
+    parser.add_argument('--start', type=_date_arg, default=FIRST_DATE,
+                        help='first date to ingest (default: %s)' % FIRST_DATE.isoformat())
+    parser.add_argument('--end', type=_date_arg, default=None,
+                        help='last date to ingest (default: the latest settled date)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent fetches (default: 4)')
+    parser.add_argument('--rate', type=float, default=2.0,
+                        help='maximum fetches per second across all workers (default: 2)')
+    parser.add_argument('--thumbs', action='store_true',
+                        help='ingest the thumbs=True variant of each entry')
+    parser.add_argument('--recheck-absent', action='store_true',
+                        help='ask again for dates found earlier to have no entry upstream')
+    parser.add_argument('--errors', default=None,
+                        help='file to append failed dates to (default: <archive>.errors.jsonl)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log each date')
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.archive:
+        parser.error('no archive given; pass --archive or set APOD_ARCHIVE')
+    if args.workers < 1 or args.rate < 0:
+        parser.error('--workers must be at least 1 and --rate may not be negative')
+
+    logging.getLogger('apod').setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    end = args.end or settled_through()
+    if end > settled_through():
+        LOG.warning('entries after ' + settled_through().isoformat() +
+                    ' may still change upstream; ingesting them anyway')
+
+    store = open_store(args.archive)
+    try:
+        dates = pending_dates(store, (False, args.thumbs), args.start, end, args.recheck_absent)
+        LOG.info('%d dates from %s to %s to ingest' % (len(dates), args.start.isoformat(), end.isoformat()))
+        if not dates:
+            return 0
+
+        with open(args.errors or args.archive + '.errors.jsonl', 'a') as errors:
+            counts = ingest(store, dates, args.thumbs, args.workers, args.rate, errors)
+    except KeyboardInterrupt:
+        LOG.warning('interrupted; run again to resume')
+        return 1
+    finally:
+        store.close()
+
+    LOG.info('stored %(stored)d, absent upstream %(absent)d, failed %(failed)d' % counts)
+    return 1 if counts['failed'] else 0
@@ -0,0 +1,307 @@
+"""
+Process-wide metrics, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are updated in place on the serving path,
+at the cost of a dict lookup and an uncontended lock each, so they can be
+left on in production. Figures which other objects already keep, such as
+the cache counters, are not mirrored on every change; a collector reads
+them when the metrics are scraped.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds; from a cached hit to a slow upstream
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PARSE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+# a single field of a page is a fraction of that
+FIELD_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    """
+    A family of metrics sharing a name, one child per set of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """
+        Returns the child for the given label values, in the order of
+        labelnames.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s takes labels %s' % (self.name, ', '.join(self.labelnames)))
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        """
+        Yields (suffix, label values, extra label, value) for every child.
+        """
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for suffix, extra, value in child.samples():
+                yield suffix, values, extra, value
+
+
+class _Value(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    @contextmanager
+    def track(self):
+        """
+        Counts the block as in progress while it runs.
+        """
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def samples(self):
+        yield '', '', self.value
+
+
+class Counter(_Metric):
+    """
+    A count which only goes up.
+    """
+
+    kind = 'counter'
+    _child = _Value
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    A value which goes up and down.
+    """
+
+    kind = 'gauge'
+    _child = _Value
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def track(self):
+        return self._default.track()
+
+
+class _Buckets(object):
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the time the block takes, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', 'le="%s"' % _number(float(bound)), cumulative
+        yield '_sum', '', total
+        yield '_count', '', cumulative
+
+
+class Histogram(_Metric):
+    """
+    A distribution of observed values, counted into buckets with the
+    given upper bounds.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labelnames)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class Registry(object):
+    """
+    The metrics of a process, and the collectors which read the figures
+    kept elsewhere when they are scraped.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, collect):
+        """
+        Registers collect, a function returning a list of (name, kind, help,
+        labelnames, [(label values, value)]) read at scrape time. Usable as
+        a decorator.
+        """
+        with self._lock:
+            self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, values, extra, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix, _labels(metric.labelnames, values, extra),
+                                            _number(value)))
+        for collect in collectors:
+            for name, kind, help, labelnames, samples in collect():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for values, value in samples:
+                    lines.append('%s%s %s' % (name, _labels(labelnames, values), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'apod_request_duration_seconds', 'Time to answer requests to the apod endpoint, by mode.', ('mode',))
+RESPONSES = REGISTRY.counter(
+    'apod_responses_total', 'Responses of the apod endpoint, by mode and status code.', ('mode', 'status'))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    'apod_requests_in_flight', 'Requests being answered.')
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'apod_upstream_fetch_duration_seconds', 'Time taken by fetches from the upstream services.', ('upstream',))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'apod_upstream_responses_total', 'Responses from the upstream services, by status code, or "error" if '
+    'there was none.', ('upstream', 'status'))
+PARSE_SECONDS = REGISTRY.histogram(
+    'apod_parse_duration_seconds', 'Time taken to parse APOD pages, by parser; "soup" is the fallback.',
+    ('parser',), PARSE_BUCKETS)
+FIELD_PARSE_SECONDS = REGISTRY.histogram(
+    'apod_parse_field_duration_seconds', 'Time taken to extract each field of APOD pages, by parser and field.',
+    ('parser', 'field'), FIELD_BUCKETS)
+THUMBNAIL_SECONDS = REGISTRY.histogram(
+    'apod_thumbnail_lookup_duration_seconds', 'Time taken by thumbnail lookups which were not cached.')
+
+
+def cache_collector(caches):
+    """
+    Returns a collector of the stats of the given ResultCaches, a dict of
+    name -> cache.
+    """
+    def collect():
+        stats = [(name, cache.stats()) for name, cache in sorted(caches.items())]
+        families = [
+            ('apod_cache_entries', 'gauge', 'Entries held in the cache.', 'entries'),
+            ('apod_cache_hits_total', 'counter', 'Lookups answered from the cache.', 'hits'),
+            ('apod_cache_misses_total', 'counter', 'Lookups the cache could not answer.', 'misses'),
+            ('apod_cache_evictions_total', 'counter', 'Entries dropped to make room.', 'evictions'),
+            ('apod_cache_expirations_total', 'counter', 'Entries dropped as expired.', 'expirations'),
+        ]
+        return [(name, kind, help, ('cache',), [((cache,), s[key]) for cache, s in stats])
+                for name, kind, help, key in families]
+    return collect
@@ -0,0 +1,87 @@
+"""
+Background pre-warming of the latest APOD entry.
+
+The first request after the daily upstream rollover would otherwise pay for
+a cold scrape of astropix.html. A Prewarmer polls that page on an interval
+instead, with conditional requests so that an unchanged page costs a 304,
+and hands the parsed entry to a callback which caches it.
+"""
+
+import logging
+import threading
+
+from apod import upstream, utility
+
+LOG = logging.getLogger(__name__)
+
+
+class Prewarmer(object):
+    """
+    Polls the upstream page of the latest entry every interval seconds on a
+    daemon thread. publish is called with the entry, parsed with thumbnails,
+    after every successful poll, whether or not the page changed, so that
+    whatever caches it can keep it fresh. latest_date records the date of
+    the latest entry upstream, which may lag the server's own clock.
+    """
+
+    def __init__(self, publish, interval=60, url=utility.BASE + 'astropix.html'):
+        self.publish = publish
+        self.interval = interval
+        self.url = url
+        self.latest = None
+        self.latest_date = None
+        self.polls = 0
+        self.not_modified = 0
+        self._etag = None
+        self._last_modified = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """
+        Fetches the page once, if it has changed, and publishes the latest
+        entry.
+        """
+        headers = {}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        res = upstream.get(self.url, headers=headers)
+        self.polls += 1
+
+        if res.status_code == 304 and self.latest is not None:
+            self.not_modified += 1
+        elif res.status_code == 200:
+            # kept as a snapshot, as any other fetch of it would be
+            data = utility.parse_fetched_page(res.text, res.content, res.status_code, thumbs='true')
+            if data != self.latest:
+                LOG.info('latest entry upstream is for ' + data['date'])
+            self.latest = data
+            self.latest_date = data['date']
+            self._etag = res.headers.get('ETag')
+            self._last_modified = res.headers.get('Last-Modified')
+        else:
+            LOG.warning('unexpected status polling ' + self.url + ': ' + str(res.status_code))
+            return
+
+        self.publish(self.latest)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as ex:
+                LOG.warning('failed to poll ' + self.url + ': ' + str(ex))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='apod-prewarm', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,167 @@
+"""
+Token bucket rate limiting of clients.
+
+Each client has a bucket of limit tokens, refilled at limit tokens per
+period seconds, and a request takes as many tokens as it costs. Buckets
+are not refilled on a timer but when next taken from, so an idle client
+costs nothing. A SQLite file shares the buckets between the worker
+processes on a node; without one each process limits on its own.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class TokenBuckets(object):
+    """
+    In-memory token buckets of limit tokens, refilled at limit tokens per
+    period seconds, for the clients of one process.
+    """
+
+    # takes between sweeps of the buckets which have filled up again
+    SWEEP_EVERY = 10000
+
+    def __init__(self, limit, period=3600.0, clock=time.time):
+        self.limit = limit
+        self.period = period
+        self.rate = limit / float(period)
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, cost=1):
+        """
+        Takes cost tokens from the bucket of key, if it holds that many.
+        Returns whether it did, the tokens left, and the seconds until the
+        bucket could pay for the request if it did not. A cost beyond the
+        limit is charged as the limit, so a full bucket pays for anything.
+        """
+        cost = min(cost, self.limit)
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.limit, now))
+            allowed, tokens = self._spend(tokens, updated, now, cost)
+            self._buckets[key] = (tokens, now)
+            self._takes += 1
+            if self._takes % self.SWEEP_EVERY == 0:
+                self._sweep(now)
+        return allowed, int(tokens), self._wait(tokens, cost, allowed)
+
+    def _spend(self, tokens, updated, now, cost):
+        # refills the bucket for the time since it was last taken from, then
+        # takes cost from it if it can
+        tokens = min(self.limit, tokens + max(0.0, now - updated) * self.rate)
+        if tokens >= cost:
+            return True, tokens - cost
+        return False, tokens
+
+    def _wait(self, tokens, cost, allowed):
+        return 0 if allowed else int(math.ceil((cost - tokens) / self.rate))
+
+    def _sweep(self, now):
+        # with the lock held: a bucket untouched for a period is full again,
+        # the same as one never taken from
+        self._buckets = dict((key, bucket) for key, bucket in self._buckets.items()
+                             if now - bucket[1] < self.period)
+
+    def close(self):
+        pass
+
+
+class SQLiteBuckets(TokenBuckets):
+    """
+    TokenBuckets kept in a SQLite database, so that every worker process
+    on a node draws on the same buckets. Each take is one short write
+    transaction.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS buckets ('
+              ' key TEXT PRIMARY KEY,'
+              ' tokens REAL NOT NULL,'
+              ' updated REAL NOT NULL)')
+
+    def __init__(self, path, limit, period=3600.0, clock=time.time, timeout=5.0):
+        super(SQLiteBuckets, self).__init__(limit, period, clock)
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute(self.SCHEMA)
+
+    def _conn(self):
+        # one connection per serving thread, as in store.SQLiteStore
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # autocommit, with transactions begun explicitly; see _take
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+            # the buckets are cheap to lose in a crash
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def take(self, key, cost=1):
+        cost = min(cost, self.limit)
+        now = self._clock()
+        try:
+            return self._take(key, cost, now)
+        except sqlite3.Error as ex:
+            # a request is let through rather than failed for want of its bucket
+            LOG.warning('failed to take from the rate limit bucket of ' + key + ': ' + str(ex))
+            return True, self.limit, 0
+
+    def _take(self, key, cost, now):
+        conn = self._conn()
+        # taken for writing up front, so that no other process reads the
+        # bucket between this read and write
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (self.limit, now)
+            allowed, tokens = self._spend(tokens, updated, now, cost)
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+            with self._lock:
+                self._takes += 1
+                sweep = self._takes % self.SWEEP_EVERY == 0
+            if sweep:
+                conn.execute('DELETE FROM buckets WHERE updated <= ?', (now - self.period,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, int(tokens), self._wait(tokens, cost, allowed)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def from_environ(environ=os.environ):
+    """
+    Returns the TokenBuckets configured by APOD_RATE_LIMIT* environment
+    variables, or None if rate limiting is off.
+    """
+    limit = int(environ.get('APOD_RATE_LIMIT', 0))
+    if limit <= 0:
+        return None
+    period = float(environ.get('APOD_RATE_LIMIT_PERIOD', 3600))
+    path = environ.get('APOD_RATE_LIMIT_DB')
+    if not path:
+        return TokenBuckets(limit, period)
+    LOG.info('Sharing rate limits through ' + path)
+    return SQLiteBuckets(path, limit, period)
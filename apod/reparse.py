@@ -0,0 +1,183 @@
+"""
+Offline re-parse of the archive from page snapshots.
+
+After a parser fix, regenerates the archived entries from the pages kept
+in a snapshot store (see apod.snapshots) instead of scraping apod.nasa.gov
+again. Pages are parsed in a pool of processes, one per CPU core by
+default, and the entries written back from this one, so the archive keeps
+a single writer. Every variant of an entry held in the archive is
+replaced; what does not come from the page, its concepts and thumbnail,
+is carried over.
+
+Nodes serve the new entries once they drop the old ones from their
+results cache, on restart.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse
+import logging
+import os
+
+from apod import snapshots, utility
+from apod.ingest import settled_through, _date_arg, PROGRESS_EVERY
+from apod.store import open_store
+
+LOG = logging.getLogger(__name__)
+
+# the (concept_tags, thumbs) variants an archive may hold
+VARIANTS = ((False, False), (False, True), (True, False), (True, True))
+
+# the snapshot store of a worker process; see _start_worker
+_store = None
+
+
+def _start_worker(root):
+    global _store
+    _store = snapshots.SnapshotStore(root)
+    # the parsers log every field at debug level
+    logging.getLogger('apod').setLevel(logging.WARNING)
+
+
+def _parse(dt):
+    """
+    Returns the date, the entry parsed from its snapshot, and the error
+    parsing failed with, if it did.
+    """
+    try:
+        content = _store.get(snapshots.page_name(dt))
+        return dt, utility.parse_apod_page(snapshots.decode(content), dt), None
+    except Exception as ex:
+        return dt, None, type(ex).__name__ + ': ' + str(ex)
+
+
+def snapshot_dates(store, start=None, end=None):
+    """
+    Returns the dates from start to end, inclusive, whose pages the
+    snapshot store holds, in order.
+    """
+    dates = (snapshots.page_date(name) for name in store.names())
+    return sorted(dt for dt in dates
+                  if dt is not None and (start is None or dt >= start) and (end is None or dt <= end))
+
+
+def _updated(old, new):
+    """
+    Returns the entry new with what old had from elsewhere than the page,
+    or None if that no longer applies to it.
+    """
+    new = dict(new)
+    if 'concepts' in old:
+        new['concepts'] = old['concepts']
+    if 'thumbnail_url' in old:
+        if old.get('url') != new.get('url'):
+            # the video changed, and its thumbnail would have to be looked up
+            return None
+        new['thumbnail_url'] = old['thumbnail_url']
+    return new
+
+
+def reparse(snapshot_store, store, dates, workers=None, dry_run=False):
+    """
+    Parses the snapshot of each of dates again and stores the entries
+    wherever they differ from those held in store, in every variant held,
+    or as a plain entry if there is none. With dry_run nothing is written.
+
+    Returns a dict counting the dates parsed, the entries changed, those
+    left alone as their thumbnail would need looking up again, and the
+    dates which failed to parse.
+    """
+    held = dict((variant, store.dates(variant)) for variant in VARIANTS)
+    counts = {'parsed': 0, 'changed': 0, 'stale': 0, 'failed': 0}
+
+    if workers == 1:
+        _start_worker(snapshot_store.root)
+        pool = None
+        results = map(_parse, dates)
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(snapshot_store.root,))
+        results = pool.map(_parse, dates, chunksize=16)
+
+    try:
+        for i, (dt, data, error) in enumerate(results):
+            if error is not None:
+                counts['failed'] += 1
+                LOG.warning('failed to parse the snapshot of ' + dt.isoformat() + ': ' + error)
+                continue
+            counts['parsed'] += 1
+
+            for variant in [variant for variant in VARIANTS if dt in held[variant]] or [VARIANTS[0]]:
+                old = store.get(dt, variant) or {}
+                new = _updated(old, data)
+                if new is None:
+                    counts['stale'] += 1
+                    LOG.warning('the video of ' + dt.isoformat() + ' changed; left its thumbs=True entry alone')
+                elif new != old:
+                    counts['changed'] += 1
+                    LOG.debug('changed ' + dt.isoformat() + ' ' + str(variant))
+                    if not dry_run:
+                        store.put(dt, variant, new)
+
+            if (i + 1) % PROGRESS_EVERY == 0:
+                LOG.info('parsed %d of %d dates (%s)' % (i + 1, len(dates), dt.isoformat()))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return counts
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='apod-reparse',
+        description='Regenerate the entries of a local SQLite archive from page snapshots, '
+                    'without fetching anything from apod.nasa.gov.')
+    parser.add_argument('--archive', default=os.environ.get('APOD_ARCHIVE'),
+                        help='path of the SQLite archive to update (default: $APOD_ARCHIVE)')
+    parser.add_argument('--snapshots', default=os.environ.get('APOD_SNAPSHOT_DIR'),
+                        help='directory of the page snapshots (default: $APOD_SNAPSHOT_DIR)')
+    parser.add_argument('--start', type=_date_arg, default=None,
+                        help='first date to parse again (default: the first snapshot)')
+    parser.add_argument('--end', type=_date_arg, default=None,
+                        help='last date to parse again (default: the latest settled date)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of parsing processes (default: one per CPU core)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='count the entries which would change, without writing them')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log each changed entry')
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.archive or not args.snapshots:
+        parser.error('pass --archive and --snapshots, or set APOD_ARCHIVE and APOD_SNAPSHOT_DIR')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    logging.getLogger('apod').setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    # entries which may still change upstream are not archived
+    end = min(args.end or settled_through(), settled_through())
+    snapshot_store = snapshots.SnapshotStore(args.snapshots)
+    dates = snapshot_dates(snapshot_store, args.start, end)
+    LOG.info('%d snapshots to parse again, through %s' % (len(dates), end.isoformat()))
+    if not dates:
+        return 0
+
+    store = open_store(args.archive)
+    started = datetime.utcnow()
+    try:
+        counts = reparse(snapshot_store, store, dates, args.workers, args.dry_run)
+    except KeyboardInterrupt:
+        LOG.warning('interrupted; run again to finish')
+        return 1
+    finally:
+        store.close()
+
+    counts['seconds'] = (datetime.utcnow() - started).total_seconds()
+    LOG.info(('would change' if args.dry_run else 'changed') +
+             ' %(changed)d entries from %(parsed)d pages in %(seconds).1fs; '
+             'stale thumbnails %(stale)d, failed %(failed)d' % counts)
+    return 1 if counts['failed'] else 0
@@ -0,0 +1,141 @@
+"""
+Local store of the raw APOD pages the service has fetched.
+
+Pages are kept gzipped under the SHA-256 of their bytes, so a page fetched
+again unchanged, or the latest entry's page fetched both as astropix.html
+and under its date, is stored once. A small ref file per page name points
+at the bytes last fetched for it.
+
+With the pages kept, entries can be parsed again after a parser fix without
+fetching anything (see apod.reparse), and the service can run as a mirror
+serving pages from the store instead of apod.nasa.gov.
+"""
+
+from datetime import date
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+# the page of the latest entry
+LATEST = 'astropix.html'
+PAGE_NAME = re.compile(r'^ap(\d\d)(\d\d)(\d\d)\.html$')
+
+
+def page_name(dt):
+    """
+    Returns the name of the upstream page of the entry for a date, or of
+    the latest entry if dt is None.
+    """
+    return 'ap%s.html' % dt.strftime('%y%m%d') if dt else LATEST
+
+
+def page_date(name):
+    """
+    Returns the date of the entry a page name is for, or None if it is not
+    the page of a date.
+    """
+    match = PAGE_NAME.match(name)
+    if match is None:
+        return None
+    year, month, day = (int(part) for part in match.groups())
+    # the archive began in 1995
+    return date(year + (1900 if year >= 95 else 2000), month, day)
+
+
+class SnapshotStore(object):
+    """
+    Content-addressed store of page bytes in a directory, safe to share
+    between processes: every file is written to a temporary name and moved
+    into place.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._objects = os.path.join(root, 'objects')
+        self._refs = os.path.join(root, 'refs')
+        for path in (self._objects, self._refs):
+            os.makedirs(path, exist_ok=True)
+
+    def _object(self, digest):
+        return os.path.join(self._objects, digest[:2], digest + '.gz')
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def put(self, name, content):
+        """
+        Stores content, the bytes of the page of the given name, and returns
+        their digest.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # no timestamp, so that the same page always makes the same file
+            self._write(path, gzip.compress(content, 6, mtime=0))
+        self._write(os.path.join(self._refs, name), digest.encode('ascii'))
+        return digest
+
+    def link(self, name, digest):
+        """
+        Points the page of the given name at bytes already stored.
+        """
+        self._write(os.path.join(self._refs, name), digest.encode('ascii'))
+
+    def digest(self, name):
+        """
+        Returns the digest of the bytes stored for the page of the given
+        name, or None if there are none.
+        """
+        try:
+            with open(os.path.join(self._refs, name), 'rb') as f:
+                return f.read().decode('ascii')
+        except (IOError, OSError):
+            return None
+
+    def get(self, name):
+        """
+        Returns the bytes stored for the page of the given name, or None.
+        """
+        digest = self.digest(name)
+        if digest is None:
+            return None
+        with gzip.open(self._object(digest), 'rb') as f:
+            return f.read()
+
+    def names(self):
+        """
+        Returns the names of the pages held, sorted.
+        """
+        return sorted(name for name in os.listdir(self._refs) if not name.startswith('.'))
+
+
+def decode(content):
+    """
+    Returns the text of page bytes. apod.nasa.gov declares no charset, which
+    requests takes as latin-1, so the text is what the parser saw live.
+    """
+    return content.decode('latin1')
+
+
+def from_environ(environ=os.environ):
+    """
+    Returns the SnapshotStore named by APOD_SNAPSHOT_DIR, or None.
+    """
+    root = environ.get('APOD_SNAPSHOT_DIR')
+    if not root:
+        return None
+    LOG.info('Keeping snapshots of fetched pages in ' + root)
+    return SnapshotStore(root)
@@ -0,0 +1,281 @@
+"""
+Persistent on-disk archive of parsed APOD entries.
+
+Entries for past dates never change upstream, so once parsed they can be
+kept on disk and shared by every worker process on a node instead of being
+re-scraped from apod.nasa.gov after each restart.
+"""
+
+from abc import ABC, abstractmethod
+import datetime
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class ArchiveStore(ABC):
+    """
+    Interface for a store of parsed APOD entries. Entries are keyed by
+    their date plus the (concept_tags, thumbs) variant of the request that
+    produced them.
+    """
+
+    @abstractmethod
+    def get(self, dt, variant):
+        """
+        Returns the stored entry for the given date and variant, or None.
+        """
+
+    def get_many(self, dates, variant):
+        """
+        Returns a dict of date -> entry for those of the given dates which
+        are held in the store.
+        """
+        found = {}
+        for dt in dates:
+            data = self.get(dt, variant)
+            if data is not None:
+                found[dt] = data
+        return found
+
+    @abstractmethod
+    def put(self, dt, variant, data):
+        """
+        Stores the entry for the given date and variant.
+        """
+
+    @abstractmethod
+    def dates(self, variant):
+        """
+        Returns the set of dates for which an entry of the given variant is
+        stored.
+        """
+
+    @abstractmethod
+    def mark_absent(self, dt):
+        """
+        Records that apod.nasa.gov has no entry for the given date, so that
+        bulk ingests stop asking for it. Storing an entry for it clears this.
+        """
+
+    @abstractmethod
+    def absent_dates(self):
+        """
+        Returns the set of dates recorded as having no entry upstream.
+        """
+
+    # whether search() is supported
+    searchable = False
+
+    @abstractmethod
+    def search(self, query, start=None, end=None, order='relevance', limit=20, offset=0):
+        """
+        Returns the number of stored entries matching query, a string of
+        words, between the dates start and end, and a page of limit of them
+        from offset, best matches or, with order='date', latest first.
+        Raises a ValueError if query has no words in it.
+        """
+
+    def close(self):
+        pass
+
+
+class NullStore(ArchiveStore):
+    """
+    A store which holds nothing. Used when no archive is configured.
+    """
+
+    def get(self, dt, variant):
+        return None
+
+    def get_many(self, dates, variant):
+        return {}
+
+    def put(self, dt, variant, data):
+        pass
+
+    def dates(self, variant):
+        return set()
+
+    def mark_absent(self, dt):
+        pass
+
+    def absent_dates(self):
+        return set()
+
+    def search(self, query, start=None, end=None, order='relevance', limit=20, offset=0):
+        # not searchable; callers check first, but nothing matches anyway
+        return 0, []
+
+
+class SQLiteStore(ArchiveStore):
+    """
+    An ArchiveStore backed by a SQLite database in WAL mode, so that any
+    number of worker processes on a node can read it concurrently while
+    one of them writes.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS apod ('
+              ' date TEXT NOT NULL,'
+              ' concept_tags INTEGER NOT NULL,'
+              ' thumbs INTEGER NOT NULL,'
+              ' data TEXT NOT NULL,'
+              ' stored_at REAL NOT NULL,'
+              ' PRIMARY KEY (date, concept_tags, thumbs))')
+
+    # dates apod.nasa.gov has no entry for, such as the gaps of its first years
+    ABSENT_SCHEMA = ('CREATE TABLE IF NOT EXISTS apod_absent ('
+                     ' date TEXT PRIMARY KEY,'
+                     ' checked_at REAL NOT NULL)')
+
+    # full-text index of the entries, one row per date, keyed by its ordinal
+    SEARCH_SCHEMA = ('CREATE VIRTUAL TABLE IF NOT EXISTS apod_search USING fts5('
+                     ' date UNINDEXED, title, explanation, copyright, data UNINDEXED,'
+                     " tokenize='porter unicode61')")
+    # relative weights of the title, explanation and copyright in rankings
+    SEARCH_RANK = 'bm25(apod_search, 0, 10.0, 1.0, 2.0)'
+    # PRAGMA user_version of an archive whose entries have been indexed
+    SEARCH_VERSION = 1
+
+    searchable = True
+
+    # SQLite caps the number of host parameters in a single statement
+    MAX_BATCH = 500
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute(self.SCHEMA)
+            conn.execute(self.ABSENT_SCHEMA)
+            conn.execute(self.SEARCH_SCHEMA)
+            if conn.execute('PRAGMA user_version').fetchone()[0] < self.SEARCH_VERSION:
+                # an archive from before the index; index what it holds
+                for key, data in conn.execute('SELECT date, data FROM apod ORDER BY thumbs').fetchall():
+                    self._index(conn, datetime.datetime.strptime(key, '%Y-%m-%d').date(), json.loads(data))
+                conn.execute('PRAGMA user_version = %d' % self.SEARCH_VERSION)
+
+    def _conn(self):
+        # each serving thread lazily opens its own connection; they are only
+        # ever used from that thread but may be closed from another
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get(self, dt, variant):
+        row = self._conn().execute(
+            'SELECT data FROM apod WHERE date = ? AND concept_tags = ? AND thumbs = ?',
+            (dt.isoformat(), int(variant[0]), int(variant[1]))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_many(self, dates, variant):
+        by_key = dict((dt.isoformat(), dt) for dt in dates)
+        keys = list(by_key)
+        found = {}
+        for i in range(0, len(keys), self.MAX_BATCH):
+            batch = keys[i:i + self.MAX_BATCH]
+            rows = self._conn().execute(
+                'SELECT date, data FROM apod WHERE concept_tags = ? AND thumbs = ? AND date IN (%s)'
+                % ','.join('?' * len(batch)),
+                [int(variant[0]), int(variant[1])] + batch)
+            for key, data in rows:
+                found[by_key[key]] = json.loads(data)
+        return found
+
+    def put(self, dt, variant, data):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO apod VALUES (?, ?, ?, ?, ?)',
+                         (dt.isoformat(), int(variant[0]), int(variant[1]),
+                          json.dumps(data), time.time()))
+            conn.execute('DELETE FROM apod_absent WHERE date = ?', (dt.isoformat(),))
+            self._index(conn, dt, data)
+
+    def _index(self, conn, dt, data):
+        # every variant of a date has the same text; the index holds it once,
+        # without what only some variants have
+        entry = dict((key, value) for key, value in data.items() if key not in ('concepts', 'thumbnail_url'))
+        conn.execute('INSERT OR REPLACE INTO apod_search (rowid, date, title, explanation, copyright, data)'
+                     ' VALUES (?, ?, ?, ?, ?, ?)',
+                     (dt.toordinal(), dt.isoformat(), entry.get('title', ''), entry.get('explanation', ''),
+                      entry.get('copyright', ''), json.dumps(entry)))
+
+    def search(self, query, start=None, end=None, order='relevance', limit=20, offset=0):
+        match = _match(query)
+        where = 'apod_search MATCH ?'
+        params = [match]
+        if start is not None:
+            where += ' AND rowid >= ?'
+            params.append(start.toordinal())
+        if end is not None:
+            where += ' AND rowid <= ?'
+            params.append(end.toordinal())
+        conn = self._conn()
+        total = conn.execute('SELECT count(*) FROM apod_search WHERE ' + where, params).fetchone()[0]
+        rows = conn.execute(
+            'SELECT data FROM apod_search WHERE %s ORDER BY %s LIMIT ? OFFSET ?'
+            % (where, 'rowid DESC' if order == 'date' else self.SEARCH_RANK),
+            params + [limit, offset])
+        return total, [json.loads(row[0]) for row in rows]
+
+    def dates(self, variant):
+        rows = self._conn().execute(
+            'SELECT date FROM apod WHERE concept_tags = ? AND thumbs = ?',
+            (int(variant[0]), int(variant[1])))
+        return set(datetime.datetime.strptime(row[0], '%Y-%m-%d').date() for row in rows)
+
+    def mark_absent(self, dt):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO apod_absent VALUES (?, ?)', (dt.isoformat(), time.time()))
+
+    def absent_dates(self):
+        rows = self._conn().execute('SELECT date FROM apod_absent')
+        return set(datetime.datetime.strptime(row[0], '%Y-%m-%d').date() for row in rows)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def _match(query):
+    """
+    Returns an FTS5 query matching every word of query, a word ending in *
+    as a prefix. Raises a ValueError if there are no words in query.
+    """
+    words = re.findall(r'\w+\*?', query or '')
+    if not words:
+        raise ValueError('Search query must contain at least one word.')
+    return ' '.join('"%s"%s' % (word.rstrip('*'), '*' if word.endswith('*') else '') for word in words)
+
+
+def open_store(path):
+    """
+    Returns the ArchiveStore for the given path, or a NullStore if no path
+    is configured.
+    """
+    if not path:
+        return NullStore()
+    LOG.info('Using APOD archive at ' + path)
+    return SQLiteStore(path)
@@ -0,0 +1,146 @@
+"""
+Resolution of thumbnail URLs for the videos embedded in APOD pages.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from apod import metrics, upstream
+from apod.coalesce import SingleFlight
+
+LOG = logging.getLogger(__name__)
+
+YOUTUBE_ID = re.compile(r"(?:(?<=(v|V)/)|(?<=be/)|(?<=(\?|\&)v=)|(?<=embed/))([\w-]+)")
+VIMEO_ID = re.compile(r"(?:/video/)(\d+)")
+YOUTUBE_THUMBNAIL = 'https://img.youtube.com/vi/%s/0.jpg'
+VIMEO_API = os.environ.get('APOD_VIMEO_API', 'https://vimeo.com/api/v2/video/%s.json')
+
+
+class ThumbnailError(Exception):
+    """
+    Raised when the thumbnail of a video could not be looked up for now.
+    """
+
+
+class ThumbnailResolver(object):
+    """
+    Maps the URL of an embedded video to the URL of its thumbnail, or to ''
+    if it has none. YouTube thumbnails follow from the video ID. Vimeo ones
+    are looked up through the Vimeo API and kept in a bounded cache; a video
+    Vimeo no longer has is kept as '', while a lookup that failed otherwise
+    is kept for negative_ttl seconds, during which asking again raises a
+    ThumbnailError straight away. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=4096, negative_ttl=600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.lookups = 0
+        self.failures = 0
+
+    def resolve(self, url):
+        """
+        Returns the thumbnail URL for the given video URL, or ''. Raises a
+        ThumbnailError if it cannot be looked up for now.
+        """
+        if 'youtube' in url or 'youtu.be' in url:
+            video_id = ''.join(''.join(groups) for groups in YOUTUBE_ID.findall(url))
+            return YOUTUBE_THUMBNAIL % video_id.replace('?', '').replace('&', '')
+        if 'vimeo' in url:
+            match = VIMEO_ID.search(url)
+            if match is None:
+                LOG.warning('no Vimeo video ID in ' + url)
+                return ''
+            return self._vimeo(match.group(1))
+        # not a video, or not one with a known thumbnail
+        return ''
+
+    def resolve_many(self, urls, map=map):
+        """
+        Returns a dict of url -> thumbnail URL for the given video URLs. Each
+        distinct Vimeo video not already cached is looked up once, through
+        the given map function, which may run the lookups concurrently.
+        Raises a ThumbnailError if any of them cannot be looked up for now.
+        """
+        urls = list(set(urls))
+        return dict(zip(urls, map(self.resolve, urls)))
+
+    def _vimeo(self, video_id):
+        thumbnail = self.cached_vimeo(video_id)
+        if thumbnail is not None:
+            return thumbnail
+        thumbnail = self._flight.do(video_id, self._lookup_vimeo, video_id)
+        if thumbnail is None:
+            raise ThumbnailError('Vimeo lookup for video ' + video_id + ' failed')
+        return thumbnail
+
+    def cached_vimeo(self, video_id):
+        """
+        Returns the cached thumbnail URL of a Vimeo video, or None if it has
+        to be looked up. Raises a ThumbnailError if a lookup failed recently.
+        """
+        with self._lock:
+            item = self._cache.get(video_id)
+            if item is None:
+                return None
+            thumbnail, expires = item
+            if expires is not None and expires <= self._clock():
+                del self._cache[video_id]
+                return None
+            self._cache.move_to_end(video_id)
+        if thumbnail is None:
+            raise ThumbnailError('Vimeo lookup for video ' + video_id + ' failed recently')
+        return thumbnail
+
+    def _lookup_vimeo(self, video_id):
+        with metrics.THUMBNAIL_SECONDS.time():
+            try:
+                res = upstream.get(VIMEO_API % video_id, service='vimeo')
+                thumbnail = self.record_vimeo(video_id, res.status_code, res.content)
+            except Exception as ex:
+                thumbnail = self.record_vimeo(video_id, error=ex)
+        return thumbnail
+
+    def record_vimeo(self, video_id, status_code=None, content=None, error=None):
+        """
+        Caches the outcome of a lookup of a Vimeo video through the Vimeo
+        API, made by whatever client, and returns the thumbnail URL, or None
+        if the lookup failed.
+        """
+        expires = None
+        try:
+            if error is not None:
+                raise error
+            if status_code == 404:
+                LOG.info('Vimeo has no video ' + video_id)
+                thumbnail = ''
+            elif status_code != 200:
+                raise Exception('HTTP ' + str(status_code))
+            else:
+                thumbnail = json.loads(content.decode('utf-8'))[0]['thumbnail_large']
+        except Exception as ex:
+            LOG.warning('failed to look up the thumbnail of Vimeo video ' + video_id + ': ' + str(ex))
+            thumbnail = None
+            expires = self._clock() + self.negative_ttl
+
+        with self._lock:
+            self.lookups += 1
+            if expires is not None:
+                self.failures += 1
+            self._cache[video_id] = (thumbnail, expires)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return thumbnail
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._cache), 'lookups': self.lookups, 'failures': self.failures}
@@ -0,0 +1,274 @@
+"""
+Opt-in tracing of single requests.
+
+A traced request records a timed span for each stage it goes through, from
+the endpoint down to the upstream fetch and each field's extraction. The
+spans are summed by name into a Server-Timing header, and can be appended
+to a local trace file as JSON lines. A request may also be run under
+cProfile, and the profile dumped for offline analysis.
+
+Untraced requests pay for a context variable lookup per stage, so the
+spans can stay in the code.
+"""
+
+from contextvars import ContextVar
+from functools import wraps
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+LOG = logging.getLogger(__name__)
+
+# the trace of the request being served, if it is being traced
+_current = ContextVar('apod_trace', default=None)
+
+
+class Trace(object):
+    """
+    The spans recorded while serving one request. Spans may be recorded
+    from several threads at once; see bind.
+    """
+
+    def __init__(self, name='request', profile=False):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self.duration = None
+        self._lock = threading.Lock()
+        self.profiler = cProfile.Profile() if profile else None
+        # restores the trace of the context once this one stops; see start
+        self.token = None
+
+    def add(self, name, start, duration):
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'start': start - self.started,
+                'duration': duration,
+                'thread': threading.current_thread().name,
+            })
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+        return self
+
+    def timings(self):
+        """
+        Returns a list of (name, total seconds, count) of the spans, in the
+        order their names were first recorded.
+        """
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total, count = totals.get(span['name'], (0.0, 0))
+            totals[span['name']] = (total + span['duration'], count + 1)
+        return [(name, total, count) for name, (total, count) in totals.items()]
+
+    def server_timing(self):
+        """
+        Returns the value of a Server-Timing header for the spans so far,
+        with the whole request as total.
+        """
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.started
+        entries = ['total;dur=%.2f' % (duration * 1e3)]
+        for name, total, count in self.timings():
+            entry = '%s;dur=%.2f' % (name, total * 1e3)
+            if count > 1:
+                entry += ';desc="x%d"' % count
+            entries.append(entry)
+        return ', '.join(entries)
+
+    def to_dict(self, **extra):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return dict(extra, id=self.id, name=self.name, duration=self.duration, spans=spans)
+
+
+class _Span(object):
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current():
+    """
+    Returns the trace of the request being served, or None.
+    """
+    return _current.get()
+
+
+def span(name):
+    """
+    Returns a context manager recording the block as a span of the current
+    trace, if there is one.
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name)
+
+
+def traced(name=None):
+    """
+    Decorates a function so that each call is recorded as a span, named
+    after the function unless name is given.
+    """
+    def decorate(fn):
+        label = name or fn.__name__.lstrip('_')
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _Span(trace, label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def bind(fn):
+    """
+    Returns fn wrapped to record its spans into the current trace, for
+    running on another thread, which does not inherit it.
+    """
+    trace = _current.get()
+    if trace is None:
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+
+def start(name='request', profile=False):
+    """
+    Starts tracing the current request and returns its trace.
+    """
+    trace = Trace(name, profile)
+    trace.token = _current.set(trace)
+    if trace.profiler is not None:
+        try:
+            trace.profiler.enable()
+        except ValueError as ex:
+            # another request is being profiled
+            LOG.warning('not profiling trace ' + trace.id + ': ' + str(ex))
+            trace.profiler = None
+    return trace
+
+
+def stop(trace):
+    """
+    Stops tracing the current request, and returns its trace.
+    """
+    if trace.profiler is not None:
+        trace.profiler.disable()
+    try:
+        _current.reset(trace.token)
+    except ValueError:
+        # stopped from another context than it was started in
+        _current.set(None)
+    return trace.finish()
+
+
+class Tracer(object):
+    """
+    Decides which requests to trace, and where their traces go. A request
+    is traced if it presents token, when one is set, or else with
+    probability sample_rate. Traces are appended to trace_file, if given,
+    and the profiles of requests asking for one are dumped to profile_dir,
+    if given.
+    """
+
+    def __init__(self, token=None, sample_rate=0.0, trace_file=None, profile_dir=None):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.trace_file = trace_file
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.token or self.sample_rate)
+
+    def wanted(self, header):
+        """
+        Returns whether to trace a request, and whether to profile it,
+        given the value of its trace header. A header of the token asks for
+        a trace, of the token followed by ';profile' for a profile too.
+        """
+        if header and self.token:
+            token, _, option = header.partition(';')
+            # compared as bytes, as compare_digest refuses non-ASCII strings
+            if hmac.compare_digest(token.strip().encode('utf-8'), self.token.encode('utf-8')):
+                return True, option.strip() == 'profile' and self.profile_dir is not None
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True, False
+        return False, False
+
+    def record(self, trace, **extra):
+        """
+        Writes the trace to the trace file, and its profile to the profile
+        directory, as configured.
+        """
+        if self.trace_file:
+            line = json.dumps(trace.to_dict(**extra), sort_keys=True)
+            try:
+                with self._lock, open(self.trace_file, 'a') as f:
+                    f.write(line + '\n')
+            except IOError as ex:
+                LOG.warning('failed to write trace to ' + self.trace_file + ': ' + str(ex))
+        if trace.profiler is not None:
+            path = os.path.join(self.profile_dir, '%d-%s.prof' % (time.time(), trace.id))
+            try:
+                trace.profiler.dump_stats(path)
+                LOG.info('wrote profile of trace ' + trace.id + ' to ' + path)
+            except IOError as ex:
+                LOG.warning('failed to write profile to ' + path + ': ' + str(ex))
+
+
+def from_environ(environ=os.environ):
+    """
+    Returns a Tracer configured from APOD_TRACE_* environment variables.
+    """
+    return Tracer(token=environ.get('APOD_TRACE_TOKEN') or None,
+                  sample_rate=float(environ.get('APOD_TRACE_SAMPLE', 0)),
+                  trace_file=environ.get('APOD_TRACE_FILE') or None,
+                  profile_dir=environ.get('APOD_TRACE_PROFILE_DIR') or None)
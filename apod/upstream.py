@@ -0,0 +1,80 @@
+"""
+Shared HTTP client for the upstream services this one scrapes: the APOD
+pages themselves and the Vimeo API used to look up video thumbnails.
+
+Every fetch goes through one pooled, keep-alive session, so a cache miss
+does not pay for a new TCP and TLS handshake, and every fetch is bounded by
+connect and read timeouts so that a hung upstream cannot tie up a worker.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from apod import metrics
+
+LOG = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = float(os.environ.get('APOD_UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('APOD_UPSTREAM_READ_TIMEOUT', 10))
+RETRIES = int(os.environ.get('APOD_UPSTREAM_RETRIES', 2))
+# connections kept alive per host; should cover the fetch engine's workers
+POOL_SIZE = int(os.environ.get('APOD_UPSTREAM_POOL_SIZE', 32))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _make_session():
+    # requests and urllib3 take longer to import than the rest of the
+    # service, so they are put off until the first fetch; a node serving
+    # from its archive may never make one
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # only GETs are ever retried, and only on connection failures, read
+    # timeouts and gateway errors; a 404 is an answer, not a failure
+    retry = Retry(total=RETRIES, connect=RETRIES, read=RETRIES, status=RETRIES,
+                  backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def session():
+    """
+    Returns the shared upstream session, creating it on first use.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _make_session()
+    return _session
+
+
+def get(url, service='apod', **kwargs):
+    """
+    GETs the given URL through the shared session with the configured
+    timeouts, counting it in the metrics of the named upstream service.
+    Other keyword arguments are passed on to requests.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    LOG.debug('GET ' + url)
+    start = time.perf_counter()
+    try:
+        res = session().get(url, **kwargs)
+    except Exception:
+        metrics.UPSTREAM_RESPONSES.labels(service, 'error').inc()
+        raise
+    finally:
+        metrics.UPSTREAM_SECONDS.labels(service).observe(time.perf_counter() - start)
+    metrics.UPSTREAM_RESPONSES.labels(service, str(res.status_code)).inc()
+    return res
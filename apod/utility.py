@@ -6,62 +6,98 @@ Created on Mar 24, 2017
 @author=bathomas @email=brian.a.thomas@nasa.gov
 """
 
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from apod import extractor, metrics, snapshots, tracing, upstream
+from apod.coalesce import SingleFlight
+from apod.thumbs import ThumbnailError, ThumbnailResolver
 import datetime
-import requests
 import logging
 import json
+import os
 import re
-import urllib3
+import time
 # import urllib.request
 
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARN)
 
 # location of backing APOD service
-BASE = 'https://apod.nasa.gov/apod/'
+BASE = os.environ.get('APOD_BASE_URL', 'https://apod.nasa.gov/apod/')
 
-# Create urllib3 Pool Manager
-http = urllib3.PoolManager()
+# the raw pages fetched are kept here, if configured; see apod.snapshots
+SNAPSHOTS = snapshots.from_environ()
+# a mirror reads pages from SNAPSHOTS rather than fetching them from BASE,
+# which media URLs are still relative to
+MIRROR = os.environ.get('APOD_MIRROR', '').lower() in ('1', 'true', 'yes')
+if MIRROR and SNAPSHOTS is None:
+    raise ValueError('APOD_MIRROR needs APOD_SNAPSHOT_DIR to serve pages from')
+
+# concurrent parses of the same page share one fetch
+IN_FLIGHT = SingleFlight()
+# thumbnails of the videos seen so far
+THUMBNAILS = ThumbnailResolver()
 
 # function for getting video thumbnails
 def _get_thumbs(data):
-    global video_thumb
-    if "youtube" in data or "youtu.be" in data:
-        # get ID from YouTube URL
-        youtube_id_regex = re.compile("(?:(?<=(v|V)/)|(?<=be/)|(?<=(\?|\&)v=)|(?<=embed/))([\w-]+)")
-        video_id = youtube_id_regex.findall(data)
-        video_id = ''.join(''.join(elements) for elements in video_id).replace("?", "").replace("&", "")
-        # get URL of thumbnail
-        video_thumb = "https://img.youtube.com/vi/" + video_id + "/0.jpg"
-    elif "vimeo" in data:
-        # get ID from Vimeo URL
-        vimeo_id_regex = re.compile("(?:/video/)(\d+)")
-        vimeo_id = vimeo_id_regex.findall(data)[0]
-        # make an API call to get thumbnail URL
-        vimeo_request = http.request("GET", "https://vimeo.com/api/v2/video/" + vimeo_id + ".json")
-        data = json.loads(vimeo_request.data.decode('utf-8'))
-        video_thumb = data[0]['thumbnail_large']
-    else:
-        # the thumbs parameter is True, but the APOD for the date is not a video, output nothing
-        video_thumb = ""
+    return THUMBNAILS.resolve(data)
+
+# the fields an entry may have
+FIELDS = frozenset(['date', 'title', 'explanation', 'copyright', 'media_type', 'url', 'hdurl', 'thumbnail_url',
+                    'concepts'])
+# the fields whose extraction is skipped unless asked for; the others come
+# with the media, or are needed to tell what the entry is
+LAZY_FIELDS = frozenset(['title', 'explanation', 'copyright'])
 
-    return video_thumb
+
+def extracted(fields):
+    """
+    Returns the fields an entry holds when parsed for the given set of
+    wanted fields, or None if it holds them all; see parse_apod_page.
+    """
+    if fields is None or LAZY_FIELDS <= fields:
+        return None
+    return FIELDS - (LAZY_FIELDS - fields)
+
+LAST_URL = re.compile(r"(?:.(?!http[s]?://))+$")
 
 # function that returns only last URL if there are multiple URLs stacked together
 def _get_last_url(data):
-    regex = re.compile("(?:.(?!http[s]?://))+$")
-    return regex.findall(data)[0]
+    return LAST_URL.findall(data)[0]
 
-def _get_apod_chars(dt, thumbs):
-    media_type = 'image'
-    if dt:
-        date_str = dt.strftime('%y%m%d')
-        apod_url = '%sap%s.html' % (BASE, date_str)
-    else:
-        apod_url = '%sastropix.html' % BASE
+
+def _snapshot(name, content):
+    """
+    Keeps the bytes of a fetched page in SNAPSHOTS, if configured, and
+    returns their digest. A page which cannot be kept is only logged.
+    """
+    if SNAPSHOTS is None:
+        return None
+    try:
+        with tracing.span('snapshot'):
+            return SNAPSHOTS.put(name, content)
+    except (IOError, OSError) as ex:
+        LOG.warning('failed to keep a snapshot of ' + name + ': ' + str(ex))
+        return None
+
+
+def _read_snapshot(dt, thumbs, fields=None):
+    # the mirror's _get_apod_chars
+    name = snapshots.page_name(dt)
+    with tracing.span('snapshot'):
+        content = SNAPSHOTS.get(name)
+    if content is None:
+        return None
+    return parse_apod_page(snapshots.decode(content), dt, thumbs, fields)
+
+
+@tracing.traced()
+def _get_apod_chars(dt, thumbs, fields=None):
+    if MIRROR:
+        return _read_snapshot(dt, thumbs, fields)
+    apod_url = BASE + snapshots.page_name(dt)
     LOG.debug('OPENING URL:' + apod_url)
-    res = requests.get(apod_url)
+    with tracing.span('fetch'):
+        res = upstream.get(apod_url)
     
     if res.status_code == 404:
         return None
@@ -75,51 +111,153 @@ def _get_apod_chars(dt, thumbs):
 
         # return default_obj_props
 
-    soup = BeautifulSoup(res.text, 'html.parser')
+    return parse_fetched_page(res.text, res.content, res.status_code, dt, thumbs, fields)
+
+
+def parse_fetched_page(html, content, status, dt=None, thumbs=False, fields=None):
+    """
+    Parses a page fetched from upstream as parse_apod_page does, given its
+    text, bytes and status, and keeps a snapshot of it if it was found.
+    """
+    digest = _snapshot(snapshots.page_name(dt), content) if status == 200 else None
+    props = parse_apod_page(html, dt, thumbs, fields)
+    if digest is not None and dt is None:
+        # the latest page is also the page of its date
+        try:
+            SNAPSHOTS.link(snapshots.page_name(datetime.datetime.strptime(props['date'], '%Y-%m-%d')), digest)
+        except (IOError, OSError) as ex:
+            LOG.warning('failed to keep a snapshot of the page of ' + props['date'] + ': ' + str(ex))
+    return props
+
+
+def parse_apod_page(html, dt=None, thumbs=False, fields=None):
+    """
+    Accepts the HTML of an APOD page and returns the characteristics of its
+    entry. If dt is None the date is read from the page itself. Given a set
+    of fields, those of LAZY_FIELDS not among them are not extracted.
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span('scan'):
+            page = extractor.Page(html)
+        props, data = _read_page(page, dt, fields)
+        parser = 'extractor'
+    except Exception as ex:
+        # odd legacy layouts are left to the full BeautifulSoup parse
+        LOG.debug('single-pass extraction failed, parsing with BeautifulSoup: ' + repr(ex))
+        # imported here, as few pages need it and it is slow to import
+        from bs4 import BeautifulSoup
+        with tracing.span('soup'):
+            page = _SoupPage(BeautifulSoup(html, 'html.parser'))
+        props, data = _read_page(page, dt, fields)
+        parser = 'soup'
+    metrics.PARSE_SECONDS.labels(parser).observe(time.perf_counter() - start)
+
+    if thumbs and props['media_type'] == "video":
+        if thumbs.lower() == "true":
+            with tracing.span('thumbnail'):
+                try:
+                    props['thumbnail_url'] = _get_thumbs(data)
+                except ThumbnailError as ex:
+                    # the entry is served without it for now
+                    LOG.warning(str(ex))
+
+    return props
+
+
+@contextmanager
+def _extracting(page, field):
+    """
+    Records the extraction of a field from page as a span of the current
+    trace, and its time by parser and field.
+    """
+    parser = 'soup' if isinstance(page, _SoupPage) else 'extractor'
+    with tracing.span(field), metrics.FIELD_PARSE_SECONDS.labels(parser, field).time():
+        yield
+
+
+def _read_page(page, dt, fields=None):
+    """
+    Accepts a parsed APOD page, either an extractor.Page or a _SoupPage, and
+    returns the properties of its entry along with the raw media URL. Only
+    the lazy fields among fields are extracted, if fields are given.
+    """
     LOG.debug('getting the data url')
-    hd_data = None
-    if soup.img:
-        # it is an image, so get both the low- and high-resolution data
-        data = BASE + soup.img['src']
-        hd_data = data
-
-        LOG.debug('getting the link for hd_data')
-        for link in soup.find_all('a', href=True):
-            if link['href'] and link['href'].startswith('image'):
-                hd_data = BASE + link['href']
-                break
-    elif soup.iframe:
-        # its a video
-        media_type = 'video'
-        data = soup.iframe['src']
-    else:
-        # it is neither image nor video, output empty urls
-        media_type = 'other'
-        data = ''
+    with _extracting(page, 'media'):
+        media_type, data, hd_data = page.media(BASE)
 
     props = {}
 
-    props['explanation'] = _explanation(soup)
-    props['title'] = _title(soup)
-    copyright_text = _copyright(soup)
-    if copyright_text:
-        props['copyright'] = copyright_text
+    if fields is None or 'explanation' in fields:
+        with _extracting(page, 'explanation'):
+            props['explanation'] = page.explanation()
+    if fields is None or 'title' in fields:
+        with _extracting(page, 'title'):
+            props['title'] = page.title()
+    if fields is None or 'copyright' in fields:
+        with _extracting(page, 'copyright'):
+            copyright_text = page.copyright()
+        if copyright_text:
+            props['copyright'] = copyright_text
     props['media_type'] = media_type
     if data:
         props['url'] = _get_last_url(data)
     if dt:
         props['date'] = dt.strftime('%Y-%m-%d')
     else:
-        props['date'] = _date(soup)
+        with _extracting(page, 'date'):
+            props['date'] = page.date()
 
     if hd_data:
         props['hdurl'] = _get_last_url(hd_data)
 
-    if thumbs and media_type == "video":
-        if thumbs.lower() == "true":
-            props['thumbnail_url'] = _get_thumbs(data)
+    return props, data
 
-    return props
+
+class _SoupPage(object):
+    """
+    Presents a BeautifulSoup parse of an APOD page through the same methods
+    as extractor.Page.
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    def media(self, base):
+        soup = self.soup
+        hd_data = None
+        if soup.img:
+            # it is an image, so get both the low- and high-resolution data
+            media_type = 'image'
+            data = base + soup.img['src']
+            hd_data = data
+
+            LOG.debug('getting the link for hd_data')
+            for link in soup.find_all('a', href=True):
+                if link['href'] and link['href'].startswith('image'):
+                    hd_data = base + link['href']
+                    break
+        elif soup.iframe:
+            # its a video
+            media_type = 'video'
+            data = soup.iframe['src']
+        else:
+            # it is neither image nor video, output empty urls
+            media_type = 'other'
+            data = ''
+        return media_type, data, hd_data
+
+    def explanation(self):
+        return _explanation(self.soup)
+
+    def title(self):
+        return _title(self.soup)
+
+    def copyright(self):
+        return _copyright(self.soup)
+
+    def date(self):
+        return _date(self.soup)
 
 
 def _title(soup):
@@ -224,35 +362,12 @@ def _explanation(soup):
     """
     # Handler for later APOD entries
     LOG.debug('getting the explanation')
-    s = soup.find_all('p')[2].text
-    s = s.replace('\n', ' ')
-    s = s.replace('  ', ' ')
-    s = s.strip(' ').strip('Explanation: ')
-    s = s.split(' Tomorrow\'s picture')[0]
-    s = s.strip(' ')
+    s = extractor.clean_explanation(soup.find_all('p')[2].text)
     if s == '':
         # Handler for earlier APOD entries
-        texts = [x.strip() for x in soup.text.split('\n')]
-        try:
-            begin_idx = texts.index('Explanation:') + 1
-        except ValueError as e:
-            # Rare case where "Explanation:" is not on its own line
-            explanation_line = [x for x in texts if "Explanation:" in x]
-            if len(explanation_line) == 1:
-                begin_idx = texts.index(explanation_line[0])
-                texts[begin_idx] = texts[begin_idx][12:].strip()
-            else:
-                raise e
-
-        idx = texts[begin_idx:].index('')
-        s = ' '.join(texts[begin_idx:begin_idx + idx])
+        s = extractor.early_explanation(soup.text)
 
-    try:
-        s = s.encode('latin1').decode('cp1252')
-    except Exception as ex:
-        LOG.error(str(ex))
-
-    return s
+    return extractor.fix_cp1252(s)
 
 
 def _date(soup):
@@ -261,40 +376,26 @@ def _date(soup):
     date of the APOD image.
     """
     LOG.debug('getting the date from soup data.')
-    _today = datetime.date.today()
-    for line in soup.text.split('\n'):
-        today_year = str(_today.year)
-        yesterday_year = str((_today-datetime.timedelta(days=1)).year)
-        # Looks for the first line that starts with the current year.
-        # This also checks yesterday's year so it doesn't break on January 1st at 00:00 UTC
-        # before apod.nasa.gov uploads a new image.
-        if line.startswith(today_year) or line.startswith(yesterday_year):
-            LOG.debug('found possible date match: ' + line)
-            # takes apart the date string and turns it into a datetime
-            try:
-                year, month, day = line.split()
-                year = int(year)
-                month = ['january', 'february', 'march', 'april',
-                         'may', 'june', 'july', 'august',
-                         'september', 'october', 'november', 'december'
-                         ].index(month.lower()) + 1
-                day = int(day)
-                return datetime.date(year=year, month=month, day=day).strftime('%Y-%m-%d')
-            except:
-                LOG.debug('unable to retrieve date from line: ' + line)
-    raise Exception('Date not found in soup data.')
-
-
-def parse_apod(dt, use_default_today_date=False, thumbs=False):
+    return extractor.find_date(soup.text)
+
+
+@tracing.traced()
+def parse_apod(dt, use_default_today_date=False, thumbs=False, fields=None):
     """
     Accepts a date in '%Y-%m-%d' format. Returns the URL of the APOD image
     of that day, noting that
     """
+    key = (dt, bool(use_default_today_date), str(thumbs).lower() == 'true', fields)
+    props = IN_FLIGHT.do(key, _parse_apod, dt, use_default_today_date, thumbs, fields)
+    # every caller gets a copy of its own to extend
+    return dict(props) if props else props
+
 
+def _parse_apod(dt, use_default_today_date, thumbs, fields=None):
     LOG.debug('apod chars called date:' + str(dt))
 
     try:
-        return _get_apod_chars(dt, thumbs)
+        return _get_apod_chars(dt, thumbs, fields)
 
     except Exception as ex:
 
@@ -306,7 +407,7 @@ def parse_apod(dt, use_default_today_date=False, thumbs=False):
         if use_default_today_date and dt:
             # try to get the day before
             dt = dt - datetime.timedelta(days=1)
-            return _get_apod_chars(dt, thumbs)
+            return _get_apod_chars(dt, thumbs, fields)
         else:
             # pass exception up the call stack
             LOG.error(str(ex))
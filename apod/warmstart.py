@@ -0,0 +1,140 @@
+"""
+Warm start of the results cache from a snapshot of its hot entries.
+
+A new process starts with an empty cache, so until it has served a while
+its requests go to the archive or upstream. With a snapshot file set, a
+process writes out the entries its cache holds for the most recent days,
+and those it was asked for most, as it exits, and the next process to
+start on the node loads them before it serves anything.
+
+The snapshot is a header line and then a line of JSON per entry, hottest
+last, so that if the cache is smaller than the snapshot it is the coldest
+entries which are evicted. It is memory-mapped and read a line at a time,
+so a large one is never held in memory twice. Only entries which can no
+longer change upstream are written.
+"""
+
+from datetime import date, datetime, timedelta
+import json
+import logging
+import mmap
+import os
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+# bumped whenever the layout of the snapshot changes; others are ignored
+VERSION = 1
+
+
+def select(entries, today, recent_days=30, top=1000):
+    """
+    Returns the (key, entry) of entries, as returned by
+    ResultCache.entries, worth keeping: those of the last recent_days days
+    through today, and the top others by lookups answered. They are
+    ordered coldest first.
+    """
+    since = today - timedelta(days=recent_days)
+    recent, others = [], []
+    for key, data, hits in entries:
+        if key[0] is None:
+            # the latest entry, which can still change
+            continue
+        if key[0] > since:
+            recent.append((key, data))
+        else:
+            others.append((hits, key, data))
+    # ties are left least recently used first
+    others.sort(key=lambda other: other[0])
+    recent.sort(key=lambda entry: entry[0][0])
+    return [(key, data) for _, key, data in (others[-top:] if top > 0 else [])] + recent
+
+
+def _line(key, data):
+    (dt, (concept_tags, thumbs)) = key
+    return json.dumps([dt.isoformat(), concept_tags, thumbs, dict(data)], separators=(',', ':'))
+
+
+class WarmStart(object):
+    """
+    Saves the hot entries of a ResultCache to a snapshot file, and loads
+    them into another. Processes sharing the file each write it whole, so
+    the last to exit wins.
+    """
+
+    def __init__(self, path, recent_days=30, top=1000):
+        self.path = path
+        self.recent_days = recent_days
+        self.top = top
+
+    def save(self, cache, today=None):
+        """
+        Writes the hot entries of cache to the snapshot file, replacing it,
+        and returns how many were written.
+        """
+        kept = select(cache.entries(), today or datetime.utcnow().date(), self.recent_days, self.top)
+        header = json.dumps({'version': VERSION, 'written': datetime.utcnow().isoformat()})
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(header + '\n')
+                    for key, data in kept:
+                        f.write(_line(key, data) + '\n')
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (IOError, OSError) as ex:
+            LOG.warning('failed to write the warm start snapshot to ' + self.path + ': ' + str(ex))
+            return 0
+        LOG.info('wrote %d entries to the warm start snapshot %s' % (len(kept), self.path))
+        return len(kept)
+
+    def load(self, cache):
+        """
+        Puts the entries of the snapshot file into cache, and returns how
+        many there were. A missing, stale or damaged snapshot loads nothing,
+        or as much of it as could be read.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return 0
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                    return self._load(cache, snapshot)
+        except (IOError, OSError) as ex:
+            if not os.path.exists(self.path):
+                return 0
+            LOG.warning('failed to read the warm start snapshot ' + self.path + ': ' + str(ex))
+            return 0
+
+    def _load(self, cache, snapshot):
+        loaded = 0
+        try:
+            header = json.loads(snapshot.readline())
+            if header.get('version') != VERSION:
+                LOG.info('ignoring the warm start snapshot ' + self.path + ' of version ' + str(header.get('version')))
+                return 0
+            for line in iter(snapshot.readline, b''):
+                dt, concept_tags, thumbs, data = json.loads(line)
+                cache.put((date.fromisoformat(dt), (concept_tags, thumbs)), data)
+                loaded += 1
+        except (ValueError, TypeError, AttributeError) as ex:
+            LOG.warning('stopped reading the damaged warm start snapshot %s after %d entries: %s'
+                        % (self.path, loaded, ex))
+        LOG.info('loaded %d entries from the warm start snapshot %s' % (loaded, self.path))
+        return loaded
+
+
+def from_environ(environ=os.environ):
+    """
+    Returns the WarmStart configured by APOD_WARM_START* environment
+    variables, or None if there is no snapshot file.
+    """
+    path = environ.get('APOD_WARM_START')
+    if not path:
+        return None
+    return WarmStart(path,
+                     recent_days=int(environ.get('APOD_WARM_START_DAYS', 30)),
+                     top=int(environ.get('APOD_WARM_START_TOP', 1000)))
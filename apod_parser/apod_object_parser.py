@@ -1,7 +1,6 @@
 import requests
 import json
 import os
-from PIL import Image
 
 def get_data(api_key):
     raw_response = requests.get(f'https://api.nasa.gov/planetary/apod?api_key={api_key}').text
@@ -60,5 +59,7 @@ def convert_image(image_path):
 
     base_directory = os.path.dirname(path_to_image)
 
+    # Pillow is only needed here, and is slow to import
+    from PIL import Image
     image = Image.open(path_to_image)
     image.save(f"{base_directory}/{filename_no_extension}.png")
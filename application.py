@@ -17,18 +17,35 @@ sys.path.insert(0, "../lib")
 ### justin edit
 sys.path.insert(1, ".")
 
-from datetime import datetime, date
-from random import shuffle
-from flask import request, jsonify, render_template, Flask, current_app
+from collections.abc import Mapping
+from functools import partial
+from datetime import datetime, date, timedelta, timezone
+from random import sample, shuffle
+from urllib.parse import urlencode
+from flask import request, jsonify, render_template, Flask, current_app, copy_current_request_context, \
+    stream_with_context, g
+from werkzeug.http import is_resource_modified
 from flask_cors import CORS
-from apod.utility import parse_apod, get_concepts
+from apod.utility import parse_apod, get_concepts, extracted, FIELDS, THUMBNAILS, IN_FLIGHT
+from apod import metrics, ratelimit, tracing, utility, warmstart
+from apod.store import open_store
+from apod.cache import ResultCache
+from apod.fetch import FetchEngine
+from apod.prewarm import Prewarmer
+from apod.encoding import EncodedBody, CODINGS
+import atexit
+import base64
+import hashlib
 import logging
+import os
+import signal
+import time
 
 #### added by justin for EB
 #from wsgiref.simple_server import make_server
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"expose_headers": ["X-RateLimit-Limit","X-RateLimit-Remaining"]} })
+CORS(app, resources={r"/*": {"expose_headers": ["X-RateLimit-Limit","X-RateLimit-Remaining","Retry-After","Link"]} })
 
 LOG = logging.getLogger(__name__)
 # logging.basicConfig(level=logging.INFO)
@@ -38,9 +55,68 @@ logging.basicConfig(level=logging.DEBUG)
 # assorted libraries
 SERVICE_VERSION = 'v1'
 APOD_METHOD_NAME = 'apod'
-ALLOWED_APOD_FIELDS = ['concept_tags', 'date', 'hd', 'count', 'start_date', 'end_date', 'thumbs']
+ALLOWED_APOD_FIELDS = ['concept_tags', 'date', 'hd', 'count', 'start_date', 'end_date', 'thumbs', 'format', 'dates',
+                       'fields', 'cursor']
+# most dates a dates= request may ask for
+MAX_DATES = 100
+SEARCH_METHOD_NAME = 'search'
+ALLOWED_SEARCH_FIELDS = ['q', 'start_date', 'end_date', 'sort', 'page', 'per_page']
+SEARCH_ORDERS = ('relevance', 'date')
+MAX_PER_PAGE = 100
+# output formats for date ranges; the streamed ones are sent as they are built
+OUTPUT_FORMATS = {'json': 'application/json', 'json-stream': 'application/json', 'ndjson': 'application/x-ndjson'}
+# dates looked up and fetched at a time while streaming a range
+STREAM_WINDOW = 100
+# most days in one page of a date range; the rest follow a cursor
+RANGE_PAGE_DAYS = int(os.environ.get('APOD_RANGE_PAGE_DAYS', 366))
 ALCHEMY_API_KEY = None
-RESULTS_DICT = dict([])
+# bounded cache of parsed entries; entries which can still change upstream
+# are only held for TODAY_TTL seconds
+RESULTS_CACHE = ResultCache(int(os.environ.get('APOD_CACHE_ENTRIES', 4096)))
+TODAY_TTL = int(os.environ.get('APOD_TODAY_TTL', 300))
+# persistent archive of parsed entries, shared by all workers on the node
+ARCHIVE = open_store(os.environ.get('APOD_ARCHIVE'))
+# the hot entries of the last process to exit on the node, if configured,
+# so that a new one does not start cold
+WARM_START = warmstart.from_environ()
+
+
+def _exit_on_sigterm():
+    """
+    Has SIGTERM, which process managers stop a server with, exit cleanly so
+    that atexit handlers run, unless the server handles it itself.
+    """
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    except ValueError:
+        # imported off the main thread, which cannot set handlers
+        LOG.warning('cannot handle SIGTERM; the warm start snapshot is only written on a clean exit')
+
+
+if WARM_START is not None:
+    WARM_START.load(RESULTS_CACHE)
+    atexit.register(WARM_START.save, RESULTS_CACHE)
+    _exit_on_sigterm()
+# spare random dates drawn for count= requests, to absorb days without an APOD
+RANDOM_OVERSAMPLE = 10
+# validators of recently served responses, by query, so that conditional
+# requests can be answered without building the response again
+VALIDATORS = ResultCache(int(os.environ.get('APOD_CACHE_ENTRIES', 4096)))
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# pool for concurrent upstream fetches, capped per process and per request
+FETCH_ENGINE = FetchEngine(int(os.environ.get('APOD_FETCH_WORKERS', 16)),
+                           int(os.environ.get('APOD_FETCH_PER_REQUEST', 8)))
+# seconds between background polls for the latest entry; 0 turns them off
+PREWARM_INTERVAL = float(os.environ.get('APOD_PREWARM_INTERVAL', 0))
+# opt-in tracing of requests, by header or by sampling; see apod.tracing
+TRACER = tracing.from_environ()
+TRACE_HEADER = 'X-Apod-Trace'
+# per-client token buckets, or None if requests are not rate limited
+RATE_LIMITER = ratelimit.from_environ()
+# header naming the client, as set by a trusted proxy or API gateway;
+# clients are told apart by address otherwise
+RATE_LIMIT_KEY_HEADER = os.environ.get('APOD_RATE_LIMIT_KEY_HEADER') or None
 try:
     with open('alchemy_api.key', 'r') as f:
         ALCHEMY_API_KEY = f.read()
@@ -86,14 +162,15 @@ def _validate_date(dt):
         raise ValueError('Date must be between %s and %s.' % (begin_str, today_str))
 
 
-def _apod_handler(dt, use_concept_tags=False, use_default_today_date=False, thumbs=False):
+@tracing.traced()
+def _apod_handler(dt, use_concept_tags=False, use_default_today_date=False, thumbs=False, held=None):
     """
     Accepts a parameter dictionary. Returns the response object to be
     served through the API.
     """
     try:
         
-        page_props = parse_apod(dt, use_default_today_date, thumbs)
+        page_props = parse_apod(dt, use_default_today_date, thumbs, held)
         if not page_props:
             return None
         LOG.debug('managed to get apod page characteristics')
@@ -113,7 +190,392 @@ def _apod_handler(dt, use_concept_tags=False, use_default_today_date=False, thum
         return _abort(500, 'Internal Service Error', usage=False)
 
 
-def _get_json_for_date(input_date, use_concept_tags, thumbs):
+def _variant(use_concept_tags, thumbs):
+    """
+    Returns the (concept_tags, thumbs) variant under which the entries for a
+    request are cached and archived.
+    """
+    return bool(use_concept_tags), str(thumbs).lower() == 'true'
+
+
+def _parse_fields(text):
+    """
+    Returns the set of fields named by a fields parameter, a comma separated
+    list, to which responses are trimmed. The date is always kept. Raises a
+    ValueError if any is not a field of an entry.
+    """
+    fields = frozenset(name.strip() for name in text.split(',') if name.strip())
+    unknown = fields - FIELDS
+    if unknown:
+        raise ValueError('fields must be among ' + ', '.join(sorted(FIELDS)) + '.')
+    return fields | {'date'}
+
+
+def _held(fields, use_concept_tags):
+    """
+    Returns the fields which an entry parsed for a request for the given
+    fields holds, or None if it holds them all; see utility.extracted.
+    Concepts are drawn from the explanation.
+    """
+    if fields is not None and use_concept_tags:
+        fields = fields | {'explanation'}
+    return extracted(fields)
+
+
+def _is_settled(dt):
+    """
+    Returns True if the APOD entry for the given date can no longer change
+    upstream. APOD runs on US Eastern time, so a date is only safe once the
+    following day has also begun everywhere.
+    """
+    return dt < datetime.utcnow().date() - timedelta(days=1)
+
+
+def _get_apod(dt, use_concept_tags, use_default_today_date, thumbs, fields=None):
+    """
+    Returns the entry for the given date, served from the results cache or
+    the archive if either holds it and otherwise parsed from the upstream
+    APOD page. A date of None asks for the latest entry. Given the set of
+    fields asked for, an entry holding only those may be returned. Entries
+    come back frozen; see _versioned.
+    """
+    variant = _variant(use_concept_tags, thumbs)
+    data = RESULTS_CACHE.get((dt, variant), _held(fields, use_concept_tags))
+    if data is not None:
+        return data
+
+    if dt and not use_default_today_date:
+        data = ARCHIVE.get(dt, variant)
+        if data is not None:
+            return RESULTS_CACHE.put((dt, variant), data)
+
+    return _fetch_apod(dt, use_concept_tags, use_default_today_date, thumbs, fields)
+
+
+def _fetch_apod(dt, use_concept_tags, use_default_today_date, thumbs, fields=None):
+    """
+    Parses the entry for the given date from the upstream APOD page and
+    records it in the results cache and, once settled, the archive. Given
+    the set of fields asked for, the page is only parsed for those.
+    """
+    variant = _variant(use_concept_tags, thumbs)
+    held = _held(fields, use_concept_tags)
+    data = _apod_handler(dt, use_concept_tags, use_default_today_date, thumbs, held)
+
+    # _apod_handler hands back an error response rather than raising
+    if not isinstance(data, dict):
+        return data
+
+    data = _remember(data, variant, held)
+    if dt is None:
+        # which date is the latest depends on the upstream, so it is also
+        # remembered under a key of its own
+        RESULTS_CACHE.put((None, variant), data, TODAY_TTL, held)
+
+    return data
+
+
+def _remember(data, variant, held=None):
+    """
+    Records a freshly parsed entry in the results cache and, once settled,
+    the archive, and returns the frozen entry. An entry holding only the
+    fields in held is only cached, as such, and one lacking the thumbnail
+    asked for only briefly.
+    """
+    datadate = datetime.strptime(data['date'], '%Y-%m-%d').date()
+    if variant[1] and data.get('media_type') == 'video' and 'thumbnail_url' not in data:
+        # its thumbnail could not be looked up, so it is looked up again soon
+        return RESULTS_CACHE.put((datadate, variant), data, TODAY_TTL, held)
+    if held is not None:
+        return RESULTS_CACHE.put((datadate, variant), data, None if _is_settled(datadate) else TODAY_TTL, held)
+    if _is_settled(datadate):
+        ARCHIVE.put(datadate, variant, data)
+        return RESULTS_CACHE.put((datadate, variant), data)
+    return RESULTS_CACHE.put((datadate, variant), data, TODAY_TTL)
+
+
+def _prewarmed(data):
+    """
+    Caches the latest entry as polled by PREWARMER, under both its date and
+    the latest-entry key, for requests with and without thumbs.
+    """
+    datadate = datetime.strptime(data['date'], '%Y-%m-%d').date()
+    plain = dict(data)
+    plain.pop('thumbnail_url', None)
+    for variant, entry in (((False, False), plain), ((False, True), data)):
+        frozen = RESULTS_CACHE.put((datadate, variant), entry, TODAY_TTL)
+        RESULTS_CACHE.put((None, variant), frozen, TODAY_TTL)
+
+
+PREWARMER = Prewarmer(_prewarmed, PREWARM_INTERVAL)
+if PREWARM_INTERVAL > 0 and not utility.MIRROR:
+    PREWARMER.start()
+
+metrics.REGISTRY.collector(metrics.cache_collector({'results': RESULTS_CACHE, 'validators': VALIDATORS}))
+
+
+@metrics.REGISTRY.collector
+def _collect_metrics():
+    """
+    Reads the counters the coalescer, thumbnail resolver and prewarmer keep
+    for themselves, for /metrics.
+    """
+    flights = IN_FLIGHT.stats()
+    thumbnails = THUMBNAILS.stats()
+    return [
+        ('apod_page_fetches_in_flight', 'gauge', 'Page fetches and parses in flight.', (),
+         [((), flights['in_flight'])]),
+        ('apod_page_fetches_total', 'counter', 'Page fetches and parses started.', (), [((), flights['calls'])]),
+        ('apod_page_fetches_coalesced_total', 'counter', 'Page fetches saved by joining one already in flight.', (),
+         [((), flights['coalesced'])]),
+        ('apod_thumbnail_cache_entries', 'gauge', 'Vimeo thumbnails held.', (), [((), thumbnails['entries'])]),
+        ('apod_thumbnail_lookups_total', 'counter', 'Vimeo thumbnail lookups.', (), [((), thumbnails['lookups'])]),
+        ('apod_thumbnail_lookup_failures_total', 'counter', 'Vimeo thumbnail lookups which failed.', (),
+         [((), thumbnails['failures'])]),
+        ('apod_prewarm_polls_total', 'counter', 'Polls for the latest entry.', (), [((), PREWARMER.polls)]),
+        ('apod_prewarm_not_modified_total', 'counter', 'Polls answered with a 304.', (),
+         [((), PREWARMER.not_modified)]),
+    ]
+
+
+def _lookup_apods(dts, variant, held=None):
+    """
+    Returns a dict of date -> entry for those of the given dates which are
+    held in the results cache or the archive, without going upstream. Given
+    held, entries holding only those fields will do.
+    """
+    today_ordinal = datetime.today().date().toordinal()
+
+    found = {}
+    for dt in dts:
+        data = RESULTS_CACHE.get((dt, variant), held)
+        if data is not None:
+            found[dt] = data
+
+    missing = [dt for dt in dts if dt not in found and dt.toordinal() != today_ordinal]
+    for dt, data in ARCHIVE.get_many(missing, variant).items():
+        found[dt] = RESULTS_CACHE.put((dt, variant), data)
+
+    today = date.fromordinal(today_ordinal)
+    if today in dts and today not in found and PREWARMER.latest_date \
+            and PREWARMER.latest_date < today.isoformat():
+        # the upstream has not rolled over yet, so a fetch of today would
+        # only fall back to the latest entry, which may already be cached
+        data = RESULTS_CACHE.get((None, variant), held)
+        if data is not None:
+            found[today] = data
+
+    return found
+
+
+def _fetch_apods(dts, use_concept_tags, thumbs, parallelism=None, fields=None):
+    """
+    Fetches the entries for the given dates from upstream concurrently,
+    yielding them in the order of dts. With thumbs, the pages are fetched
+    and parsed without, and the thumbnails for all of their videos are then
+    resolved in one batch; see _with_thumbnails.
+    """
+    if _variant(use_concept_tags, thumbs)[1]:
+        return iter(_with_thumbnails(list(_fetch_apods(dts, use_concept_tags, False, parallelism, fields)),
+                                     use_concept_tags, _held(fields, use_concept_tags)))
+
+    LOG.debug('fetching ' + str(len(dts)) + ' dates from upstream')
+    today_ordinal = datetime.today().date().toordinal()
+    # each fetch runs on a pool thread with its own copy of the request
+    tasks = [tracing.bind(copy_current_request_context(partial(_fetch_apod, dt, use_concept_tags,
+                                                               dt.toordinal() == today_ordinal, thumbs, fields)))
+             for dt in dts]
+    return FETCH_ENGINE.imap(lambda task: task(), tasks, parallelism)
+
+
+def _with_thumbnails(entries, use_concept_tags, held=None):
+    """
+    Returns the thumbs=True versions of the given entries, recorded as such,
+    as holding the fields in held if given. The thumbnail of each distinct
+    video among them is resolved once, with the Vimeo lookups running
+    concurrently.
+    """
+    videos = [data['url'] for data in entries
+              if isinstance(data, Mapping) and data['media_type'] == 'video' and 'url' in data]
+    thumbnails = THUMBNAILS.resolve_many(videos, lambda fn, urls: FETCH_ENGINE.map(tracing.bind(fn), urls, len(urls)))
+
+    variant = (bool(use_concept_tags), True)
+    results = []
+    for data in entries:
+        if isinstance(data, Mapping):
+            data = dict(data)
+            if data['media_type'] == 'video':
+                data['thumbnail_url'] = thumbnails.get(data.get('url'), '')
+            data = _remember(data, variant, held)
+        results.append(data)
+    return results
+
+
+def _iter_apod_batch(dts, use_concept_tags, thumbs, window=None, fields=None):
+    """
+    Yields the entries for a list of dates, in the same order, as soon as
+    each is available. Those held in the results cache or the archive are
+    looked up first and only the rest are fetched from upstream,
+    concurrently, for the given fields only. Given a window, the dates are
+    taken that many at a time, so that no more entries than that are held
+    at once.
+    """
+    window = window or len(dts)
+    held = _held(fields, use_concept_tags)
+    for i in range(0, len(dts), window):
+        chunk = dts[i:i + window]
+        found = _lookup_apods(chunk, _variant(use_concept_tags, thumbs), held)
+
+        missing = [dt for dt in chunk if dt not in found]
+        fetched = _fetch_apods(missing, use_concept_tags, thumbs, fields=fields) if missing else iter(())
+        for dt in chunk:
+            yield found.pop(dt) if dt in found else next(fetched)
+
+
+def _get_apod_batch(dts, use_concept_tags, thumbs, fields=None):
+    """
+    Returns the entries for a list of dates, in the same order; see
+    _iter_apod_batch.
+    """
+    return list(_iter_apod_batch(dts, use_concept_tags, thumbs, fields=fields))
+
+
+def _last_date(date_str):
+    """
+    Returns the date a date or end_date parameter names, or None for the
+    latest entry.
+    """
+    return datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else None
+
+
+def _page_last_date(start_date, end_date, page_days):
+    """
+    Returns the last date the first page of a date range covers, given
+    page_days per page; see _next_link.
+    """
+    end_dt = _last_date(end_date) or date.today()
+    return min(end_dt, datetime.strptime(start_date, '%Y-%m-%d').date() + timedelta(days=page_days - 1))
+
+
+def _set_validators(response, validators):
+    response.vary.add('Accept-Encoding')
+    response.set_etag(validators['etag'])
+    if validators['last_modified'] is not None:
+        response.last_modified = validators['last_modified']
+    response.headers['Cache-Control'] = validators['cache_control']
+
+
+def _with_validators(response, key, last_dt):
+    """
+    Adds an ETag computed from the body of a successful response, and a
+    Cache-Control policy depending on whether every entry in it is settled,
+    in which case the response is immutable and also gets the last date it
+    covers as its Last-Modified. The validators are remembered under key for
+    _not_modified. Returns a 304 instead if the request's validators match.
+    """
+    if response.status_code != 200:
+        return response
+
+    settled = last_dt is not None and _is_settled(last_dt)
+    if response.is_streamed:
+        # the body is not known up front
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if settled else 'public, max-age=%d' % TODAY_TTL
+        return response
+
+    validators = {
+        'etag': hashlib.sha1(response.get_data()).hexdigest(),
+        'last_modified': datetime(last_dt.year, last_dt.month, last_dt.day, tzinfo=timezone.utc) if settled else None,
+        'cache_control': IMMUTABLE_CACHE_CONTROL if settled else 'public, max-age=%d' % TODAY_TTL,
+    }
+    VALIDATORS.put(key, validators, None if settled else TODAY_TTL)
+
+    _set_validators(response, validators)
+    return response.make_conditional(request)
+
+
+def _not_modified(key):
+    """
+    Returns a 304 response if a response to the same query was served
+    recently and the request's If-None-Match or If-Modified-Since header
+    matches it, or None.
+    """
+    validators = VALIDATORS.get(key)
+    if validators is None or is_resource_modified(request.environ, etag=validators['etag'],
+                                                  last_modified=validators['last_modified']):
+        return None
+
+    response = current_app.response_class(status=304)
+    _set_validators(response, validators)
+    return response
+
+
+def _versioned(data):
+    """
+    Returns a response copy of a (frozen) entry, stamped with the service
+    version.
+    """
+    return dict(data, service_version=SERVICE_VERSION)
+
+
+@tracing.traced()
+def _encode(data):
+    """
+    Returns the body of the response for a single entry, encoded once as
+    jsonify would. Less its trailing newline it is also the entry's fragment
+    of a list response; see _join.
+    """
+    return EncodedBody(app.json.dumps(_versioned(data), separators=(',', ':')).encode() + b'\n')
+
+
+def _project(data, fields):
+    """
+    Returns the response copy of an entry trimmed to the given fields.
+    """
+    return {name: value for name, value in data.items() if name in fields}
+
+
+def _body(key, data, fields=None):
+    """
+    Returns the encoded body for an entry, which is kept with the entry in
+    the results cache under key for as long as the cache holds it. Bodies
+    trimmed to some fields are encoded each time.
+    """
+    if fields is not None:
+        return _encode(_project(data, fields))
+    return RESULTS_CACHE.get_body(key, _encode) or _encode(data)
+
+
+def _join(bodies):
+    """
+    Returns the body of a list response, joined from the bodies of its
+    entries without encoding them again.
+    """
+    return EncodedBody(b'[' + b','.join(body.identity[:-1] for body in bodies) + b']\n')
+
+
+def _content_coding():
+    """
+    Returns the content coding negotiated from the request's Accept-Encoding
+    header, or None to send the body as is.
+    """
+    return request.accept_encodings.best_match(CODINGS)
+
+
+def _json_response(body):
+    """
+    Returns a JSON response sending an encoded body in the negotiated
+    content coding.
+    """
+    coding = _content_coding()
+    response = app.response_class(body.encoded(coding), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if coding is not None:
+        response.content_encoding = coding
+    return response
+
+
+@tracing.traced()
+def _get_json_for_date(input_date, use_concept_tags, thumbs, fields=None):
     """
     This returns the JSON data for a specific date, which must be a string of the form YYYY-MM-DD. If date is None,
     then it defaults to the current date.
@@ -128,41 +590,29 @@ def _get_json_for_date(input_date, use_concept_tags, thumbs):
         # fall back to using today's date IF they didn't specify a date
         use_default_today_date = True
         dt = input_date  # None
-        key = datetime.utcnow().date()
-        key = str(key.year)+'y'+str(key.month)+'m'+str(key.day)+'d'+str(use_concept_tags)+str(thumbs)
 
     # validate input date
     else:
 
         dt = datetime.strptime(input_date, '%Y-%m-%d').date()
         _validate_date(dt)
-        key = str(dt.year)+'y'+str(dt.month)+'m'+str(dt.day)+'d'+str(use_concept_tags)+str(thumbs)
 
     # get data
-    if key in RESULTS_DICT.keys():
-        data = RESULTS_DICT[key]
-    else:
-        data = _apod_handler(dt, use_concept_tags, use_default_today_date, thumbs)
-        
+    data = _get_apod(dt, use_concept_tags, use_default_today_date, thumbs, fields)
 
     # Handle case where no data is available
     if not data:
         return _abort(code=404, msg=f"No data available for date: {input_date}", usage=False)
-    
-
-    data['service_version'] = SERVICE_VERSION
-
-    #Volatile caching dict
-    datadate =  datetime.strptime(data['date'], '%Y-%m-%d').date()
-    key = str(datadate.year)+'y'+str(datadate.month)+'m'+str(datadate.day)+'d'+str(use_concept_tags)+str(thumbs)
-    RESULTS_DICT[key] = data
 
+    if not isinstance(data, Mapping):
+        return data
 
     # return info as JSON
-    return jsonify(data)
+    return _json_response(_body((dt, _variant(use_concept_tags, thumbs)), data, fields))
 
 
-def _get_json_for_random_dates(count, use_concept_tags, thumbs):
+@tracing.traced()
+def _get_json_for_random_dates(count, use_concept_tags, thumbs, fields=None):
     """
     This returns the JSON data for a set of randomly chosen dates. The number of dates is specified by the count
     parameter
@@ -175,33 +625,52 @@ def _get_json_for_random_dates(count, use_concept_tags, thumbs):
     begin_ordinal = datetime(1995, 6, 16).toordinal()
     today_ordinal = datetime.today().toordinal()
 
-    random_date_ordinals = list(range(begin_ordinal, today_ordinal + 1))
-    shuffle(random_date_ordinals)
+    # sample candidate dates without replacement, over-sampling so that days
+    # without an APOD can be skipped, and use those already held locally
+    # before going upstream for the rest
+    population = range(begin_ordinal, today_ordinal + 1)
+    candidates = [date.fromordinal(ordinal)
+                  for ordinal in sample(population, min(len(population), 2 * count + RANDOM_OVERSAMPLE))]
 
-    all_data = []
-    for date_ordinal in random_date_ordinals:
-        dt = date.fromordinal(date_ordinal)
-        data = _apod_handler(dt, use_concept_tags, date_ordinal == today_ordinal, thumbs)
-        
-        # Handle case where no data is available
-        if not data:
-            continue
+    variant = _variant(use_concept_tags, thumbs)
+    found = _lookup_apods(candidates, variant, _held(fields, use_concept_tags))
+    all_data = [(dt, found[dt]) for dt in candidates
+                if dt in found and found[dt]['date'] == dt.isoformat()][:count]
+    remaining = [dt for dt in candidates if dt not in found]
+
+    while len(all_data) < count and remaining:
+        # fetch what is still needed, plus a few spare, all at once
+        needed = count - len(all_data)
+        batch = remaining[:needed + needed // 10 + 1]
+        remaining = remaining[len(batch):]
+
+        for dt, data in zip(batch, _fetch_apods(batch, use_concept_tags, thumbs, FETCH_ENGINE.per_request, fields)):
 
-        data['service_version'] = SERVICE_VERSION
-        all_data.append(data)
-        if len(all_data) >= count:
-            break
+            # Handle case where no data is available
+            if not data:
+                continue
 
-    return jsonify(all_data)
+            if not isinstance(data, Mapping):
+                return data
 
+            # today's date may have fallen back to yesterday's entry
+            if data['date'] == dt.isoformat() and len(all_data) < count:
+                all_data.append((dt, data))
 
-def _get_json_for_date_range(start_date, end_date, use_concept_tags, thumbs):
+    shuffle(all_data)
+    return _json_response(_join([_body((dt, variant), data, fields) for dt, data in all_data]))
+
+
+@tracing.traced()
+def _get_json_for_date_range(start_date, end_date, use_concept_tags, thumbs, output_format='json', fields=None):
     """
     This returns the JSON data for a range of dates, specified by start_date and end_date, which must be strings of the
-    form YYYY-MM-DD. If end_date is None then it defaults to the current date.
+    form YYYY-MM-DD. If end_date is None then it defaults to the current date. Unless the output format is 'json' the
+    response is streamed; see _stream_date_range.
     :param start_date:
     :param end_date:
     :param use_concept_tags:
+    :param output_format:
     :return:
     """
     # validate input date
@@ -219,34 +688,328 @@ def _get_json_for_date_range(start_date, end_date, use_concept_tags, thumbs):
 
     start_ordinal = start_dt.toordinal()
     end_ordinal = end_dt.toordinal()
-    today_ordinal = datetime.today().date().toordinal()
 
     if start_ordinal > end_ordinal:
         raise ValueError('start_date cannot be after end_date')
 
+    dts = [date.fromordinal(ordinal) for ordinal in range(start_ordinal, end_ordinal + 1)]
+    if output_format != 'json':
+        return _stream_date_range(dts, use_concept_tags, thumbs, output_format, fields)
+
+    next_dt = None
+    if len(dts) > RANGE_PAGE_DAYS:
+        # the rest of the range is left to the following pages
+        next_dt = dts[RANGE_PAGE_DAYS]
+        dts = dts[:RANGE_PAGE_DAYS]
+
+    variant = _variant(use_concept_tags, thumbs)
     all_data = []
 
-    while start_ordinal <= end_ordinal:
-        # get data
-        dt = date.fromordinal(start_ordinal)
-        
-        data = _apod_handler(dt, use_concept_tags, start_ordinal == today_ordinal, thumbs)
+    for dt, data in zip(dts, _get_apod_batch(dts, use_concept_tags, thumbs, fields)):
 
         # Handle case where no data is available
         if not data:
-            start_ordinal += 1
             continue
 
-        data['service_version'] = SERVICE_VERSION
+        if not isinstance(data, Mapping):
+            return data
 
         if data['date'] == dt.isoformat():
             # Handles edge case where server is a day ahead of NASA APOD service
-            all_data.append(data)
-
-        start_ordinal += 1
+            all_data.append(_body((dt, variant), data, fields))
 
     # return info as JSON
-    return jsonify(all_data)
+    response = _json_response(_join(all_data))
+    if next_dt is not None:
+        response.headers['Link'] = _next_link(request.base_url, request.args.items(multi=True), next_dt, end_dt)
+    return response
+
+
+def _make_cursor(start_dt, end_dt):
+    """
+    Returns the opaque cursor standing for the rest of a date range, from
+    start_dt to end_dt.
+    """
+    text = start_dt.isoformat() + ':' + end_dt.isoformat()
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def _parse_cursor(cursor):
+    """
+    Returns the start_date and end_date of the range a cursor stands for;
+    see _make_cursor. Raises a ValueError if it is not a cursor.
+    """
+    try:
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        start_date, end_date = text.split(':')
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('cursor is not valid.')
+    return start_date, end_date
+
+
+def _next_link(base_url, params, next_dt, end_dt):
+    """
+    Returns the Link header pointing at the next page of a date range, with
+    the same query params but for the range, which a cursor replaces.
+    """
+    query = [(name, value) for name, value in params if name not in ('start_date', 'end_date', 'cursor')]
+    query.append(('cursor', _make_cursor(next_dt, end_dt)))
+    return '<%s?%s>; rel="next"' % (base_url, urlencode(query))
+
+
+def _parse_dates(dates):
+    """
+    Returns the dates named by a dates parameter, a comma separated list of
+    YYYY-MM-DD dates, in the order given. Raises a ValueError if any is not
+    valid or there are too many.
+    """
+    dts = [datetime.strptime(part.strip(), '%Y-%m-%d').date() for part in dates.split(',') if part.strip()]
+    if not dts or len(dts) > MAX_DATES:
+        raise ValueError('dates must list between 1 and %d dates.' % MAX_DATES)
+    for dt in dts:
+        _validate_date(dt)
+    return dts
+
+
+def _missing_body(dt):
+    """
+    Returns the encoded fragment standing for a date without an entry in a
+    dates= response, shaped like the 404 of a single date.
+    """
+    return EncodedBody(app.json.dumps({
+        'code': 404,
+        'date': dt.isoformat(),
+        'msg': 'No data available for date: ' + dt.isoformat(),
+        'service_version': SERVICE_VERSION,
+    }, separators=(',', ':')).encode() + b'\n')
+
+
+@tracing.traced()
+def _get_json_for_dates(dts, use_concept_tags, thumbs, fields=None):
+    """
+    This returns the JSON data for a list of arbitrary dates, in the order they are given; see _parse_dates. Those
+    held in the results cache or the archive are used first and the rest fetched from upstream concurrently, once each.
+    A date without an entry is reported in its place; see _missing_body.
+    :param dts:
+    :param use_concept_tags:
+    :param thumbs:
+    :return:
+    """
+    unique = list(dict.fromkeys(dts))
+
+    variant = _variant(use_concept_tags, thumbs)
+    bodies = {}
+    for dt, data in zip(unique, _get_apod_batch(unique, use_concept_tags, thumbs, fields)):
+
+        if data and not isinstance(data, Mapping):
+            return data
+
+        if data and data['date'] == dt.isoformat():
+            bodies[dt] = _body((dt, variant), data, fields)
+        else:
+            # Handles edge case where server is a day ahead of NASA APOD service
+            bodies[dt] = _missing_body(dt)
+
+    return _json_response(_join([bodies[dt] for dt in dts]))
+
+
+def _stream_date_range(dts, use_concept_tags, thumbs, output_format, fields=None):
+    """
+    Returns a response which streams the entries for a range of dates in date
+    order, each sent as soon as it is available, either as one JSON array
+    ('json-stream') or as one JSON object per line ('ndjson').
+    """
+    ndjson = output_format == 'ndjson'
+    variant = _variant(use_concept_tags, thumbs)
+
+    def generate():
+        first = True
+        if not ndjson:
+            yield b'['
+        for dt, data in zip(dts, _iter_apod_batch(dts, use_concept_tags, thumbs, STREAM_WINDOW, fields)):
+
+            # Handle case where no data is available
+            if not data:
+                continue
+
+            if not isinstance(data, Mapping):
+                # too late to change the status; a JSON array is left
+                # unterminated, and an NDJSON stream ends with the error
+                LOG.error('failed streaming the entry for ' + dt.isoformat())
+                if ndjson:
+                    yield data.get_data()
+                return
+
+            if data['date'] == dt.isoformat():
+                # Handles edge case where server is a day ahead of NASA APOD service
+                body = _body((dt, variant), data, fields).identity
+                if ndjson:
+                    yield body
+                else:
+                    yield body[:-1] if first else b',' + body[:-1]
+                first = False
+        if not ndjson:
+            yield b']\n'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=OUTPUT_FORMATS[output_format])
+
+
+def _mode(args, endpoint='apod'):
+    if endpoint == 'search':
+        return 'search'
+    if 'dates' in args:
+        return 'dates'
+    if args.get('count'):
+        return 'count'
+    if args.get('start_date') or args.get('cursor'):
+        return 'range'
+    return 'single'
+
+
+def _cost(args, endpoint='apod'):
+    """
+    Returns the rate limit tokens a request costs: one per entry it may
+    return, so that a date range costs its days and count= its count.
+    Requests which do not validate cost one, and are turned away later.
+    """
+    if endpoint != 'apod':
+        return 1
+    try:
+        if args.get('count'):
+            return max(1, min(int(args['count']), 100))
+        if 'dates' in args:
+            return max(1, min(len([part for part in args['dates'].split(',') if part.strip()]), MAX_DATES))
+        start_date, end_date = args.get('start_date'), args.get('end_date')
+        if args.get('cursor'):
+            start_date, end_date = _parse_cursor(args['cursor'])
+        if start_date:
+            start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_dt = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else datetime.today().date()
+            days = (end_dt - start_dt).days + 1
+            if args.get('format', 'json') == 'json':
+                # the rest is paid for by the requests for the following pages
+                days = min(days, RANGE_PAGE_DAYS)
+            return max(1, days)
+    except ValueError:
+        pass
+    return 1
+
+
+def _client_key(headers, remote_addr):
+    """
+    Returns the key of the client making a request, whose bucket it is
+    charged to.
+    """
+    if RATE_LIMIT_KEY_HEADER and headers.get(RATE_LIMIT_KEY_HEADER):
+        return 'key:' + headers[RATE_LIMIT_KEY_HEADER]
+    return 'addr:' + str(remote_addr)
+
+
+def _rate_limit_headers(remaining, retry_after):
+    headers = {'X-RateLimit-Limit': str(RATE_LIMITER.limit), 'X-RateLimit-Remaining': str(remaining)}
+    if retry_after:
+        headers['Retry-After'] = str(retry_after)
+    return headers
+
+
+@app.before_request
+def _start_request():
+    if request.endpoint in ('apod', 'search'):
+        g.started = time.perf_counter()
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        if TRACER.enabled:
+            wanted, profile = TRACER.wanted(request.headers.get(TRACE_HEADER))
+            if wanted:
+                g.trace = tracing.start('apod', profile)
+
+
+@app.before_request
+def _limit_rate():
+    # charged before any work is done; a 429 is counted in the metrics as
+    # set up by _start_request
+    if RATE_LIMITER is None or request.endpoint not in ('apod', 'search'):
+        return None
+    allowed, remaining, retry_after = RATE_LIMITER.take(_client_key(request.headers, request.remote_addr),
+                                                        _cost(request.args, request.endpoint))
+    g.rate_limit = _rate_limit_headers(remaining, retry_after)
+    if not allowed:
+        return _abort(429, 'Too Many Requests: rate limit exceeded, retry in %d seconds.' % retry_after, False)
+    return None
+
+
+@app.after_request
+def _record_status(response):
+    g.status = response.status_code
+    if 'started' in g and response.is_streamed:
+        # the request is torn down once now, and again when the stream ends
+        g.streamed = True
+    trace = g.get('trace')
+    if trace is not None:
+        # a streamed response is still to be built, so only its start is in here
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers[TRACE_HEADER + '-Id'] = trace.id
+    response.headers.update(g.get('rate_limit', {}))
+    return response
+
+
+@app.teardown_request
+def _finish_request(exc=None):
+    if g.pop('streamed', False):
+        # finished once the stream has been sent, so that is timed too
+        return
+    started = g.pop('started', None)
+    if started is not None:
+        mode = _mode(request.args, request.endpoint)
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        metrics.REQUEST_SECONDS.labels(mode).observe(time.perf_counter() - started)
+        status = g.pop('status', 500)
+        metrics.RESPONSES.labels(mode, str(status)).inc()
+        trace = g.pop('trace', None)
+        if trace is not None:
+            TRACER.record(tracing.stop(trace), path=request.path, query=request.query_string.decode('latin1'),
+                          status=status)
+
+
+@tracing.traced()
+def _search(args):
+    """
+    Returns a page of the archived entries matching the search in args,
+    the query parameters of a search request. Raises a ValueError if they
+    are not valid.
+    """
+    for key in args:
+        if key not in ALLOWED_SEARCH_FIELDS:
+            raise ValueError('Bad Request: incorrect field passed. Allowed request fields for ' + SEARCH_METHOD_NAME
+                             + ' method are ' + ', '.join(ALLOWED_SEARCH_FIELDS) + '.')
+
+    query = args.get('q', '')
+    order = args.get('sort', 'relevance')
+    if order not in SEARCH_ORDERS:
+        raise ValueError('sort must be one of ' + ', '.join(SEARCH_ORDERS) + '.')
+    page = int(args.get('page', 1))
+    per_page = int(args.get('per_page', 20))
+    if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+        raise ValueError('page must be at least 1, and per_page between 1 and %d.' % MAX_PER_PAGE)
+
+    start_dt = end_dt = None
+    if args.get('start_date'):
+        start_dt = datetime.strptime(args['start_date'], '%Y-%m-%d').date()
+        _validate_date(start_dt)
+    if args.get('end_date'):
+        end_dt = datetime.strptime(args['end_date'], '%Y-%m-%d').date()
+        _validate_date(end_dt)
+
+    total, results = ARCHIVE.search(query, start_dt, end_dt, order, per_page, (page - 1) * per_page)
+    return {
+        'service_version': SERVICE_VERSION,
+        'query': query,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'results': [_versioned(data) for data in results],
+    }
 
 
 #
@@ -265,6 +1028,11 @@ def serve_static(asset_path):
     return current_app.send_static_file(asset_path)
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return current_app.response_class(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/' + SERVICE_VERSION + '/' + APOD_METHOD_NAME + '/', methods=['GET'])
 def apod():
     LOG.info('apod path called')
@@ -281,17 +1049,55 @@ def apod():
         count = args.get('count')
         start_date = args.get('start_date')
         end_date = args.get('end_date')
+        dates = args.get('dates')
         use_concept_tags = args.get('concept_tags', False)
         thumbs = args.get('thumbs', False)
-
-        if not count and not start_date and not end_date:
-            return _get_json_for_date(input_date, use_concept_tags, thumbs)
+        output_format = args.get('format', 'json')
+        fields = _parse_fields(args['fields']) if args.get('fields') else None
+
+        if args.get('cursor'):
+            # the rest of a range; see _next_link
+            if input_date or count or start_date or end_date or dates is not None:
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            start_date, end_date = _parse_cursor(args['cursor'])
+
+        if output_format not in OUTPUT_FORMATS:
+            return _abort(400, 'Bad Request: format must be one of ' + ', '.join(OUTPUT_FORMATS) + '.', False)
+        if output_format != 'json' and not start_date:
+            return _abort(400, 'Bad Request: format=' + output_format + ' is only supported for date ranges.', False)
+
+        key = (tuple(sorted(args.items(multi=True))), _content_coding())
+        if not count:
+            response = _not_modified(key)
+            if response is not None:
+                return response
+
+        # present but empty is an empty list, not a request for today
+        if dates is not None:
+            if input_date or count or start_date or end_date:
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            dts = _parse_dates(dates)
+            response = _get_json_for_dates(dts, use_concept_tags, thumbs, fields)
+            return _with_validators(response, key, max(dts))
+
+        elif not count and not start_date and not end_date:
+            response = _get_json_for_date(input_date, use_concept_tags, thumbs, fields)
+            return _with_validators(response, key, _last_date(input_date))
 
         elif not input_date and not start_date and not end_date and count:
-            return _get_json_for_random_dates(int(count), use_concept_tags, thumbs)
+            response = _get_json_for_random_dates(int(count), use_concept_tags, thumbs, fields)
+            if response.status_code == 200:
+                # a new random selection each time
+                response.headers['Cache-Control'] = 'no-store'
+            return response
 
         elif not count and not input_date and start_date:
-            return _get_json_for_date_range(start_date, end_date, use_concept_tags, thumbs)
+            response = _get_json_for_date_range(start_date, end_date, use_concept_tags, thumbs, output_format,
+                                                fields)
+            if output_format != 'json':
+                # streamed whole
+                return _with_validators(response, key, _last_date(end_date))
+            return _with_validators(response, key, _page_last_date(start_date, end_date, RANGE_PAGE_DAYS))
 
         else:
             return _abort(400, 'Bad Request: invalid field combination passed.')
@@ -309,6 +1115,17 @@ def apod():
             return _abort(500, 'Internal Service Error', usage=False)
 
 
+@app.route('/' + SERVICE_VERSION + '/' + SEARCH_METHOD_NAME + '/', methods=['GET'])
+def search():
+    LOG.info('search path called')
+    if not ARCHIVE.searchable:
+        return _abort(503, 'Search is not available: no archive is configured.', False)
+    try:
+        return jsonify(_search(request.args))
+    except ValueError as ve:
+        return _abort(400, str(ve), False)
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """
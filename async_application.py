@@ -0,0 +1,573 @@
+"""
+An asyncio variant of the APOD micro-service.
+
+Serves the same /v1/apod/ contract as application.py, validated by the same
+code and sharing its results cache, archive and encoded bodies, but fetches
+from apod.nasa.gov and Vimeo with an async HTTP client and parses pages on a
+thread pool. An upstream fetch then holds a coroutine rather than a worker
+thread, so thousands of slow fetches can be in flight in one process, and
+date range and count requests gather theirs.
+
+Needs the optional aiohttp dependency (pip install apod-api[async]):
+
+    python async_application.py
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from random import sample, shuffle
+
+from aiohttp import web, ClientConnectionError, ClientSession, ClientTimeout, TCPConnector
+from werkzeug.http import parse_accept_header
+from werkzeug.sansio.http import is_resource_modified
+
+import application
+from application import (SERVICE_VERSION, APOD_METHOD_NAME, OUTPUT_FORMATS, RESULTS_CACHE, TODAY_TTL, ARCHIVE,
+                         RANDOM_OVERSAMPLE, STREAM_WINDOW, RANGE_PAGE_DAYS, IMMUTABLE_CACHE_CONTROL,
+                         _usage, _validate, _validate_date, _variant, _is_settled, _remember, _lookup_apods,
+                         _body, _join, _last_date, _page_last_date, _mode, _parse_dates, _missing_body, _parse_fields,
+                         _held, _parse_cursor, _next_link, _cost, _client_key, _rate_limit_headers, RATE_LIMITER,
+                         TRACER, TRACE_HEADER, SEARCH_METHOD_NAME, _search)
+from apod import metrics, snapshots, tracing, upstream, utility
+from apod.encoding import CODINGS
+from apod.thumbs import VIMEO_ID, VIMEO_API, ThumbnailError
+from apod.utility import BASE, THUMBNAILS, parse_fetched_page, get_concepts
+
+LOG = logging.getLogger(__name__)
+
+# upstream connections held open at once, across all requests
+CONNECTIONS = int(os.environ.get('APOD_ASYNC_CONNECTIONS', 100))
+# threads parsing fetched pages
+PARSE_POOL = ThreadPoolExecutor(int(os.environ.get('APOD_PARSE_WORKERS', 4)), thread_name_prefix='apod-parse')
+# upstream responses retried, as by apod.upstream
+RETRY_STATUSES = (502, 503, 504)
+
+CLIENT = web.AppKey('client', ClientSession)
+# the rate limit headers of a request; see _limit_rate
+RATE_LIMIT = web.RequestKey('rate_limit', dict)
+
+# fetches in flight, by key, so that concurrent requests for the same page
+# share one; only ever touched from the event loop
+_flights = {}
+
+
+def _jsonify(data, status=200):
+    """
+    Returns data as JSON, encoded as Flask's jsonify encodes it in
+    application.py: compact, with sorted keys and a trailing newline.
+    """
+    body = application.app.json.dumps(data, separators=(',', ':')) + '\n'
+    return web.Response(body=body.encode('utf-8'), status=status, content_type='application/json')
+
+
+def _abort(code, msg, usage=True):
+    if usage:
+        msg += " " + _usage() + "'"
+
+    return _jsonify({'service_version': SERVICE_VERSION, 'msg': msg, 'code': code}, code)
+
+
+async def _coalesce(key, make_coro):
+    """
+    Awaits make_coro(), or the call already in flight for key.
+    """
+    task = _flights.get(key)
+    if task is None:
+        task = _flights[key] = asyncio.ensure_future(make_coro())
+        task.add_done_callback(lambda done: _flights.pop(key, None))
+    # shielded, so that one caller going away does not cancel it for all
+    return await asyncio.shield(task)
+
+
+async def _get(session, url, service='apod'):
+    """
+    GETs the given URL, retrying connection failures, timeouts and gateway
+    errors and counting it in the metrics as apod.upstream does. Returns the
+    status, body and charset.
+    """
+    LOG.debug('GET ' + url)
+    start = time.perf_counter()
+    try:
+        status, content, charset = await _get_with_retries(session, url)
+    except Exception:
+        metrics.UPSTREAM_RESPONSES.labels(service, 'error').inc()
+        raise
+    finally:
+        metrics.UPSTREAM_SECONDS.labels(service).observe(time.perf_counter() - start)
+    metrics.UPSTREAM_RESPONSES.labels(service, str(status)).inc()
+    return status, content, charset
+
+
+async def _get_with_retries(session, url):
+    for attempt in range(upstream.RETRIES + 1):
+        last = attempt == upstream.RETRIES
+        try:
+            async with session.get(url) as res:
+                if res.status not in RETRY_STATUSES or last:
+                    return res.status, await res.read(), res.charset
+        except (ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+        await asyncio.sleep(0.3 * (2 ** attempt))
+
+
+async def _thumbnail(session, url):
+    """
+    Returns the thumbnail URL for a video URL, looking Vimeo videos up
+    through the shared resolver's cache and the async client.
+    """
+    match = VIMEO_ID.search(url) if 'vimeo' in url else None
+    if match is None:
+        # no I/O needed
+        return THUMBNAILS.resolve(url)
+
+    video_id = match.group(1)
+    thumbnail = THUMBNAILS.cached_vimeo(video_id)
+    if thumbnail is not None:
+        return thumbnail
+
+    async def lookup():
+        with metrics.THUMBNAIL_SECONDS.time():
+            try:
+                status, content, _ = await _get(session, VIMEO_API % video_id, 'vimeo')
+                return THUMBNAILS.record_vimeo(video_id, status, content)
+            except Exception as ex:
+                return THUMBNAILS.record_vimeo(video_id, error=ex)
+
+    thumbnail = await _coalesce(('vimeo', video_id), lookup)
+    if thumbnail is None:
+        raise ThumbnailError('Vimeo lookup for video ' + video_id + ' failed')
+    return thumbnail
+
+
+async def _get_apod_chars(session, dt, thumbs, held=None):
+    loop = asyncio.get_running_loop()
+    if utility.MIRROR:
+        # read and parsed off the event loop
+        props = await loop.run_in_executor(PARSE_POOL, tracing.bind(utility._read_snapshot), dt, False, held)
+    else:
+        status, content, charset = await _get(session, BASE + snapshots.page_name(dt))
+
+        if status == 404:
+            return None
+
+        # apod.nasa.gov declares no charset, which requests takes as latin-1
+        html = content.decode(charset or 'latin1')
+        props = await loop.run_in_executor(PARSE_POOL, tracing.bind(parse_fetched_page), html, content, status, dt,
+                                           False, held)
+    if not props:
+        return None
+
+    if thumbs and props['media_type'] == 'video':
+        try:
+            props['thumbnail_url'] = await _thumbnail(session, props.get('url', ''))
+        except ThumbnailError as ex:
+            LOG.warning(str(ex))
+
+    return props
+
+
+async def _parse_apod(session, dt, use_default_today_date, thumbs, held=None):
+    """
+    The async counterpart of utility.parse_apod.
+    """
+    try:
+        return await _get_apod_chars(session, dt, thumbs, held)
+    except Exception as ex:
+        if use_default_today_date and dt:
+            # the upstream may not have rolled over to the server's today yet
+            return await _get_apod_chars(session, dt - timedelta(days=1), thumbs, held)
+        LOG.error(str(ex))
+        raise
+
+
+async def _fetch_apod(session, dt, use_concept_tags, use_default_today_date, thumbs, fields=None):
+    """
+    The async counterpart of application._fetch_apod. Failures raise.
+    """
+    variant = _variant(use_concept_tags, thumbs)
+    held = _held(fields, use_concept_tags)
+    key = (dt, bool(use_default_today_date), variant[1], held)
+    props = await _coalesce(key, lambda: _parse_apod(session, dt, use_default_today_date, variant[1], held))
+    if not props:
+        return None
+    props = dict(props)
+
+    if use_concept_tags:
+        if application.ALCHEMY_API_KEY is None:
+            props['concepts'] = 'concept_tags functionality turned off in current service'
+        else:
+            props['concepts'] = await asyncio.get_running_loop().run_in_executor(
+                None, get_concepts, None, props['explanation'], application.ALCHEMY_API_KEY)
+
+    data = _remember(props, variant, held)
+    if dt is None:
+        RESULTS_CACHE.put((None, variant), data, TODAY_TTL, held)
+    return data
+
+
+async def _get_apod(session, dt, use_concept_tags, use_default_today_date, thumbs, fields=None):
+    """
+    The async counterpart of application._get_apod.
+    """
+    variant = _variant(use_concept_tags, thumbs)
+    data = RESULTS_CACHE.get((dt, variant), _held(fields, use_concept_tags))
+    if data is not None:
+        return data
+
+    if dt and not use_default_today_date:
+        data = ARCHIVE.get(dt, variant)
+        if data is not None:
+            return RESULTS_CACHE.put((dt, variant), data)
+
+    return await _fetch_apod(session, dt, use_concept_tags, use_default_today_date, thumbs, fields)
+
+
+def _fetch_apods(session, dts, use_concept_tags, thumbs, fields=None):
+    """
+    Starts fetching the entries for the given dates, returning a task for
+    each in the order of dts.
+    """
+    today = date.today()
+    return [asyncio.ensure_future(_fetch_apod(session, dt, use_concept_tags, dt == today, thumbs, fields))
+            for dt in dts]
+
+
+async def _get_apod_batch(session, dts, use_concept_tags, thumbs, fields=None):
+    """
+    The async counterpart of application._get_apod_batch.
+    """
+    found = _lookup_apods(dts, _variant(use_concept_tags, thumbs), _held(fields, use_concept_tags))
+    missing = [dt for dt in dts if dt not in found]
+    found.update(zip(missing, await asyncio.gather(*_fetch_apods(session, missing, use_concept_tags, thumbs,
+                                                                 fields))))
+    return [found[dt] for dt in dts]
+
+
+def _json_response(request, body):
+    coding = parse_accept_header(request.headers.get('Accept-Encoding')).best_match(CODINGS)
+    response = web.Response(body=body.encoded(coding), content_type='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    return response
+
+
+def _with_validators(request, response, last_dt):
+    """
+    The counterpart of application._with_validators, without the memory of
+    recent validators.
+    """
+    if response.status != 200:
+        return response
+
+    settled = last_dt is not None and _is_settled(last_dt)
+    etag = hashlib.sha1(response.body).hexdigest()
+    headers = {'ETag': '"%s"' % etag, 'Vary': 'Accept-Encoding',
+               'Cache-Control': IMMUTABLE_CACHE_CONTROL if settled else 'public, max-age=%d' % TODAY_TTL}
+    last_modified = None
+    if settled:
+        last_modified = datetime(last_dt.year, last_dt.month, last_dt.day, tzinfo=timezone.utc)
+        headers['Last-Modified'] = last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+    if not is_resource_modified(http_if_none_match=request.headers.get('If-None-Match'),
+                                http_if_modified_since=request.headers.get('If-Modified-Since'),
+                                etag=etag, last_modified=last_modified):
+        return web.Response(status=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+
+async def _get_json_for_date(request, input_date, use_concept_tags, thumbs, fields=None):
+    use_default_today_date = False
+    if not input_date:
+        use_default_today_date = True
+        dt = None
+    else:
+        dt = datetime.strptime(input_date, '%Y-%m-%d').date()
+        _validate_date(dt)
+
+    data = await _get_apod(request.app[CLIENT], dt, use_concept_tags, use_default_today_date, thumbs, fields)
+
+    if not data:
+        return _abort(code=404, msg=f"No data available for date: {input_date}", usage=False)
+
+    return _json_response(request, _body((dt, _variant(use_concept_tags, thumbs)), data, fields))
+
+
+async def _get_json_for_random_dates(request, count, use_concept_tags, thumbs, fields=None):
+    if count > 100 or count <= 0:
+        raise ValueError('Count must be positive and cannot exceed 100')
+    begin_ordinal = datetime(1995, 6, 16).toordinal()
+    today_ordinal = datetime.today().toordinal()
+
+    population = range(begin_ordinal, today_ordinal + 1)
+    candidates = [date.fromordinal(ordinal)
+                  for ordinal in sample(population, min(len(population), 2 * count + RANDOM_OVERSAMPLE))]
+
+    variant = _variant(use_concept_tags, thumbs)
+    found = _lookup_apods(candidates, variant, _held(fields, use_concept_tags))
+    all_data = [(dt, found[dt]) for dt in candidates
+                if dt in found and found[dt]['date'] == dt.isoformat()][:count]
+    remaining = [dt for dt in candidates if dt not in found]
+
+    while len(all_data) < count and remaining:
+        needed = count - len(all_data)
+        batch = remaining[:needed + needed // 10 + 1]
+        remaining = remaining[len(batch):]
+
+        fetched = await asyncio.gather(*_fetch_apods(request.app[CLIENT], batch, use_concept_tags, thumbs, fields))
+        for dt, data in zip(batch, fetched):
+            if data and data['date'] == dt.isoformat() and len(all_data) < count:
+                all_data.append((dt, data))
+
+    shuffle(all_data)
+    return _json_response(request, _join([_body((dt, variant), data, fields) for dt, data in all_data]))
+
+
+async def _get_json_for_date_range(request, start_date, end_date, use_concept_tags, thumbs, output_format,
+                                   fields=None):
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
+    _validate_date(start_dt)
+
+    if not end_date:
+        end_date = datetime.strftime(datetime.today(), '%Y-%m-%d')
+
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
+    _validate_date(end_dt)
+
+    if start_dt > end_dt:
+        raise ValueError('start_date cannot be after end_date')
+
+    dts = [start_dt + timedelta(days=i) for i in range((end_dt - start_dt).days + 1)]
+    if output_format != 'json':
+        return await _stream_date_range(request, dts, use_concept_tags, thumbs, output_format, fields)
+
+    next_dt = None
+    if len(dts) > RANGE_PAGE_DAYS:
+        next_dt = dts[RANGE_PAGE_DAYS]
+        dts = dts[:RANGE_PAGE_DAYS]
+
+    variant = _variant(use_concept_tags, thumbs)
+    entries = await _get_apod_batch(request.app[CLIENT], dts, use_concept_tags, thumbs, fields)
+    bodies = [_body((dt, variant), data, fields) for dt, data in zip(dts, entries)
+              if data and data['date'] == dt.isoformat()]
+    response = _json_response(request, _join(bodies))
+    if next_dt is not None:
+        response.headers['Link'] = _next_link(str(request.url.with_query(None)), request.query.items(), next_dt,
+                                              end_dt)
+    return response
+
+
+async def _get_json_for_dates(request, dts, use_concept_tags, thumbs, fields=None):
+    variant = _variant(use_concept_tags, thumbs)
+    unique = list(dict.fromkeys(dts))
+    entries = await _get_apod_batch(request.app[CLIENT], unique, use_concept_tags, thumbs, fields)
+    bodies = {dt: _body((dt, variant), data, fields) if data and data['date'] == dt.isoformat() else _missing_body(dt)
+              for dt, data in zip(unique, entries)}
+    return _json_response(request, _join([bodies[dt] for dt in dts]))
+
+
+async def _stream_date_range(request, dts, use_concept_tags, thumbs, output_format, fields=None):
+    """
+    The counterpart of application._stream_date_range.
+    """
+    ndjson = output_format == 'ndjson'
+    variant = _variant(use_concept_tags, thumbs)
+    settled = _is_settled(dts[-1])
+    response = web.StreamResponse(headers={
+        'Content-Type': OUTPUT_FORMATS[output_format],
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if settled else 'public, max-age=%d' % TODAY_TTL})
+    await response.prepare(request)
+
+    first = True
+    if not ndjson:
+        await response.write(b'[')
+    for i in range(0, len(dts), STREAM_WINDOW):
+        chunk = dts[i:i + STREAM_WINDOW]
+        found = _lookup_apods(chunk, variant, _held(fields, use_concept_tags))
+        missing = [dt for dt in chunk if dt not in found]
+        found.update(zip(missing, _fetch_apods(request.app[CLIENT], missing, use_concept_tags, thumbs, fields)))
+
+        for dt in chunk:
+            data = found.pop(dt)
+            try:
+                if asyncio.isfuture(data):
+                    data = await data
+            except Exception as ex:
+                # too late to change the status; see application._stream_date_range
+                LOG.error('failed streaming the entry for ' + dt.isoformat() + ': ' + str(ex))
+                if ndjson:
+                    await response.write(_abort(500, 'Internal Service Error', usage=False).body + b'\n')
+                for pending in found.values():
+                    if asyncio.isfuture(pending):
+                        pending.cancel()
+                return response
+
+            if data and data['date'] == dt.isoformat():
+                body = _body((dt, variant), data, fields).identity
+                if ndjson:
+                    await response.write(body)
+                else:
+                    await response.write(body[:-1] if first else b',' + body[:-1])
+                first = False
+    if not ndjson:
+        await response.write(b']\n')
+    await response.write_eof()
+    return response
+
+
+async def apod(request):
+    LOG.info('apod path called')
+    try:
+        args = request.query
+
+        if not _validate(args):
+            return _abort(400, 'Bad Request: incorrect field passed.')
+
+        input_date = args.get('date')
+        count = args.get('count')
+        start_date = args.get('start_date')
+        end_date = args.get('end_date')
+        dates = args.get('dates')
+        use_concept_tags = args.get('concept_tags', False)
+        thumbs = args.get('thumbs', False)
+        output_format = args.get('format', 'json')
+        fields = _parse_fields(args['fields']) if args.get('fields') else None
+
+        if args.get('cursor'):
+            if input_date or count or start_date or end_date or dates is not None:
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            start_date, end_date = _parse_cursor(args['cursor'])
+
+        if output_format not in OUTPUT_FORMATS:
+            return _abort(400, 'Bad Request: format must be one of ' + ', '.join(OUTPUT_FORMATS) + '.', False)
+        if output_format != 'json' and not start_date:
+            return _abort(400, 'Bad Request: format=' + output_format + ' is only supported for date ranges.', False)
+
+        # present but empty is an empty list, not a request for today
+        if dates is not None:
+            if input_date or count or start_date or end_date:
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            dts = _parse_dates(dates)
+            response = await _get_json_for_dates(request, dts, use_concept_tags, thumbs, fields)
+            return _with_validators(request, response, max(dts))
+
+        elif not count and not start_date and not end_date:
+            response = await _get_json_for_date(request, input_date, use_concept_tags, thumbs, fields)
+            return _with_validators(request, response, _last_date(input_date))
+
+        elif not input_date and not start_date and not end_date and count:
+            response = await _get_json_for_random_dates(request, int(count), use_concept_tags, thumbs, fields)
+            if response.status == 200:
+                response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        elif not count and not input_date and start_date:
+            response = await _get_json_for_date_range(request, start_date, end_date, use_concept_tags, thumbs,
+                                                      output_format, fields)
+            if not isinstance(response, web.Response):
+                # streamed, and already sent
+                return response
+            return _with_validators(request, response, _page_last_date(start_date, end_date, RANGE_PAGE_DAYS))
+
+        else:
+            return _abort(400, 'Bad Request: invalid field combination passed.')
+
+    except ValueError as ve:
+        return _abort(400, str(ve), False)
+
+    except Exception as ex:
+        LOG.error('Service Exception. Msg: ' + str(type(ex)) + ' ' + str(ex))
+        return _abort(500, 'Internal Service Error', usage=False)
+
+
+async def search(request):
+    LOG.info('search path called')
+    if not ARCHIVE.searchable:
+        return _abort(503, 'Search is not available: no archive is configured.', False)
+    try:
+        # a query of the archive, off the event loop
+        results = await asyncio.get_running_loop().run_in_executor(PARSE_POOL, tracing.bind(_search), request.query)
+    except ValueError as ve:
+        return _abort(400, str(ve), False)
+    return _jsonify(results)
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@web.middleware
+async def _instrument(request, handler):
+    if request.match_info.handler not in (apod, search):
+        return await handler(request)
+    mode = _mode(request.query, 'search' if request.match_info.handler is search else 'apod')
+    status = 500
+    start = time.perf_counter()
+    trace = None
+    if TRACER.enabled and TRACER.wanted(request.headers.get(TRACE_HEADER))[0]:
+        # never profiled, as a profile of the event loop would take in every request
+        trace = tracing.start('apod')
+    try:
+        with metrics.REQUESTS_IN_FLIGHT.track():
+            response = await handler(request)
+            status = response.status
+            if trace is not None and not response.prepared:
+                response.headers['Server-Timing'] = trace.server_timing()
+                response.headers[TRACE_HEADER + '-Id'] = trace.id
+            return response
+    finally:
+        metrics.REQUEST_SECONDS.labels(mode).observe(time.perf_counter() - start)
+        metrics.RESPONSES.labels(mode, str(status)).inc()
+        if trace is not None:
+            TRACER.record(tracing.stop(trace), path=request.path, query=request.query_string, status=status)
+
+
+@web.middleware
+async def _limit_rate(request, handler):
+    """
+    The counterpart of application._limit_rate. The headers are added as
+    the response is sent; see _add_rate_limit_headers.
+    """
+    if RATE_LIMITER is None or request.match_info.handler not in (apod, search):
+        return await handler(request)
+    endpoint = 'search' if request.match_info.handler is search else 'apod'
+    allowed, remaining, retry_after = RATE_LIMITER.take(_client_key(request.headers, request.remote),
+                                                        _cost(request.query, endpoint))
+    request[RATE_LIMIT] = _rate_limit_headers(remaining, retry_after)
+    if not allowed:
+        return _abort(429, 'Too Many Requests: rate limit exceeded, retry in %d seconds.' % retry_after, False)
+    return await handler(request)
+
+
+async def _add_rate_limit_headers(request, response):
+    # streamed responses included
+    response.headers.update(request.get(RATE_LIMIT, {}))
+
+
+async def _client(app):
+    timeout = ClientTimeout(sock_connect=upstream.CONNECT_TIMEOUT, sock_read=upstream.READ_TIMEOUT)
+    async with ClientSession(timeout=timeout, connector=TCPConnector(limit=CONNECTIONS),
+                             headers={'Accept-Encoding': 'gzip, deflate'}) as session:
+        app[CLIENT] = session
+        yield
+
+
+def create_app():
+    app = web.Application(middlewares=[_instrument, _limit_rate])
+    app.cleanup_ctx.append(_client)
+    app.on_response_prepare.append(_add_rate_limit_headers)
+    app.router.add_get('/' + SERVICE_VERSION + '/' + APOD_METHOD_NAME + '/', apod)
+    app.router.add_get('/' + SERVICE_VERSION + '/' + SEARCH_METHOD_NAME + '/', search)
+    app.router.add_get('/metrics', metrics_endpoint)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
@@ -0,0 +1,5 @@
+"""
+Offline benchmarks of the service, run from the repository root, e.g.
+
+    python -m benchmarks.parsing
+"""
@@ -0,0 +1,302 @@
+"""
+End-to-end load test of the service against a local stand-in for
+apod.nasa.gov; see benchmarks.stub.
+
+Starts the stub upstream and the service, as the Procfile does under
+waitress or under the Flask or aiohttp servers, then drives a mix of
+requests for today's entry, single dates, count= and date ranges from a
+number of concurrent clients. Reports throughput, latency percentiles by
+kind of request, and how many calls reached the upstream:
+
+    python -m benchmarks.load --duration 30 --concurrency 16 --latency 0.2
+    python -m benchmarks.load --target http://127.0.0.1:8000 --output run.json
+
+With --target, neither the service nor the stub upstream is started;
+start it with the environment printed by python -m benchmarks.stub to keep
+it off apod.nasa.gov, and pass that stub's URL as --upstream to count the
+calls which reached it.
+"""
+
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from urllib.parse import urljoin
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from benchmarks import stub as _stub
+from benchmarks.parsing import _meta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATH = '/v1/apod/'
+# first APOD image date
+FIRST_DATE = date(1995, 6, 16)
+KINDS = ('today', 'date', 'count', 'range')
+SERVERS = {
+    'waitress': lambda port, threads: ['waitress-serve', '--port=%d' % port, '--threads=%d' % threads,
+                                       'application:app'],
+    'flask': lambda port, threads: [sys.executable, '-c', 'from application import app; '
+                                    'app.run("127.0.0.1", port=%d, threaded=True)' % port],
+    'async': lambda port, threads: [sys.executable, 'async_application.py'],
+}
+
+
+class Traffic(object):
+    """
+    Draws requests from the mix, a dict of kind -> weight. Single dates
+    are drawn from the last hot_days days with probability hot, and from
+    the whole archive otherwise; a thumbs share of requests asks for
+    thumbnails.
+    """
+
+    def __init__(self, mix, hot=0.8, hot_days=30, count=10, range_days=7, thumbs=0.0, seed=0):
+        self.kinds = [kind for kind in KINDS if mix.get(kind)]
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.hot = hot
+        self.hot_days = hot_days
+        self.count = count
+        self.range_days = range_days
+        self.thumbs = thumbs
+        self.seed = seed
+        # the latest date whose entry can no longer change upstream; see _is_settled
+        self.latest = date.today() - timedelta(days=2)
+
+    def source(self, worker):
+        return random.Random('%s:%s' % (self.seed, worker))
+
+    def _date(self, rnd, span=0):
+        if rnd.random() < self.hot:
+            back = rnd.randrange(self.hot_days)
+        else:
+            back = rnd.randrange((self.latest - FIRST_DATE).days - span)
+        return self.latest - timedelta(days=back)
+
+    def next(self, rnd):
+        """
+        Returns the kind and query parameters of the next request.
+        """
+        kind = rnd.choices(self.kinds, self.weights)[0]
+        params = {}
+        if kind == 'date':
+            params['date'] = self._date(rnd).isoformat()
+        elif kind == 'count':
+            params['count'] = self.count
+        elif kind == 'range':
+            end = self._date(rnd, self.range_days)
+            params['start_date'] = (end - timedelta(days=self.range_days - 1)).isoformat()
+            params['end_date'] = end.isoformat()
+        if self.thumbs and rnd.random() < self.thumbs:
+            params['thumbs'] = 'true'
+        return kind, params
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+
+    def at(share):
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+    return {
+        'requests': len(latencies),
+        'mean': sum(latencies) / len(latencies),
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99),
+        'max': latencies[-1],
+    }
+
+
+def drive(target, traffic, concurrency=8, duration=30.0, requests_per_client=None, timeout=60.0):
+    """
+    Sends requests from concurrency clients until duration seconds have
+    passed, or each client has sent requests_per_client, and returns the
+    latencies in seconds by kind, the statuses seen and the elapsed time.
+    """
+    latencies = defaultdict(list)
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(worker):
+        rnd = traffic.source(worker)
+        session = requests.Session()
+        sent = 0
+        while time.monotonic() < deadline and (requests_per_client is None or sent < requests_per_client):
+            kind, params = traffic.next(rnd)
+            start = time.perf_counter()
+            try:
+                res = session.get(target + PATH, params=params, timeout=timeout)
+                res.content
+                status = res.status_code
+            except requests.RequestException as ex:
+                status = type(ex).__name__
+            elapsed = time.perf_counter() - start
+            sent += 1
+            with lock:
+                latencies[kind].append(elapsed)
+                statuses[status] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def upstream_stats(url):
+    """
+    Returns the counts of the requests answered so far by the stub upstream
+    at url, which may be its APOD_BASE_URL.
+    """
+    return requests.get(urljoin(url, _stub.STATS), timeout=5).json()
+
+
+def _since(before, after):
+    return {kind: n - before.get(kind, 0) for kind, n in after.items() if n != before.get(kind, 0)}
+
+
+def report(latencies, statuses, elapsed, upstream):
+    """
+    Returns the results of a run as a dict. upstream is the counts of the
+    calls which reached the stub upstream, or None if they are not known.
+    """
+    total = sum(len(values) for values in latencies.values())
+    every = [latency for values in latencies.values() for latency in values]
+    return {
+        'requests': total,
+        'elapsed': elapsed,
+        'throughput': total / elapsed if elapsed else None,
+        'statuses': {str(status): n for status, n in statuses.items()},
+        'latency': _percentiles(every),
+        'by_kind': {kind: _percentiles(latencies[kind]) for kind in KINDS if latencies.get(kind)},
+        'upstream': upstream,
+        'upstream_per_request': (sum(upstream.get(kind, 0) for kind in ('page', 'vimeo')) / total
+                                 if total and upstream is not None else None),
+    }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_service(server, env, threads=8, wait=30.0):
+    """
+    Starts the service under server, one of SERVERS, with the given
+    environment, and returns the process and its URL once it answers.
+    """
+    port = _free_port()
+    env = dict(os.environ, PORT=str(port), **env)
+    process = subprocess.Popen(SERVERS[server](port, threads), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    target = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('%s exited with %d' % (server, process.returncode))
+        try:
+            requests.get(target + '/', timeout=1)
+            return process, target
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s did not start within %d seconds' % (server, wait))
+
+
+def _mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError('unknown kind of request: ' + kind)
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load',
+        description='Load test the service against a local stand-in for apod.nasa.gov.')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='waitress',
+                        help='server to start the service under (default: waitress)')
+    parser.add_argument('--threads', type=int, default=8, help='waitress worker threads (default: 8)')
+    parser.add_argument('--target', help='URL of an already running service; nothing is started')
+    parser.add_argument('--upstream', help='URL of the stub upstream the --target service fetches from, '
+                                           'whose counts of calls are reported')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients (default: 8)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run for (default: 30)')
+    parser.add_argument('--requests', type=int, help='requests per client, instead of a duration')
+    parser.add_argument('--mix', type=_mix, default=_mix('today=20,date=60,count=5,range=15'),
+                        help='weights of each kind of request (default: today=20,date=60,count=5,range=15)')
+    parser.add_argument('--hot', type=float, default=0.8,
+                        help='share of dates drawn from the last --hot-days days (default: 0.8)')
+    parser.add_argument('--hot-days', type=int, default=30, help='days in the hot set (default: 30)')
+    parser.add_argument('--count', type=int, default=10, help='count of count= requests (default: 10)')
+    parser.add_argument('--range-days', type=int, default=7, help='days in date range requests (default: 7)')
+    parser.add_argument('--thumbs', type=float, default=0.0,
+                        help='share of requests asking for thumbnails (default: 0)')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    _stub.add_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    traffic = Traffic(args.mix, args.hot, args.hot_days, args.count, args.range_days, args.thumbs, args.seed)
+
+    # a service given as --target fetches from an upstream of its own
+    upstream = _stub.stub_from(args).start() if args.target is None else None
+    process = None
+    try:
+        target = args.target
+        if upstream is not None:
+            process, target = start_service(args.server, upstream.env, args.threads)
+        before = upstream_stats(args.upstream) if upstream is None and args.upstream else None
+        duration = float('inf') if args.requests else args.duration
+        latencies, statuses, elapsed = drive(target, traffic, args.concurrency, duration, args.requests)
+        if upstream is not None:
+            calls = upstream.stats()
+        elif before is not None:
+            calls = _since(before, upstream_stats(args.upstream))
+        else:
+            calls = None
+        results = report(latencies, statuses, elapsed, calls)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if upstream is not None:
+            upstream.stop()
+
+    results['meta'] = _meta(args={key: value for key, value in vars(args).items() if key != 'output'})
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    print('%d requests in %.1fs, %.1f requests/s' % (results['requests'], elapsed, results['throughput']))
+    print('statuses: ' + ', '.join('%s: %d' % item for item in sorted(results['statuses'].items())))
+    for kind, stats in [('all', results['latency'])] + sorted(results['by_kind'].items()):
+        print('%-6s p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  (%d)' % (
+            kind, stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3, stats['requests']))
+    if results['upstream'] is None:
+        print('upstream: not counted; pass --upstream with --target')
+    else:
+        print('upstream: ' + ', '.join('%s: %d' % item for item in sorted(results['upstream'].items())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Micro-benchmark of the APOD page parser over the corpus of saved pages in
+tests/apod/pages, which samples every era of the apod.nasa.gov layout.
+
+For each page it times the single-pass extractor and the BeautifulSoup
+fallback field by field (title, copyright, explanation, date, media), the
+scan or soup construction they share, and parse_apod_page end to end. It
+also counts the memory allocated by one end-to-end parse. Nothing is
+fetched, thumbnails are not resolved and logging is switched off, so the
+timings are of the parsing alone.
+
+The results are written as JSON, so that runs can be compared across
+commits:
+
+    python -m benchmarks.parsing --output before.json
+    python -m benchmarks.parsing --output after.json --compare before.json
+"""
+
+from datetime import date
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from apod import extractor, utility
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'apod', 'pages')
+FIELDS = ('title', 'copyright', 'explanation', 'date', 'media')
+
+
+def date_line(dt):
+    """
+    Returns the date line of the page of a date as APOD writes it, with the
+    day unpadded, e.g. 2017 February 8.
+    """
+    return '%d %s %d' % (dt.year, dt.strftime('%B'), dt.day)
+
+
+def load_corpus(corpus=CORPUS):
+    """
+    Returns a list of (name, date, html) for the saved pages in corpus,
+    decoded as requests decodes apod.nasa.gov, which declares no charset.
+    The date line of each page is moved to today, as find_date only looks
+    for the current year.
+    """
+    today = date_line(date.today())
+    pages = []
+    for path in sorted(glob.glob(os.path.join(corpus, 'ap*.html'))):
+        name = os.path.basename(path)
+        year = int(name[2:4]) + (1900 if name[2] == '9' else 2000)
+        dt = date(year, int(name[4:6]), int(name[6:8]))
+        with open(path, 'rb') as f:
+            html = f.read().decode('latin1')
+        pages.append((name, dt, html.replace(date_line(dt), today)))
+    return pages
+
+
+def _time(fn, repeat, number):
+    """
+    Returns the min and median seconds per call of fn over repeat rounds of
+    number calls each.
+    """
+    rounds = [t / number for t in timeit.repeat(fn, repeat=repeat, number=number)]
+    return {'min': min(rounds), 'median': statistics.median(rounds)}
+
+
+def _fields(page, dated):
+    """
+    Returns the call extracting each field from page, or None for the date
+    of a page without a date line. Each is called once, so that a page the
+    parser fails on fails the run.
+    """
+    calls = {
+        'title': page.title,
+        'copyright': page.copyright,
+        'explanation': page.explanation,
+        # early layouts carry no date line; their entries are dated by the URL
+        'date': page.date if dated else None,
+        'media': lambda: page.media(utility.BASE),
+    }
+    for call in calls.values():
+        if call is not None:
+            call()
+    return calls
+
+
+def _allocations(fn):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        fn()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return {
+        'blocks': sum(max(stat.count_diff, 0) for stat in stats),
+        'peak_bytes': peak,
+    }
+
+
+def bench_page(name, dt, html, repeat=5, number=20):
+    """
+    Returns the timings, in seconds per call, and allocations for one page.
+    """
+    fast = extractor.Page(html)
+    soup = utility._SoupPage(BeautifulSoup(html, 'html.parser'))
+    dated = date_line(date.today()) in html
+    result = {
+        'bytes': len(html),
+        'scan': _time(lambda: extractor.Page(html), repeat, number),
+        'soup': _time(lambda: BeautifulSoup(html, 'html.parser'), repeat, number),
+        'extractor': {},
+        'bs4': {},
+    }
+    for kind, page in (('extractor', fast), ('bs4', soup)):
+        for field, call in _fields(page, dated).items():
+            result[kind][field] = _time(call, repeat, number) if call else None
+
+    end_to_end = lambda: utility.parse_apod_page(html, dt)
+    result['parse_apod_page'] = _time(end_to_end, repeat, number)
+    result['allocations'] = _allocations(end_to_end)
+    return result
+
+
+def run(pages, repeat=5, number=20):
+    """
+    Benchmarks every page and returns the results along with the totals
+    over the corpus.
+    """
+    results = {name: bench_page(name, dt, html, repeat, number) for name, dt, html in pages}
+    per_pass = sum(page['parse_apod_page']['median'] for page in results.values())
+    return {
+        'meta': _meta(repeat=repeat, number=number),
+        'pages': results,
+        'total': {
+            'pages': len(results),
+            'parse_apod_page': per_pass,
+            'pages_per_second': len(results) / per_pass if per_pass else None,
+        },
+    }
+
+
+def _meta(**extra):
+    """
+    Returns what a run was measured on, along with extra.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict({
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+    }, **extra)
+
+
+def _rows(results):
+    """
+    Yields (page, measurement, median seconds) for every timing in results.
+    """
+    for name, page in sorted(results['pages'].items()):
+        for key in ('scan', 'soup', 'parse_apod_page'):
+            yield name, key, page[key]['median']
+        for kind in ('extractor', 'bs4'):
+            for field in FIELDS:
+                if page[kind].get(field):
+                    yield name, kind + '.' + field, page[kind][field]['median']
+
+
+def report(results, baseline=None, out=sys.stdout):
+    """
+    Writes a table of median microseconds per call, along with the ratio
+    to baseline, a previous run, if given.
+    """
+    before = {(name, key): t for name, key, t in _rows(baseline)} if baseline else {}
+    for name, key, t in _rows(results):
+        line = '%-14s %-24s %10.1f us' % (name, key, t * 1e6)
+        if (name, key) in before:
+            line += '  %5.2fx' % (t / before[(name, key)])
+        out.write(line + '\n')
+    total = results['total']
+    out.write('%d pages, %.1f pages/s end to end\n' % (total['pages'], total['pages_per_second']))
+    if baseline:
+        out.write('baseline (%s): %.1f pages/s\n' % (baseline['meta']['commit'],
+                                                     baseline['total']['pages_per_second']))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.parsing',
+        description='Benchmark the APOD page parser over a corpus of saved pages.')
+    parser.add_argument('--corpus', default=CORPUS, help='directory of saved ap*.html pages (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per measurement (default: 5)')
+    parser.add_argument('--number', type=int, default=20, help='calls per round (default: 20)')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--compare', help='results of a previous run to compare against')
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    pages = load_corpus(args.corpus)
+    if not pages:
+        _parser().error('no pages in ' + args.corpus)
+    results = run(pages, args.repeat, args.number)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Benchmark of how quickly a new service process becomes useful.
+
+Each measurement runs in a fresh interpreter, as a new instance behind an
+autoscaler would. It times the import of application and
+async_application, and lists the slow-to-import modules (bs4, requests,
+urllib3, PIL) which were loaded by it although they are only needed on
+first use. It then times a new process answering requests for the last
+--days settled dates, from a local stand-in for apod.nasa.gov (see
+benchmarks.stub) and without an archive, starting cold and starting from a
+warm start snapshot written by an earlier process (see apod.warmstart):
+
+    python -m benchmarks.startup --latency 0.2 --output before.json
+    python -m benchmarks.startup --latency 0.2 --output after.json --compare before.json
+"""
+
+from datetime import date, timedelta
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import stub as _stub
+from benchmarks.parsing import _meta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules which should only be imported once they are needed
+LAZY = ('bs4', 'requests', 'urllib3', 'PIL')
+MODULES = ('application', 'async_application')
+
+# run in each new interpreter: imports a module, then asks application for
+# the paths given, and prints what it measured as JSON
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+result = {'import': time.perf_counter() - start,
+          'lazy_loaded': sorted(name for name in %r if name in sys.modules)}
+if len(sys.argv) > 2:
+    client = module.app.test_client()
+    start = time.perf_counter()
+    for i, path in enumerate(sys.argv[2:]):
+        status = client.get(path).status_code
+        if status != 200:
+            raise SystemExit('%%s answered %%d' %% (path, status))
+        if i == 0:
+            result['first_request'] = time.perf_counter() - start
+    result['requests'] = time.perf_counter() - start
+print(json.dumps(result))
+''' % (LAZY,)
+
+
+def _child(module, paths=(), env=None):
+    """
+    Runs CHILD in a new interpreter and returns what it measured, with the
+    wall time of the whole process as 'process'.
+    """
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', CHILD, module] + list(paths), cwd=ROOT,
+                         env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if out.returncode != 0:
+        raise RuntimeError('%s failed: %s' % (module, out.stderr.strip().splitlines()[-1:]))
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['process'] = elapsed
+    return result
+
+
+def _summary(runs, key):
+    values = [run[key] for run in runs]
+    return {'min': min(values), 'median': statistics.median(values)}
+
+
+def bench_imports(env, repeat=5):
+    """
+    Returns the import and process times of each of MODULES, and the lazy
+    modules each loaded.
+    """
+    results = {}
+    for module in MODULES:
+        runs = [_child(module, env=env) for _ in range(repeat)]
+        results[module] = {
+            'import': _summary(runs, 'import'),
+            'process': _summary(runs, 'process'),
+            'lazy_loaded': runs[-1]['lazy_loaded'],
+        }
+    return results
+
+
+def bench_warm_start(env, days=30, repeat=5):
+    """
+    Returns the times of new processes answering requests for the last
+    days settled dates, cold and from a warm start snapshot.
+    """
+    last = date.today() - timedelta(days=2)
+    paths = ['/v1/apod/?date=' + (last - timedelta(days=i)).isoformat() for i in range(days)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        warm_env = dict(env, APOD_WARM_START=os.path.join(tmpdir, 'warm.jsonl'))
+        # the first process to exit writes the snapshot the others start from
+        _child('application', paths, warm_env)
+        results = {}
+        for name, run_env in (('cold', env), ('warm', warm_env)):
+            runs = [_child('application', paths, run_env) for _ in range(repeat)]
+            results[name] = dict((key, _summary(runs, key)) for key in ('import', 'first_request', 'requests'))
+        results['snapshot_bytes'] = os.path.getsize(warm_env['APOD_WARM_START'])
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _rows(results):
+    """
+    Yields (measurement, median seconds) for every timing in results.
+    """
+    for module in MODULES:
+        for key in ('import', 'process'):
+            yield module + '.' + key, results['imports'][module][key]['median']
+    for start in ('cold', 'warm'):
+        for key in ('import', 'first_request', 'requests'):
+            yield start + '.' + key, results['warm_start'][start][key]['median']
+
+
+def report(results, baseline=None, out=sys.stdout):
+    """
+    Writes a table of median milliseconds, along with the ratio to
+    baseline, a previous run, if given.
+    """
+    before = dict(_rows(baseline)) if baseline else {}
+    for key, t in _rows(results):
+        line = '%-28s %10.1f ms' % (key, t * 1e3)
+        if key in before:
+            line += '  %5.2fx' % (t / before[key])
+        out.write(line + '\n')
+    for module in MODULES:
+        loaded = results['imports'][module]['lazy_loaded']
+        if loaded:
+            out.write('%s imports %s eagerly\n' % (module, ', '.join(loaded)))
+    out.write('warm start snapshot: %d bytes\n' % results['warm_start']['snapshot_bytes'])
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.startup',
+        description='Benchmark the import and warm-up of new service processes.')
+    parser.add_argument('--repeat', type=int, default=5, help='processes per measurement (default: 5)')
+    parser.add_argument('--days', type=int, default=30, help='recent dates each process is asked for (default: 30)')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--compare', help='results of a previous run to compare against')
+    _stub.add_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    upstream = _stub.stub_from(args).start()
+    try:
+        # nothing carried over from the environment but the stand-in
+        env = dict((key, value) for key, value in os.environ.items() if not key.startswith('APOD_'))
+        env.update(upstream.env)
+        results = {
+            'imports': bench_imports(env, args.repeat),
+            'warm_start': bench_warm_start(env, args.days, args.repeat),
+        }
+    finally:
+        upstream.stop()
+
+    results['meta'] = _meta(args={key: value for key, value in vars(args).items()
+                                  if key not in ('output', 'compare')})
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
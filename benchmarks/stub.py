@@ -0,0 +1,207 @@
+"""
+A local stand-in for apod.nasa.gov and the Vimeo API, for load tests.
+
+Every apYYMMDD.html is answered with one of the saved pages in
+tests/apod/pages, picked by date, and astropix.html with a saved page
+dated today. Vimeo lookups get a made-up thumbnail. Latency, an error rate
+and gaps of missing dates can be injected, and every request is counted.
+Point the service at it with
+
+    APOD_BASE_URL=http://127.0.0.1:8081/apod/
+    APOD_VIMEO_API=http://127.0.0.1:8081/api/v2/video/%s.json
+
+or run it on its own:
+
+    python -m benchmarks.stub --port 8081 --latency 0.2 --missing 0.01
+
+The counts of the requests it has answered are served at /stats, as JSON.
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+from benchmarks.parsing import CORPUS, load_corpus
+
+PAGE = re.compile(r'^/apod/ap(\d{6})\.html$')
+VIMEO = re.compile(r'^/api/v2/video/(\d+)\.json$')
+STATS = '/stats'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        kind, status, body, content_type = stub.answer(self.path)
+        if kind != 'stats':
+            stub.count(kind, status)
+            if stub.latency:
+                time.sleep(stub.delay())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubUpstream(object):
+    """
+    Serves the stand-in on a background thread. latency is the mean delay
+    of each answer in seconds, spread by up to jitter of it either way;
+    error_rate the share of requests answered with a 503; missing the share
+    of dates for which there is no page, answered with a 404. Which dates
+    are missing is fixed by seed, so that runs are repeatable.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.5, error_rate=0.0, missing=0.0,
+                 seed=0, corpus=CORPUS):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.missing = missing
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+        pages = load_corpus(corpus)
+        self._pages = [html.encode('latin1') for _, _, html in pages]
+        # a page of the current layout, whose date line load_corpus moved to today
+        self._latest = {name: html for name, _, html in pages}.get('ap170322.html', pages[-1][2]).encode('latin1')
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    @property
+    def env(self):
+        """
+        The environment variables that point the service at the stand-in.
+        """
+        return {
+            'APOD_BASE_URL': self.base_url + 'apod/',
+            'APOD_VIMEO_API': self.base_url + 'api/v2/video/%s.json',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='apod-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def delay(self):
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency * (1 + spread))
+
+    def count(self, kind, status):
+        with self._lock:
+            self.counts[kind] += 1
+            if status != 200:
+                self.counts['%s_%d' % (kind, status)] += 1
+
+    def stats(self):
+        """
+        Returns the number of requests of each kind, and of each kind
+        answered with an error, e.g. page_404.
+        """
+        with self._lock:
+            return dict(self.counts)
+
+    def _failed(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _exists(self, key):
+        return zlib.crc32(('%s:%s' % (self.seed, key)).encode('ascii')) % 10000 >= self.missing * 10000
+
+    def answer(self, path):
+        """
+        Returns the kind of request, and the status, body and content type
+        to answer it with.
+        """
+        path = path.split('?', 1)[0]
+        if path == STATS:
+            return 'stats', 200, json.dumps(self.stats(), sort_keys=True).encode('ascii'), 'application/json'
+        page = PAGE.match(path)
+        video = VIMEO.match(path)
+        if page is None and video is None and path != '/apod/astropix.html':
+            return 'unknown', 404, b'', 'text/plain'
+        kind = 'vimeo' if video else 'page'
+        if self._failed():
+            return kind, 503, b'Service Unavailable', 'text/plain'
+        if video:
+            thumbnail = 'https://i.vimeocdn.com/video/%s_640.jpg' % video.group(1)
+            return kind, 200, json.dumps([{'thumbnail_large': thumbnail}]).encode('ascii'), 'application/json'
+        if page is None:
+            return kind, 200, self._latest, 'text/html'
+        if not self._exists(page.group(1)):
+            return kind, 404, b'', 'text/html'
+        return kind, 200, self._pages[zlib.crc32(page.group(1).encode('ascii')) % len(self._pages)], 'text/html'
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.stub',
+        description='Serve a local stand-in for apod.nasa.gov and the Vimeo API.')
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8081, help='port to listen on (default: 8081)')
+    return parser
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('stub upstream')
+    group.add_argument('--latency', type=float, default=0.0, help='mean delay of each answer in seconds (default: 0)')
+    group.add_argument('--jitter', type=float, default=0.5,
+                       help='spread of the delay, as a share of it either way (default: 0.5)')
+    group.add_argument('--error-rate', type=float, default=0.0,
+                       help='share of requests answered with a 503 (default: 0)')
+    group.add_argument('--missing', type=float, default=0.0,
+                       help='share of dates with no page, answered with a 404 (default: 0)')
+    group.add_argument('--seed', type=int, default=0, help='seed for the injected failures (default: 0)')
+
+
+def stub_from(args, port=0):
+    return StubUpstream(port=port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        missing=args.missing, seed=args.seed)
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    stub = stub_from(args, args.port)
+    for name, value in sorted(stub.env.items()):
+        print('%s=%s' % (name, value))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(stub.stats(), sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
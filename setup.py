@@ -66,5 +66,6 @@ setup(
     cmdclass=cmd_classes,
 
     install_requires=reqs,
+    extras_require={'brotli': ['brotli'], 'async': ['aiohttp']},
 
 )
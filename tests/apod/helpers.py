@@ -0,0 +1,63 @@
+#!/bin/sh/python
+# coding= utf-8
+"""
+Fixtures shared by the tests: a clock which only moves when told to, and
+local HTTP stubs standing in for apod.nasa.gov.
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+class FakeClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """A request handler which does not log each request."""
+
+    def log_message(self, *args):
+        pass
+
+
+class PagesHandler(QuietHandler):
+    """Serves the trimmed pages as apod.nasa.gov would, and 404s the rest."""
+
+    hits = []
+
+    def do_GET(self):
+        PagesHandler.hits.append(self.path)
+        path = os.path.join(PAGES_DIR, self.path.lstrip('/'))
+        if not os.path.exists(path):
+            self.send_response(404)
+            self.end_headers()
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(handler):
+    """
+    Serves handler on a free local port from a background thread, and
+    returns the server and its base URL, ending in a slash.
+    """
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_port
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
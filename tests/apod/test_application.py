@@ -0,0 +1,306 @@
+#!/bin/sh/python
+# coding= utf-8
+import gzip
+import json
+import os
+import unittest
+from datetime import date
+from mock import patch
+import application
+from apod import encoding, ratelimit, snapshots
+from tests.apod.helpers import PAGES_DIR, PagesHandler, start_server, stop_server
+
+
+class StubHandler(PagesHandler):
+    """
+    Serves the trimmed pages, and that of 2017-03-22 redated as the latest
+    entry or, with every_day set, as the entry of any date without a page.
+    """
+
+    every_day = False
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        dt = date.today() if name == 'astropix.html' else snapshots.page_date(name)
+        if (os.path.exists(os.path.join(PAGES_DIR, name)) or dt is None
+                or not (dt == date.today() or StubHandler.every_day)):
+            return PagesHandler.do_GET(self)
+        PagesHandler.hits.append(self.path)
+        with open(os.path.join(PAGES_DIR, 'ap170322.html'), 'rb') as f:
+            body = f.read().replace(b'2017 March 22', dt.strftime('%Y %B %d').encode())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestApplication(unittest.TestCase):
+    """Test the Flask service against a local stub."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base = start_server(StubHandler)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    def setUp(self):
+        PagesHandler.hits = []
+        StubHandler.every_day = False
+        application.RESULTS_CACHE.clear()
+        application.VALIDATORS.clear()
+        patcher = patch('apod.utility.BASE', self.base)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = application.app.test_client()
+
+    def test_not_modified(self):
+        res = self.client.get('/v1/apod/?date=2017-03-22')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['title'], 'Central Cygnus Skyscape')
+        etag = res.headers['ETag']
+        last_modified = res.headers['Last-Modified']
+        self.assertEqual(last_modified, 'Wed, 22 Mar 2017 00:00:00 GMT')
+
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': '"other"'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(PagesHandler.hits, ['/ap170322.html'])
+
+        # without the validators remembered, the rebuilt response is compared
+        application.VALIDATORS.clear()
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_weak_and_strong_etags(self):
+        res = self.client.get('/v1/apod/?date=2017-03-22')
+        etag = res.headers['ETag']
+        # the ETag is a digest of the body, so it is strong
+        self.assertFalse(etag.startswith('W/'))
+
+        # If-None-Match compares weakly, so a weak copy of it matches too
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': 'W/' + etag})
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': '"other", W/' + etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_cache_control(self):
+        immutable = application.IMMUTABLE_CACHE_CONTROL
+        fresh = 'public, max-age=%d' % application.TODAY_TTL
+        for path, cache_control in (
+                ('/v1/apod/?date=2017-03-22', immutable),
+                ('/v1/apod/?start_date=2017-03-21&end_date=2017-03-23', immutable),
+                ('/v1/apod/?dates=2017-03-22,2013-03-11', immutable),
+                ('/v1/apod/?start_date=2017-03-21&end_date=2017-03-23&format=ndjson', immutable),
+                ('/v1/apod/', fresh),
+                ('/v1/apod/?date=' + date.today().isoformat(), fresh),
+                ('/v1/apod/?start_date=' + date.today().isoformat(), fresh)):
+            res = self.client.get(path)
+            self.assertEqual(res.status_code, 200, path)
+            self.assertEqual(res.headers['Cache-Control'], cache_control, path)
+            # only what can no longer change has a Last-Modified
+            self.assertEqual('Last-Modified' in res.headers, cache_control == immutable and 'format' not in path,
+                             path)
+
+        res = self.client.get('/v1/apod/?count=1')
+        self.assertEqual(res.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', res.headers)
+        self.assertNotIn('Last-Modified', res.headers)
+
+    def test_random_dates(self):
+        StubHandler.every_day = True
+        engine = application.FETCH_ENGINE
+        for count in (1, 100):
+            with patch.object(engine, 'imap', wraps=engine.imap) as imap:
+                res = self.client.get('/v1/apod/?count=%d' % count)
+            self.assertEqual(res.status_code, 200)
+            dates = [entry['date'] for entry in res.get_json()]
+            self.assertEqual(len(dates), count)
+            self.assertEqual(len(set(dates)), count)
+            for dt in dates:
+                self.assertTrue('1995-06-16' <= dt <= date.today().isoformat(), dt)
+            # each batch of fetches keeps to the cap per request
+            self.assertEqual(set(call[0][2] for call in imap.call_args_list), {engine.per_request})
+
+        for count in (0, 101):
+            self.assertEqual(self.client.get('/v1/apod/?count=%d' % count).status_code, 400)
+
+    def test_compressed_bodies(self):
+        plain = self.client.get('/v1/apod/?date=2017-03-22')
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn('Accept-Encoding', plain.vary)
+
+        with patch('apod.encoding.compress', wraps=encoding.compress) as compress:
+            for _ in range(2):
+                res = self.client.get('/v1/apod/?date=2017-03-22', headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.content_encoding, 'gzip')
+                self.assertEqual(gzip.decompress(res.data), plain.data)
+        # compressed once, and kept for the next request
+        self.assertEqual(compress.call_count, 1)
+        # the ETag is of the bytes sent
+        self.assertNotEqual(res.headers['ETag'], plain.headers['ETag'])
+
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'Accept-Encoding': 'gzip',
+                                                                   'If-None-Match': plain.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/v1/apod/?date=2017-03-22', headers={'Accept-Encoding': 'identity;q=1, gzip;q=0'})
+        self.assertEqual(res.data, plain.data)
+        self.assertEqual(PagesHandler.hits, ['/ap170322.html'])
+
+    def test_range(self):
+        res = self.client.get('/v1/apod/?start_date=2017-03-21&end_date=2017-03-23')
+        self.assertEqual(res.status_code, 200)
+        # dates without an entry upstream are left out
+        self.assertEqual([entry['date'] for entry in res.get_json()], ['2017-03-22'])
+        self.assertEqual(sorted(PagesHandler.hits), ['/ap170321.html', '/ap170322.html', '/ap170323.html'])
+
+        # the entries fetched are cached for the next range over them
+        StubHandler.every_day = True
+        res = self.client.get('/v1/apod/?start_date=2017-03-19&end_date=2017-03-22')
+        self.assertEqual([entry['date'] for entry in res.get_json()],
+                         ['2017-03-19', '2017-03-20', '2017-03-21', '2017-03-22'])
+        self.assertEqual(PagesHandler.hits.count('/ap170322.html'), 1)
+
+        res = self.client.get('/v1/apod/?start_date=2017-03-22&end_date=2017-03-21')
+        self.assertEqual(res.status_code, 400)
+
+    def test_dates(self):
+        res = self.client.get('/v1/apod/?dates=2017-03-23,2017-03-22,2017-03-22')
+        self.assertEqual(res.status_code, 200)
+        data = res.get_json()
+        self.assertEqual([entry['date'] for entry in data], ['2017-03-23', '2017-03-22', '2017-03-22'])
+        self.assertEqual(data[0]['code'], 404)
+        self.assertEqual(data[1]['title'], 'Central Cygnus Skyscape')
+        self.assertEqual(data[1], data[2])
+        # each date is fetched once
+        self.assertEqual(sorted(PagesHandler.hits), ['/ap170322.html', '/ap170323.html'])
+
+        for query in ('dates=2017-03-22&date=2017-03-22', 'dates=2017-03-22&count=1',
+                      'dates=' + ','.join(['2017-03-22'] * 101), 'dates=2017-03-22,1990-01-01',
+                      'dates=2017-03-22,yesterday'):
+            self.assertEqual(self.client.get('/v1/apod/?' + query).status_code, 400, query)
+        # an empty list is not a request for today's entry
+        for query in ('dates=', 'dates=,'):
+            res = self.client.get('/v1/apod/?' + query)
+            self.assertEqual(res.status_code, 400)
+            self.assertIn('dates must list', res.get_json()['msg'])
+        self.assertNotIn('/astropix.html', PagesHandler.hits)
+
+    def test_fields(self):
+        res = self.client.get('/v1/apod/?date=2017-03-22&fields=url,title')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(res.get_json()), {'date', 'url', 'title', 'service_version'})
+
+        # the entry parsed without its explanation does not serve the whole one
+        res = self.client.get('/v1/apod/?date=2017-03-22')
+        self.assertIn('explanation', res.get_json())
+        self.assertEqual(len(PagesHandler.hits), 2)
+
+        # which in turn serves trimmed requests, of ranges too
+        res = self.client.get('/v1/apod/?date=2017-03-22&fields=explanation')
+        self.assertEqual(set(res.get_json()), {'date', 'explanation', 'service_version'})
+        res = self.client.get('/v1/apod/?start_date=2017-03-22&end_date=2017-03-22&fields=copyright')
+        self.assertEqual(res.get_json(), [{'date': '2017-03-22', 'copyright': 'Robert Gendler',
+                                           'service_version': 'v1'}])
+        self.assertEqual(len(PagesHandler.hits), 2)
+
+        res = self.client.get('/v1/apod/?date=2017-03-22&fields=url,secret')
+        self.assertEqual(res.status_code, 400)
+
+    def test_range_pages(self):
+        StubHandler.every_day = True
+        with patch('application.RANGE_PAGE_DAYS', 2):
+            res = self.client.get('/v1/apod/?start_date=2017-03-19&end_date=2017-03-22&thumbs=false')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([entry['date'] for entry in res.get_json()], ['2017-03-19', '2017-03-20'])
+            # dated by the last day of the page, not of the whole range
+            self.assertEqual(res.headers['Last-Modified'], 'Mon, 20 Mar 2017 00:00:00 GMT')
+            link = res.headers['Link']
+            self.assertTrue(link.startswith('<http://localhost/v1/apod/?'))
+            self.assertTrue(link.endswith('>; rel="next"'))
+            self.assertIn('thumbs=false', link)
+            self.assertNotIn('start_date', link)
+
+            res = self.client.get(link[link.index('/v1/'):link.index('>')])
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([entry['date'] for entry in res.get_json()], ['2017-03-21', '2017-03-22'])
+            self.assertEqual(res.headers['Last-Modified'], 'Wed, 22 Mar 2017 00:00:00 GMT')
+            self.assertNotIn('Link', res.headers)
+
+            # a short range, and a streamed one, are not paged
+            res = self.client.get('/v1/apod/?start_date=2017-03-21&end_date=2017-03-22')
+            self.assertNotIn('Link', res.headers)
+            res = self.client.get('/v1/apod/?start_date=2017-03-19&end_date=2017-03-22&format=ndjson')
+            self.assertEqual(len(res.data.splitlines()), 4)
+            self.assertNotIn('Link', res.headers)
+
+        for query in ('cursor=bogus', 'cursor=' + application._make_cursor(date(2017, 3, 21), date(2017, 3, 22)) +
+                      '&start_date=2017-03-21'):
+            self.assertEqual(self.client.get('/v1/apod/?' + query).status_code, 400, query)
+
+    def test_rate_limit(self):
+        with patch('application.RATE_LIMITER', ratelimit.TokenBuckets(10)):
+            res = self.client.get('/v1/apod/?start_date=2017-03-15&end_date=2017-03-22')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-RateLimit-Limit'], '10')
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '2')
+
+            res = self.client.get('/v1/apod/?start_date=2017-03-20&end_date=2017-03-22&format=ndjson')
+            self.assertEqual(res.status_code, 429)
+            self.assertIn('Retry-After', res.headers)
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '2')
+
+            res = self.client.get('/v1/apod/?dates=2017-03-22,2017-03-22')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '0')
+            self.assertEqual(self.client.get('/v1/apod/?date=2017-03-22').status_code, 429)
+
+            # each client has its own bucket
+            res = self.client.get('/v1/apod/?date=2017-03-22', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '9')
+        # turned away before going upstream; the rest was cached
+        self.assertEqual(len(PagesHandler.hits), 8)
+
+        res = self.client.get('/v1/apod/?date=2017-03-22')
+        self.assertNotIn('X-RateLimit-Limit', res.headers)
+
+    def test_streamed_range(self):
+        StubHandler.every_day = True
+        query = '/v1/apod/?start_date=2017-03-19&end_date=2017-03-23'
+        expected = self.client.get(query).get_json()
+        self.assertEqual([entry['date'] for entry in expected],
+                         ['2017-03-19', '2017-03-20', '2017-03-21', '2017-03-22', '2017-03-23'])
+
+        res = self.client.get(query + '&format=ndjson')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(res.data.endswith(b'\n'))
+        self.assertEqual([json.loads(line) for line in res.data.splitlines()], expected)
+
+        # one array, sent an entry at a time
+        res = self.client.get(query + '&format=json-stream')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(json.loads(res.data), expected)
+
+        res = self.client.get('/v1/apod/?date=2017-03-22&format=ndjson')
+        self.assertEqual(res.status_code, 400)
+
+    def test_latest(self):
+        res = self.client.get('/v1/apod/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['date'], date.today().isoformat())
+        # conditional requests for the latest entry are answered as well
+        res = self.client.get('/v1/apod/', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(PagesHandler.hits, ['/astropix.html'])
+
@@ -0,0 +1,226 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from apod import ratelimit, store, thumbs, tracing
+from tests.apod.helpers import PagesHandler, start_server, stop_server
+
+try:
+    from aiohttp.test_utils import AioHTTPTestCase
+    import async_application
+except ImportError:
+    AioHTTPTestCase = unittest.TestCase
+    async_application = None
+
+@unittest.skipIf(async_application is None, 'aiohttp is not installed')
+class TestAsyncApplication(AioHTTPTestCase):
+    """Test the asyncio variant of the service against a local stub."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base = start_server(PagesHandler)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    async def get_application(self):
+        return async_application.create_app()
+
+    def setUp(self):
+        super(TestAsyncApplication, self).setUp()
+        PagesHandler.hits = []
+        async_application.RESULTS_CACHE.clear()
+        patcher = patch('async_application.BASE', self.base)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_date(self):
+        res = await self.client.get('/v1/apod/?date=2017-03-22')
+        self.assertEqual(res.status, 200)
+        data = await res.json()
+        self.assertEqual(data['title'], 'Central Cygnus Skyscape')
+        self.assertEqual(data['service_version'], 'v1')
+        self.assertIn('immutable', res.headers['Cache-Control'])
+
+        # a matching conditional request gets a 304, and is served from cache
+        res = await self.client.get('/v1/apod/?date=2017-03-22', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status, 304)
+        self.assertEqual(PagesHandler.hits, ['/ap170322.html'])
+
+    async def test_thumbnail_lookup_failed(self):
+        resolver = thumbs.ThumbnailResolver()
+        # a lookup of the video on the page failed just now
+        resolver.record_vimeo('103551479', 503)
+        with patch('async_application.THUMBNAILS', resolver):
+            res = await self.client.get('/v1/apod/?date=2014-08-18&thumbs=true')
+        self.assertEqual(res.status, 200)
+        data = await res.json()
+        self.assertEqual(data['media_type'], 'video')
+        self.assertNotIn('thumbnail_url', data)
+
+    async def test_concurrent_requests_share_one_fetch(self):
+        import asyncio
+        responses = await asyncio.gather(*[self.client.get('/v1/apod/?date=2017-03-22') for _ in range(10)])
+        self.assertEqual([res.status for res in responses], [200] * 10)
+        self.assertEqual(PagesHandler.hits, ['/ap170322.html'])
+
+    async def test_range(self):
+        res = await self.client.get('/v1/apod/?start_date=2017-03-21&end_date=2017-03-23',
+                                    headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        data = await res.json()
+        self.assertEqual([entry['date'] for entry in data], ['2017-03-22'])
+        self.assertEqual(sorted(PagesHandler.hits), ['/ap170321.html', '/ap170322.html', '/ap170323.html'])
+
+    async def test_range_pages(self):
+        with patch('async_application.RANGE_PAGE_DAYS', 2):
+            res = await self.client.get('/v1/apod/?start_date=2017-03-19&end_date=2017-03-22&thumbs=false')
+            self.assertEqual(res.status, 200)
+            self.assertEqual(await res.json(), [])
+            link = res.headers['Link']
+            self.assertTrue(link.endswith('>; rel="next"'))
+            self.assertIn('thumbs=false', link)
+            self.assertNotIn('start_date', link)
+            # the first page ends on 2017-03-20, not on the end_date
+            self.assertEqual(res.headers['Last-Modified'], 'Mon, 20 Mar 2017 00:00:00 GMT')
+
+            res = await self.client.get(link[link.index('/v1/'):link.index('>')])
+            self.assertEqual(res.status, 200)
+            self.assertEqual([entry['date'] for entry in await res.json()], ['2017-03-22'])
+            self.assertNotIn('Link', res.headers)
+
+        res = await self.client.get('/v1/apod/?cursor=bogus')
+        self.assertEqual(res.status, 400)
+
+    async def test_ndjson(self):
+        res = await self.client.get('/v1/apod/?start_date=2017-03-21&end_date=2017-03-23&format=ndjson')
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        lines = (await res.read()).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn(b'"date":"2017-03-22"', lines[0])
+
+    async def test_dates(self):
+        res = await self.client.get('/v1/apod/?dates=2017-03-23,2017-03-22,2017-03-22')
+        self.assertEqual(res.status, 200)
+        data = await res.json()
+        self.assertEqual([entry['date'] for entry in data], ['2017-03-23', '2017-03-22', '2017-03-22'])
+        self.assertEqual(data[0]['code'], 404)
+        self.assertEqual(data[1]['title'], 'Central Cygnus Skyscape')
+        # each date is fetched once
+        self.assertEqual(len(PagesHandler.hits), 2)
+
+        res = await self.client.get('/v1/apod/?dates=2017-03-22&date=2017-03-22')
+        self.assertEqual(res.status, 400)
+        res = await self.client.get('/v1/apod/?dates=' + ','.join(['2017-03-22'] * 101))
+        self.assertEqual(res.status, 400)
+        res = await self.client.get('/v1/apod/?dates=2017-03-22,1990-01-01')
+        self.assertEqual(res.status, 400)
+        # an empty list is not a request for today's entry
+        for query in ('dates=', 'dates=,'):
+            res = await self.client.get('/v1/apod/?' + query)
+            self.assertEqual(res.status, 400)
+            self.assertIn('dates must list', (await res.json())['msg'])
+        self.assertEqual(async_application.application._mode({'dates': ''}), 'dates')
+        self.assertEqual(async_application.application._cost({'dates': ''}), 1)
+
+    async def test_fields(self):
+        res = await self.client.get('/v1/apod/?date=2017-03-22&fields=url,title')
+        self.assertEqual(res.status, 200)
+        data = await res.json()
+        self.assertEqual(set(data), {'date', 'url', 'title', 'service_version'})
+
+        # the entry parsed without its explanation does not serve the whole one
+        res = await self.client.get('/v1/apod/?date=2017-03-22')
+        data = await res.json()
+        self.assertIn('explanation', data)
+        self.assertEqual(len(PagesHandler.hits), 2)
+
+        # which in turn serves trimmed requests
+        res = await self.client.get('/v1/apod/?date=2017-03-22&fields=explanation')
+        self.assertEqual(set(await res.json()), {'date', 'explanation', 'service_version'})
+        self.assertEqual(len(PagesHandler.hits), 2)
+
+        res = await self.client.get('/v1/apod/?date=2017-03-22&fields=url,secret')
+        self.assertEqual(res.status, 400)
+
+    async def test_rate_limit(self):
+        buckets = ratelimit.TokenBuckets(10)
+        with patch('async_application.RATE_LIMITER', buckets), patch('application.RATE_LIMITER', buckets):
+            res = await self.client.get('/v1/apod/?start_date=2017-03-15&end_date=2017-03-22')
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.headers['X-RateLimit-Limit'], '10')
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '2')
+
+            res = await self.client.get('/v1/apod/?start_date=2017-03-20&end_date=2017-03-22&format=ndjson')
+            self.assertEqual(res.status, 429)
+            self.assertIn('Retry-After', res.headers)
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '2')
+
+            res = await self.client.get('/v1/apod/?start_date=2017-03-21&end_date=2017-03-22&format=ndjson')
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.headers['X-RateLimit-Remaining'], '0')
+        # turned away before going upstream; the last two days were cached
+        self.assertEqual(len(PagesHandler.hits), 8)
+
+    async def test_validation(self):
+        res = await self.client.get('/v1/apod/?foo=bar')
+        self.assertEqual(res.status, 400)
+        # encoded as by application.py
+        expected = async_application.application.app.test_client().get('/v1/apod/?foo=bar')
+        self.assertEqual(await res.read(), expected.get_data())
+        self.assertEqual(res.headers['Content-Type'], expected.headers['Content-Type'])
+        res = await self.client.get('/v1/apod/?date=1990-01-01')
+        self.assertEqual(res.status, 400)
+        self.assertIn('Date must be between', (await res.json())['msg'])
+        res = await self.client.get('/v1/apod/?date=2017-03-22&count=5')
+        self.assertEqual(res.status, 400)
+
+    async def test_missing_date(self):
+        res = await self.client.get('/v1/apod/?date=2017-03-23')
+        self.assertEqual(res.status, 404)
+
+    async def test_metrics(self):
+        await self.client.get('/v1/apod/?date=2017-03-22')
+        res = await self.client.get('/metrics')
+        self.assertEqual(res.status, 200)
+        text = await res.text()
+        self.assertIn('apod_responses_total{mode="single",status="200"}', text)
+        self.assertIn('apod_upstream_responses_total{upstream="apod",status="200"}', text)
+        self.assertIn('apod_cache_entries{cache="results"}', text)
+        self.assertIn('apod_parse_field_duration_seconds_count{parser="extractor",field="title"}', text)
+
+    async def test_trace(self):
+        with patch('async_application.TRACER', tracing.Tracer(token='s3cret')):
+            res = await self.client.get('/v1/apod/?date=2017-03-22', headers={'X-Apod-Trace': 's3cret'})
+            self.assertEqual(res.status, 200)
+            self.assertIn('scan;dur=', res.headers['Server-Timing'])
+            res = await self.client.get('/v1/apod/?date=2017-03-21', headers={'X-Apod-Trace': 'guess'})
+            self.assertNotIn('Server-Timing', res.headers)
+            res = await self.client.get('/v1/apod/?date=2017-03-22', headers={'X-Apod-Trace': u'caf\xe9'})
+            self.assertEqual(res.status, 200)
+            self.assertNotIn('Server-Timing', res.headers)
+
+    async def test_search(self):
+        res = await self.client.get('/v1/search/?q=cygnus')
+        self.assertEqual(res.status, 503)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        archive = store.open_store(os.path.join(tmpdir, 'archive.db'))
+        self.addCleanup(archive.close)
+        with patch('async_application.ARCHIVE', archive), patch('application.ARCHIVE', archive):
+            res = await self.client.get('/v1/apod/?date=2017-03-22')
+            self.assertEqual(res.status, 200)
+            res = await self.client.get('/v1/search/?q=cygnus')
+            self.assertEqual(res.status, 200)
+            data = await res.json()
+            self.assertEqual(data['total'], 1)
+            self.assertEqual(data['results'][0]['title'], 'Central Cygnus Skyscape')
+            res = await self.client.get('/v1/search/?q=cygnus&per_page=1000')
+            self.assertEqual(res.status, 400)
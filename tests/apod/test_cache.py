@@ -0,0 +1,93 @@
+#!/bin/sh/python
+# coding= utf-8
+import unittest
+from apod import cache
+from tests.apod.helpers import FakeClock
+
+
+class TestResultCache(unittest.TestCase):
+    """Test the bounded in-memory results cache."""
+
+    def test_lru_eviction(self):
+        results = cache.ResultCache(max_entries=2)
+        results.put('a', {'title': 'A'})
+        results.put('b', {'title': 'B'})
+        results.get('a')
+        results.put('c', {'title': 'C'})
+
+        self.assertIsNone(results.get('b'))
+        self.assertEqual(results.get('a')['title'], 'A')
+        self.assertEqual(results.get('c')['title'], 'C')
+        self.assertEqual(results.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        results = cache.ResultCache(clock=clock)
+        results.put('today', {'title': 'A'}, ttl=60)
+        results.put('history', {'title': 'B'})
+
+        clock.now = 61
+        self.assertIsNone(results.get('today'))
+        self.assertEqual(results.get('history')['title'], 'B')
+
+        stats = results.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations']), (1, 1, 1))
+
+    def test_entries(self):
+        results = cache.ResultCache()
+        results.put('a', {'title': 'A'})
+        results.put('b', {'title': 'B'})
+        results.put('today', {'title': 'C'}, ttl=60)
+        results.put('part', {'title': 'D'}, fields=frozenset(['title']))
+        results.get('a')
+        results.get('a')
+
+        self.assertEqual([(key, dict(data), hits) for key, data, hits in results.entries()],
+                         [('b', {'title': 'B'}, 0), ('a', {'title': 'A'}, 2)])
+
+    def test_entries_are_frozen(self):
+        results = cache.ResultCache()
+        data = {'title': 'A'}
+        stored = results.put('a', data)
+        data['title'] = 'changed'
+
+        self.assertEqual(results.get('a')['title'], 'A')
+        with self.assertRaises(TypeError):
+            stored['service_version'] = 'v1'
+
+    def test_body_is_encoded_once(self):
+        clock = FakeClock()
+        results = cache.ResultCache(clock=clock)
+        encoded = []
+
+        def encode(data):
+            encoded.append(data)
+            return data['title'].encode()
+
+        self.assertIsNone(results.get_body('a', encode))
+        results.put('a', {'title': 'A'}, ttl=60)
+        self.assertEqual(results.get_body('a', encode), b'A')
+        self.assertEqual(results.get_body('a', encode), b'A')
+        self.assertEqual(len(encoded), 1)
+
+        # replacing the entry drops its body
+        results.put('a', {'title': 'B'}, ttl=60)
+        self.assertEqual(results.get_body('a', encode), b'B')
+
+        clock.now = 61
+        self.assertIsNone(results.get_body('a', encode))
+
+    def test_partial_entries(self):
+        results = cache.ResultCache()
+        results.put('a', {'url': 'u', 'title': 'A'}, fields=frozenset(['url', 'title']))
+        self.assertEqual(results.get('a', frozenset(['url']))['title'], 'A')
+        self.assertIsNone(results.get('a', frozenset(['url', 'explanation'])))
+        # only a whole entry will do without fields, and has a body
+        self.assertIsNone(results.get('a'))
+        self.assertIsNone(results.get_body('a', lambda data: b''))
+
+        results.put('a', {'url': 'u', 'title': 'A', 'explanation': 'E'})
+        self.assertEqual(results.get('a')['explanation'], 'E')
+        # a whole entry is not replaced by part of one
+        results.put('a', {'url': 'u'}, fields=frozenset(['url']))
+        self.assertEqual(results.get('a', frozenset(['url']))['explanation'], 'E')
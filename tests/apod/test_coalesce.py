@@ -0,0 +1,81 @@
+#!/bin/sh/python
+# coding= utf-8
+import threading
+import time
+import unittest
+from datetime import date
+from mock import patch
+from apod import coalesce, utility
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test the coalescing of identical concurrent calls."""
+
+    def setUp(self):
+        self.flight = coalesce.SingleFlight()
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.runs = 0
+
+    def _slow(self, value):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _callers(self, n, key, value):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do(key, self._slow, value))
+            except Exception as ex:
+                results.append(ex)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # let the followers reach the wait before the leader finishes
+        while self.flight.stats()['coalesced'] < n - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_calls_share_one_run(self):
+        results = self._callers(5, 'a', 42)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(self.flight.stats(), {'calls': 1, 'coalesced': 4, 'in_flight': 0})
+
+    def test_exception_is_shared(self):
+        error = ValueError('boom')
+        results = self._callers(3, 'a', error)
+        self.assertEqual(results, [error] * 3)
+        self.assertEqual(self.runs, 1)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        self.release.set()
+        self.assertEqual(self.flight.do('a', self._slow, 1), 1)
+        self.assertEqual(self.flight.do('a', self._slow, 2), 2)
+        self.assertEqual(self.flight.stats(), {'calls': 2, 'coalesced': 0, 'in_flight': 0})
+
+
+class TestParseApodCoalescing(unittest.TestCase):
+    """Test that parse_apod hands each caller its own copy."""
+
+    @patch('apod.utility._get_apod_chars')
+    def test_copies(self, mock_chars):
+        mock_chars.return_value = {'date': '2017-03-22', 'title': 'Central Cygnus Skyscape'}
+        first = utility.parse_apod(date(2017, 3, 22))
+        first['concepts'] = 'x'
+        self.assertNotIn('concepts', utility.parse_apod(date(2017, 3, 22)))
+
+    @patch('apod.utility._get_apod_chars', return_value=None)
+    def test_missing(self, mock_chars):
+        self.assertIsNone(utility.parse_apod(date(2017, 3, 22)))
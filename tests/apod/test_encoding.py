@@ -0,0 +1,32 @@
+#!/bin/sh/python
+# coding= utf-8
+import gzip
+import unittest
+from apod import encoding
+
+
+class TestEncodedBody(unittest.TestCase):
+    """Test the encoded bodies and their compressed forms."""
+
+    BODY = b'{"date":"2017-03-22","title":"Central Cygnus Skyscape"}\n' * 20
+
+    def test_identity(self):
+        body = encoding.EncodedBody(self.BODY)
+        self.assertIs(body.encoded(None), self.BODY)
+        self.assertEqual(len(body), len(self.BODY))
+
+    def test_gzip_is_made_once(self):
+        body = encoding.EncodedBody(self.BODY)
+        compressed = body.encoded('gzip')
+        self.assertEqual(gzip.decompress(compressed), self.BODY)
+        self.assertLess(len(compressed), len(self.BODY))
+        self.assertIs(body.encoded('gzip'), compressed)
+
+    def test_gzip_is_reproducible(self):
+        self.assertEqual(encoding.compress(self.BODY, 'gzip'), encoding.compress(self.BODY, 'gzip'))
+
+    def test_codings(self):
+        self.assertIn('gzip', encoding.CODINGS)
+        self.assertEqual('br' in encoding.CODINGS, encoding.brotli is not None)
+        with self.assertRaises(ValueError):
+            encoding.compress(self.BODY, 'compress')
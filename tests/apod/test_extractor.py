@@ -0,0 +1,87 @@
+#!/bin/sh/python
+# coding= utf-8
+import glob
+import os
+import unittest
+from datetime import date
+from bs4 import BeautifulSoup
+from mock import patch, Mock
+from apod import extractor, utility
+
+# Trimmed copies of apod.nasa.gov pages from each era of its layout
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+def _load(name):
+    with open(os.path.join(PAGES_DIR, name), 'rb') as f:
+        # apod.nasa.gov declares no charset, so requests decodes as latin-1
+        return f.read().decode('latin1')
+
+
+def _date_of(name):
+    return date(int(name[2:4]) + (1900 if name[2] == '9' else 2000), int(name[4:6]), int(name[6:8]))
+
+
+class TestExtractor(unittest.TestCase):
+    """Test the single-pass extractor against the BeautifulSoup parse."""
+
+    def _both(self, html, dt):
+        fast = utility._read_page(extractor.Page(html), dt)
+        soup = utility._read_page(utility._SoupPage(BeautifulSoup(html, 'html.parser')), dt)
+        return fast, soup
+
+    def test_matches_soup_on_every_page(self):
+        for path in sorted(glob.glob(os.path.join(PAGES_DIR, 'ap*.html'))):
+            name = os.path.basename(path)
+            fast, soup = self._both(_load(name), _date_of(name))
+            self.assertEqual(fast, soup, 'Extraction of ' + name)
+
+    def test_later_page(self):
+        props, data = utility._read_page(extractor.Page(_load('ap170322.html')), date(2017, 3, 22))
+        self.assertEqual(props['title'], 'Central Cygnus Skyscape')
+        self.assertEqual(props['copyright'], 'Robert Gendler')
+        self.assertEqual(props['hdurl'], 'https://apod.nasa.gov/apod/image/1703/Cygnus-New-L.jpg')
+        self.assertTrue(props['explanation'].startswith('In cosmic brush strokes of glowing hydrogen gas,'))
+        self.assertTrue(props['explanation'].endswith('range from 2,000 to 5,000 light-years.'))
+
+    def test_older_page(self):
+        props, data = utility._read_page(extractor.Page(_load('ap151115.html')), date(2015, 11, 15))
+        self.assertEqual(props['title'], 'Leonids Over Monument Valley')
+        self.assertEqual(props['copyright'], 'Sean M. Sabatini')
+        self.assertEqual(props['url'], 'https://apod.nasa.gov/apod/image/1511/leonidsmonuments_sabatini_960.jpg')
+        self.assertTrue(props['explanation'].startswith('There was a shower over Monument Valley -- but not water.  '
+                                                        'Meteors.  '))
+
+    def test_early_page(self):
+        props, data = utility._read_page(extractor.Page(_load('ap950620.html')), date(1995, 6, 20))
+        self.assertEqual(props['title'], 'Earth From Space')
+        self.assertNotIn('copyright', props)
+        self.assertTrue(props['explanation'].startswith('This is a picture of the Earth as seen from space.'))
+
+    def test_date_of_todays_page(self):
+        today = date.today()
+        html = _load('ap170322.html').replace('2017 March 22', today.strftime('%Y %B %d'))
+        fast, soup = self._both(html, None)
+        self.assertEqual(fast[0]['date'], today.isoformat())
+        self.assertEqual(fast, soup)
+
+    def test_only_wanted_fields(self):
+        html = _load('ap170322.html')
+        fields = frozenset(['url', 'title'])
+        props = utility.parse_apod_page(html, date(2017, 3, 22), fields=fields)
+        self.assertEqual(props['title'], 'Central Cygnus Skyscape')
+        self.assertNotIn('explanation', props)
+        self.assertNotIn('copyright', props)
+        self.assertEqual(set(props) - {'explanation', 'copyright'},
+                         set(utility.parse_apod_page(html, date(2017, 3, 22))) - {'explanation', 'copyright'})
+        self.assertEqual(utility.extracted(fields), utility.FIELDS - {'explanation', 'copyright'})
+        self.assertIsNone(utility.extracted(utility.FIELDS))
+
+    @patch('apod.upstream.get')
+    def test_falls_back_to_soup(self, mock_get):
+        mock_get.return_value = Mock(status_code=200, text=_load('ap130311.html'))
+        expected = utility._get_apod_chars(date(2013, 3, 11), False)
+
+        with patch('apod.extractor.Page', side_effect=IndexError('list index out of range')):
+            self.assertEqual(utility._get_apod_chars(date(2013, 3, 11), False), expected)
+        self.assertEqual(expected['copyright'], 'Martin RietzeAlien Landscapes on Planet Earth')
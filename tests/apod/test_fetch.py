@@ -0,0 +1,50 @@
+#!/bin/sh/python
+# coding= utf-8
+import threading
+import time
+import unittest
+from apod import fetch
+
+
+class TestFetchEngine(unittest.TestCase):
+    """Test the bounded-concurrency fetch engine."""
+
+    def setUp(self):
+        self.engine = fetch.FetchEngine(max_workers=4, per_request=2)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def _slow_square(self, n):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        # finish out of order
+        time.sleep(0.01 * (n % 3))
+        with self.lock:
+            self.running -= 1
+        return n * n
+
+    def test_results_in_order(self):
+        self.assertEqual(self.engine.map(self._slow_square, range(10)), [n * n for n in range(10)])
+
+    def test_parallelism_is_capped(self):
+        self.engine.map(self._slow_square, range(10))
+        self.assertEqual(self.peak, 2)
+
+        self.peak = 0
+        self.engine.map(self._slow_square, range(10), parallelism=10)
+        self.assertEqual(self.peak, 4)
+
+    def test_exception_is_raised(self):
+        def fail_on_three(n):
+            if n == 3:
+                raise ValueError('no data')
+            return n
+
+        results = self.engine.imap(fail_on_three, range(6))
+        self.assertEqual([next(results) for _ in range(3)], [0, 1, 2])
+        self.assertRaises(ValueError, next, results)
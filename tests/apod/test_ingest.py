@@ -0,0 +1,122 @@
+#!/bin/sh/python
+# coding= utf-8
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from mock import patch
+from apod import ingest, store
+
+
+def _fake_parse_apod(dt, use_default_today_date=False, thumbs=False):
+    if dt == date(2017, 3, 20):
+        return None
+    if dt == date(2017, 3, 21):
+        raise Exception('Date not found in soup data.')
+    return {'date': dt.isoformat(), 'title': 'Entry for ' + dt.isoformat(), 'media_type': 'image'}
+
+
+class TestIngest(unittest.TestCase):
+    """Test the bulk ingest of the archive."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'archive.db')
+        self.store = store.open_store(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pending_dates(self):
+        self.store.put(date(2017, 3, 21), (False, False), {'date': '2017-03-21'})
+        self.store.put(date(2017, 3, 22), (False, True), {'date': '2017-03-22'})
+        self.assertEqual(ingest.pending_dates(self.store, (False, False), date(2017, 3, 20), date(2017, 3, 22)),
+                         [date(2017, 3, 20), date(2017, 3, 22)])
+
+        # dates without an entry upstream are skipped, unless rechecked
+        self.store.mark_absent(date(2017, 3, 20))
+        self.assertEqual(ingest.pending_dates(self.store, (False, False), date(2017, 3, 20), date(2017, 3, 22)),
+                         [date(2017, 3, 22)])
+        self.assertEqual(ingest.pending_dates(self.store, (False, False), date(2017, 3, 20), date(2017, 3, 22),
+                                              recheck_absent=True),
+                         [date(2017, 3, 20), date(2017, 3, 22)])
+
+    @patch('apod.ingest.parse_apod', side_effect=_fake_parse_apod)
+    def test_ingest(self, mock_parse):
+        errors = io.StringIO()
+        dates = [date(2017, 3, d) for d in range(19, 24)]
+        counts = ingest.ingest(self.store, dates, workers=2, rate=0, errors=errors)
+
+        self.assertEqual(counts, {'stored': 3, 'absent': 1, 'failed': 1})
+        self.assertEqual(self.store.absent_dates(), {date(2017, 3, 20)})
+        self.assertEqual(self.store.dates((False, False)),
+                         {date(2017, 3, 19), date(2017, 3, 22), date(2017, 3, 23)})
+        self.assertEqual(self.store.get(date(2017, 3, 22), (False, False))['title'], 'Entry for 2017-03-22')
+
+        logged = [json.loads(line) for line in errors.getvalue().splitlines()]
+        self.assertEqual([entry['date'] for entry in logged], ['2017-03-21'])
+        self.assertIn('Date not found', logged[0]['error'])
+
+    @patch('apod.ingest.parse_apod', side_effect=_fake_parse_apod)
+    def test_main_resumes(self, mock_parse):
+        self.store.put(date(2017, 3, 19), (False, False), {'date': '2017-03-19'})
+        argv = ['--archive', self.path, '--start', '2017-03-19', '--end', '2017-03-23', '--rate', '0']
+
+        self.assertEqual(ingest.main(argv), 1)
+        self.assertEqual(sorted(call[0][0] for call in mock_parse.call_args_list),
+                         [date(2017, 3, d) for d in range(20, 24)])
+        with open(self.path + '.errors.jsonl') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        # the next run only retries the dates which failed, not those absent upstream
+        mock_parse.reset_mock()
+        ingest.main(argv)
+        self.assertEqual([call[0][0] for call in mock_parse.call_args_list], [date(2017, 3, 21)])
+
+        mock_parse.reset_mock()
+        ingest.main(argv + ['--recheck-absent'])
+        self.assertEqual(sorted(call[0][0] for call in mock_parse.call_args_list),
+                         [date(2017, 3, 20), date(2017, 3, 21)])
+
+    @patch('apod.ingest.parse_apod', side_effect=_fake_parse_apod)
+    def test_thumbs_variant(self, mock_parse):
+        ingest.ingest(self.store, [date(2017, 3, 22)], thumbs=True, rate=0)
+        self.assertEqual(mock_parse.call_args[1], {'thumbs': 'true'})
+        self.assertEqual(self.store.dates((False, True)), {date(2017, 3, 22)})
+
+    @patch('apod.ingest.parse_apod', return_value={'date': '2014-08-18', 'media_type': 'video'})
+    def test_video_without_thumbnail(self, mock_parse):
+        # its thumbnail could not be looked up, so it is left for later
+        counts = ingest.ingest(self.store, [date(2014, 8, 18)], thumbs=True, rate=0)
+        self.assertEqual(counts['failed'], 1)
+        self.assertEqual(self.store.dates((False, True)), set())
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test the spacing of fetches by the rate limiter."""
+
+    def test_spacing(self):
+        now = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+
+        limiter = ingest.RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(slept, [0.25, 0.5])
+
+        # time that has already passed is not made up for
+        now[0] = 10.0
+        limiter.wait()
+        self.assertEqual(slept, [0.25, 0.5])
+
+    def test_unlimited(self):
+        limiter = ingest.RateLimiter(0, sleep=lambda seconds: self.fail('slept'))
+        limiter.wait()
+        limiter.wait()
@@ -0,0 +1,58 @@
+#!/bin/sh/python
+# coding= utf-8
+import unittest
+from apod import metrics
+
+
+class TestRegistry(unittest.TestCase):
+    """Test the metrics registry and its text exposition."""
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def _lines(self):
+        return self.registry.render().splitlines()
+
+    def test_counter(self):
+        counter = self.registry.counter('hits_total', 'Hits.', ('route',))
+        counter.labels('a').inc()
+        counter.labels('a').inc(2)
+        counter.labels('b "quoted"').inc()
+        self.assertEqual(self._lines(), [
+            '# HELP hits_total Hits.',
+            '# TYPE hits_total counter',
+            'hits_total{route="a"} 3',
+            'hits_total{route="b \\"quoted\\""} 1',
+        ])
+
+    def test_wrong_labels(self):
+        counter = self.registry.counter('hits_total', 'Hits.', ('route',))
+        with self.assertRaises(ValueError):
+            counter.labels('a', 'b')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('busy', 'Busy.')
+        with gauge.track():
+            self.assertIn('busy 1', self._lines())
+        self.assertIn('busy 0', self._lines())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+        self.assertEqual(self._lines()[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.15',
+            'latency_seconds_count 3',
+        ])
+
+    def test_collector(self):
+        self.registry.collector(lambda: [('entries', 'gauge', 'Entries.', ('cache',), [(('results',), 7)])])
+        self.assertEqual(self._lines(), [
+            '# HELP entries Entries.',
+            '# TYPE entries gauge',
+            'entries{cache="results"} 7',
+        ])
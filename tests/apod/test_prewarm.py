@@ -0,0 +1,102 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date, timedelta
+from mock import patch
+from apod import prewarm, snapshots
+from tests.apod.helpers import PAGES_DIR, QuietHandler, start_server, stop_server
+
+
+class StubHandler(QuietHandler):
+    """
+    Serves a page as /astropix.html, dated as given, with an ETag, and 304s
+    when that matches.
+    """
+
+    page = ('ap170322.html', '2017 March 22')
+    day = date.today()
+    etag = '"1"'
+    statuses = []
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == StubHandler.etag:
+            StubHandler.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        name, page_date = StubHandler.page
+        with open(os.path.join(PAGES_DIR, name), 'rb') as f:
+            body = f.read().replace(page_date.encode(), StubHandler.day.strftime('%Y %B %d').encode())
+        StubHandler.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', StubHandler.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestPrewarmer(unittest.TestCase):
+    """Test the polling of the latest entry against a local stub."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, base = start_server(StubHandler)
+        cls.url = base + 'astropix.html'
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    def setUp(self):
+        StubHandler.page = ('ap170322.html', '2017 March 22')
+        StubHandler.day = date.today()
+        StubHandler.etag = '"1"'
+        StubHandler.statuses = []
+        self.published = []
+        self.prewarmer = prewarm.Prewarmer(self.published.append, interval=60, url=self.url)
+
+    def test_conditional_polls(self):
+        self.prewarmer.poll()
+        self.prewarmer.poll()
+        self.assertEqual(StubHandler.statuses, [200, 304])
+        self.assertEqual(self.prewarmer.latest_date, date.today().isoformat())
+        self.assertEqual(self.prewarmer.not_modified, 1)
+        # the entry is published again after a 304, to keep it fresh
+        self.assertEqual(len(self.published), 2)
+        self.assertEqual(self.published[0]['title'], 'Central Cygnus Skyscape')
+        self.assertIs(self.published[0], self.published[1])
+
+    def test_rollover(self):
+        StubHandler.day = date.today() - timedelta(days=1)
+        self.prewarmer.poll()
+        StubHandler.page = ('ap190702.html', '2019 July 2')
+        StubHandler.day = date.today()
+        StubHandler.etag = '"2"'
+        self.prewarmer.poll()
+        self.assertEqual(StubHandler.statuses, [200, 200])
+        self.assertEqual(self.prewarmer.latest_date, date.today().isoformat())
+        # parsed with thumbs, so a video comes with its thumbnail
+        self.assertIn('thumbnail_url', self.published[-1])
+
+    def test_snapshots_kept(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store = snapshots.SnapshotStore(tmpdir)
+        with patch('apod.utility.SNAPSHOTS', store):
+            self.prewarmer.poll()
+        self.assertIsNotNone(store.get('astropix.html'))
+        # and as the page of its date
+        self.assertEqual(store.get(snapshots.page_name(date.today())), store.get('astropix.html'))
+
+    def test_background_thread(self):
+        polled = threading.Event()
+        self.prewarmer.publish = lambda data: polled.set()
+        self.prewarmer.start()
+        try:
+            self.assertTrue(polled.wait(5))
+        finally:
+            self.prewarmer.stop(5)
@@ -0,0 +1,91 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from apod import ratelimit
+from tests.apod.helpers import FakeClock
+
+
+class TestTokenBuckets(unittest.TestCase):
+    """Test the in-memory token buckets."""
+
+    def _buckets(self, clock):
+        return ratelimit.TokenBuckets(10, period=100, clock=clock)
+
+    def test_take(self):
+        clock = FakeClock(1000.0)
+        buckets = self._buckets(clock)
+        self.assertEqual(buckets.take('a', 4), (True, 6, 0))
+        self.assertEqual(buckets.take('a', 6), (True, 0, 0))
+        # refilled at a token every 10 seconds
+        self.assertEqual(buckets.take('a', 3), (False, 0, 30))
+        # other clients have buckets of their own
+        self.assertEqual(buckets.take('b'), (True, 9, 0))
+
+        clock.now += 25
+        self.assertEqual(buckets.take('a', 3), (False, 2, 5))
+        clock.now += 10
+        self.assertEqual(buckets.take('a', 3), (True, 0, 0))
+
+        # never more than full
+        clock.now += 1000
+        self.assertEqual(buckets.take('a'), (True, 9, 0))
+
+    def test_cost_beyond_the_limit(self):
+        buckets = self._buckets(FakeClock(1000.0))
+        self.assertEqual(buckets.take('a', 50), (True, 0, 0))
+        self.assertFalse(buckets.take('a', 50)[0])
+
+    def test_sweep(self):
+        clock = FakeClock(1000.0)
+        buckets = self._buckets(clock)
+        buckets.SWEEP_EVERY = 2
+        buckets.take('a')
+        clock.now += 100
+        buckets.take('b')
+        self.assertEqual(sorted(buckets._buckets), ['b'])
+
+
+class TestSQLiteBuckets(TestTokenBuckets):
+    """Test the token buckets shared through SQLite."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'buckets.db')
+        self.opened = []
+
+    def tearDown(self):
+        for buckets in self.opened:
+            buckets.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _buckets(self, clock):
+        buckets = ratelimit.SQLiteBuckets(self.path, 10, period=100, clock=clock)
+        self.opened.append(buckets)
+        return buckets
+
+    def test_sweep(self):
+        clock = FakeClock(1000.0)
+        buckets = self._buckets(clock)
+        buckets.SWEEP_EVERY = 2
+        buckets.take('a')
+        clock.now += 100
+        buckets.take('b')
+        keys = [row[0] for row in buckets._conn().execute('SELECT key FROM buckets')]
+        self.assertEqual(keys, ['b'])
+
+    def test_shared(self):
+        clock = FakeClock(1000.0)
+        one, other = self._buckets(clock), self._buckets(clock)
+        self.assertEqual(one.take('a', 8), (True, 2, 0))
+        self.assertEqual(other.take('a', 8), (False, 2, 60))
+
+
+class TestFromEnviron(unittest.TestCase):
+
+    def test_off_by_default(self):
+        self.assertIsNone(ratelimit.from_environ({}))
+        buckets = ratelimit.from_environ({'APOD_RATE_LIMIT': '1000'})
+        self.assertEqual((buckets.limit, buckets.period), (1000, 3600))
@@ -0,0 +1,70 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from apod import reparse, snapshots, store
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+CYGNUS = date(2017, 3, 22)
+
+
+class TestReparse(unittest.TestCase):
+    """Test the re-parse of the archive from snapshots."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.snapshots = snapshots.SnapshotStore(os.path.join(self.tmpdir, 'snapshots'))
+        for name in ('ap170322.html', 'ap130311.html', 'ap950620.html'):
+            with open(os.path.join(PAGES_DIR, name), 'rb') as f:
+                self.snapshots.put(name, f.read())
+        self.snapshots.put('ap170323.html', b'<html>not an APOD page</html>')
+        self.snapshots.put('astropix.html', b'')
+        self.store = store.open_store(os.path.join(self.tmpdir, 'archive.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot_dates(self):
+        self.assertEqual(reparse.snapshot_dates(self.snapshots, date(2000, 1, 1), CYGNUS),
+                         [date(2013, 3, 11), CYGNUS])
+
+    def _reparse(self, workers=1, **kwargs):
+        dates = reparse.snapshot_dates(self.snapshots)
+        return reparse.reparse(self.snapshots, self.store, dates, workers, **kwargs)
+
+    def test_reparse(self):
+        stale = {'date': CYGNUS.isoformat(), 'title': 'Wrong', 'media_type': 'image',
+                 'url': 'https://apod.nasa.gov/apod/image/1703/Cygnus-New-1024.jpg'}
+        self.store.put(CYGNUS, (False, False), stale)
+        self.store.put(CYGNUS, (True, False), dict(stale, concepts=['cygnus']))
+
+        counts = self._reparse(dry_run=True)
+        self.assertEqual(self.store.get(CYGNUS, (False, False))['title'], 'Wrong')
+        self.assertEqual(counts, {'parsed': 3, 'changed': 4, 'stale': 0, 'failed': 1})
+
+        counts = self._reparse()
+        self.assertEqual(counts['changed'], 4)
+        self.assertEqual(self.store.get(CYGNUS, (False, False))['title'], 'Central Cygnus Skyscape')
+        self.assertEqual(self.store.get(CYGNUS, (True, False))['concepts'], ['cygnus'])
+        self.assertIsNone(self.store.get(CYGNUS, (False, True)))
+        # dates not archived yet are added
+        self.assertEqual(self.store.get(date(1995, 6, 20), (False, False))['title'], 'Earth From Space')
+        self.assertEqual(self.store.search('cygnus')[0], 1)
+
+        # nothing left to change
+        self.assertEqual(self._reparse()['changed'], 0)
+
+    def test_reparse_in_processes(self):
+        counts = self._reparse(workers=2)
+        self.assertEqual(counts, {'parsed': 3, 'changed': 3, 'stale': 0, 'failed': 1})
+
+    def test_changed_video(self):
+        self.store.put(CYGNUS, (False, True), {'date': CYGNUS.isoformat(), 'media_type': 'video',
+                                               'url': 'https://vimeo.com/1', 'thumbnail_url': 'thumb'})
+        counts = self._reparse()
+        self.assertEqual(counts['stale'], 1)
+        self.assertEqual(self.store.get(CYGNUS, (False, True))['thumbnail_url'], 'thumb')
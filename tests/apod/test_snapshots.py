@@ -0,0 +1,93 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from mock import patch, Mock
+from apod import snapshots, utility
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+def _page(name):
+    with open(os.path.join(PAGES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+class TestSnapshotStore(unittest.TestCase):
+    """Test the store of raw page snapshots."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = snapshots.SnapshotStore(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_names(self):
+        self.assertEqual(snapshots.page_name(date(2017, 3, 22)), 'ap170322.html')
+        self.assertEqual(snapshots.page_name(None), 'astropix.html')
+        self.assertEqual(snapshots.page_date('ap170322.html'), date(2017, 3, 22))
+        self.assertEqual(snapshots.page_date('ap950620.html'), date(1995, 6, 20))
+        self.assertIsNone(snapshots.page_date('astropix.html'))
+
+    def test_put(self):
+        content = _page('ap170322.html')
+        self.assertIsNone(self.store.get('ap170322.html'))
+        digest = self.store.put('ap170322.html', content)
+        self.assertEqual(self.store.get('ap170322.html'), content)
+
+        # the same bytes are stored once
+        self.assertEqual(self.store.put('astropix.html', content), digest)
+        objects = [name for _, _, names in os.walk(os.path.join(self.tmpdir, 'objects')) for name in names]
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(self.store.names(), ['ap170322.html', 'astropix.html'])
+
+        # and a page fetched again points at its latest bytes
+        self.store.put('astropix.html', b'changed')
+        self.assertEqual(self.store.get('astropix.html'), b'changed')
+        self.assertEqual(self.store.get('ap170322.html'), content)
+
+
+class TestSnapshotting(unittest.TestCase):
+    """Test the keeping of fetched pages, and serving from them as a mirror."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = snapshots.SnapshotStore(self.tmpdir)
+        patcher = patch('apod.utility.SNAPSHOTS', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('apod.upstream.get')
+    def test_fetched_pages_are_kept(self, mock_get):
+        content = _page('ap170322.html')
+        mock_get.return_value = Mock(status_code=200, content=content, text=snapshots.decode(content))
+        props = utility._get_apod_chars(date(2017, 3, 22), False)
+        self.assertEqual(self.store.get('ap170322.html'), content)
+
+        # served again from the snapshot, without fetching
+        mock_get.reset_mock()
+        with patch('apod.utility.MIRROR', True):
+            self.assertEqual(utility._get_apod_chars(date(2017, 3, 22), False), props)
+            self.assertIsNone(utility._get_apod_chars(date(2017, 3, 21), False))
+        self.assertFalse(mock_get.called)
+
+    @patch('apod.upstream.get')
+    def test_latest_page_is_kept_under_its_date(self, mock_get):
+        content = _page('ap170322.html').replace(b'2017 March 22', date.today().strftime('%Y %B %d').encode())
+        mock_get.return_value = Mock(status_code=200, content=content, text=snapshots.decode(content))
+        utility._get_apod_chars(None, False)
+        self.assertEqual(self.store.get('astropix.html'), content)
+        self.assertEqual(self.store.get(snapshots.page_name(date.today())), content)
+
+    @patch('apod.upstream.get')
+    def test_missing_pages_are_not_kept(self, mock_get):
+        mock_get.return_value = Mock(status_code=404)
+        self.assertIsNone(utility._get_apod_chars(date(2017, 3, 23), False))
+        self.assertEqual(self.store.names(), [])
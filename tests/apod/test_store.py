@@ -0,0 +1,151 @@
+#!/bin/sh/python
+# coding= utf-8
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import date
+from apod import store
+
+
+class TestSQLiteStore(unittest.TestCase):
+    """Test the persistent archive of parsed entries."""
+
+    ENTRY = {
+        "date": "2017-03-22",
+        "title": "Central Cygnus Skyscape",
+        "media_type": "image",
+        "url": "https://apod.nasa.gov/apod/image/1703/Cygnus-New-1024.jpg",
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'archive.db')
+        self.store = store.open_store(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        dt = date(2017, 3, 22)
+        self.assertIsNone(self.store.get(dt, (False, False)))
+        self.store.put(dt, (False, False), self.ENTRY)
+        self.assertEqual(self.store.get(dt, (False, False)), self.ENTRY)
+
+    def test_variants_are_separate(self):
+        dt = date(2017, 3, 22)
+        self.store.put(dt, (False, True), self.ENTRY)
+        self.assertIsNone(self.store.get(dt, (False, False)))
+        self.assertEqual(self.store.get_many([dt, date(2017, 3, 23)], (False, True)), {dt: self.ENTRY})
+
+    def test_shared_between_connections(self):
+        dt = date(2017, 3, 22)
+        other = store.open_store(self.path)
+        try:
+            other.put(dt, (False, False), self.ENTRY)
+        finally:
+            other.close()
+
+        found = []
+        worker = threading.Thread(target=lambda: found.append(self.store.get(dt, (False, False))))
+        worker.start()
+        worker.join()
+        self.assertEqual(found, [self.ENTRY])
+
+    def test_dates(self):
+        self.store.put(date(2017, 3, 22), (False, False), self.ENTRY)
+        self.store.put(date(2017, 3, 23), (False, True), self.ENTRY)
+        self.assertEqual(self.store.dates((False, False)), {date(2017, 3, 22)})
+
+    def test_absent_dates(self):
+        self.store.mark_absent(date(1995, 6, 17))
+        self.store.mark_absent(date(2017, 3, 22))
+        self.assertEqual(self.store.absent_dates(), {date(1995, 6, 17), date(2017, 3, 22)})
+        # an entry found later clears the mark
+        self.store.put(date(2017, 3, 22), (False, False), self.ENTRY)
+        self.assertEqual(self.store.absent_dates(), {date(1995, 6, 17)})
+
+    def test_null_store(self):
+        null = store.open_store(None)
+        null.put(date(2017, 3, 22), (False, False), self.ENTRY)
+        self.assertIsNone(null.get(date(2017, 3, 22), (False, False)))
+        self.assertEqual(null.dates((False, False)), set())
+        null.mark_absent(date(2017, 3, 22))
+        self.assertEqual(null.absent_dates(), set())
+        self.assertFalse(null.searchable)
+        self.assertEqual(null.search('cygnus'), (0, []))
+        self.assertRaises(TypeError, store.ArchiveStore)
+
+
+class TestSearch(unittest.TestCase):
+    """Test the full-text index of the archive."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'archive.db')
+        self.store = store.open_store(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _put(self, dt, title, explanation, variant=(False, False), **extra):
+        data = dict(date=dt.isoformat(), title=title, explanation=explanation, media_type='image', **extra)
+        self.store.put(dt, variant, data)
+        return data
+
+    def _dates(self, results):
+        return [data['date'] for data in results[1]]
+
+    def test_ranked(self):
+        self._put(date(2017, 3, 20), 'Comet Lovejoy', 'A comet seen near the Andromeda galaxy.')
+        self._put(date(2017, 3, 21), 'The Andromeda Galaxy', 'Our neighbour, M31, the Andromeda galaxy.')
+        self._put(date(2017, 3, 22), 'Central Cygnus Skyscape', 'Glowing hydrogen gas.')
+        self.assertEqual(self._dates(self.store.search('andromeda')), ['2017-03-21', '2017-03-20'])
+        self.assertEqual(self.store.search('andromeda')[0], 2)
+        # every word must match, stemmed
+        self.assertEqual(self._dates(self.store.search('galaxies comet')), ['2017-03-20'])
+        self.assertEqual(self._dates(self.store.search('sky*')), ['2017-03-22'])
+
+    def test_filters_order_and_pages(self):
+        for day in range(1, 11):
+            self._put(date(2017, 3, day), 'Moon %d' % day, 'The Moon.')
+        total, results = self.store.search('moon', start=date(2017, 3, 3), end=date(2017, 3, 8), order='date',
+                                           limit=4, offset=0)
+        self.assertEqual(total, 6)
+        self.assertEqual([data['date'] for data in results], ['2017-03-08', '2017-03-07', '2017-03-06', '2017-03-05'])
+        total, results = self.store.search('moon', start=date(2017, 3, 3), end=date(2017, 3, 8), order='date',
+                                           limit=4, offset=4)
+        self.assertEqual([data['date'] for data in results], ['2017-03-04', '2017-03-03'])
+
+    def test_variants_are_indexed_once(self):
+        dt = date(2017, 3, 22)
+        self._put(dt, 'Moon', 'The Moon.', (False, False))
+        self._put(dt, 'Moon', 'The Moon.', (True, True), concepts=['moon'], thumbnail_url='')
+        total, results = self.store.search('moon')
+        self.assertEqual(total, 1)
+        self.assertNotIn('concepts', results[0])
+        self.assertNotIn('thumbnail_url', results[0])
+
+    def test_query_syntax_is_not_passed_through(self):
+        self._put(date(2017, 3, 22), 'Moon', 'The Moon.')
+        self.assertEqual(self.store.search('"moon" OR (NEAR')[0], 0)
+        self.assertEqual(self.store.search('moon -')[0], 1)
+        with self.assertRaises(ValueError):
+            self.store.search(' "- ')
+
+    def test_existing_archive_is_indexed(self):
+        self.store.close()
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute('DROP TABLE apod_search')
+            conn.execute('PRAGMA user_version = 0')
+            conn.execute('INSERT INTO apod VALUES (?, 0, 0, ?, 0)',
+                         ('2017-03-22', json.dumps({'date': '2017-03-22', 'title': 'Moon', 'explanation': ''})))
+        conn.close()
+        self.store = store.open_store(self.path)
+        self.assertEqual(self._dates(self.store.search('moon')), ['2017-03-22'])
@@ -0,0 +1,94 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import unittest
+from datetime import date
+from mock import patch, Mock
+from apod import thumbs, utility
+from tests.apod.helpers import PAGES_DIR, FakeClock
+
+
+def _vimeo_response(status_code, thumbnail=None):
+    res = Mock(status_code=status_code)
+    res.content = ('[{"thumbnail_large": "%s"}]' % thumbnail).encode('utf-8')
+    return res
+
+
+class TestThumbnailResolver(unittest.TestCase):
+    """Test the resolution of video thumbnails."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.resolver = thumbs.ThumbnailResolver(negative_ttl=60, clock=self.clock)
+
+    def test_youtube(self):
+        self.assertEqual(self.resolver.resolve('https://www.youtube.com/embed/u_pDEnbcWcI?rel=0'),
+                         'https://img.youtube.com/vi/u_pDEnbcWcI/0.jpg')
+        self.assertEqual(self.resolver.resolve('https://youtu.be/u_pDEnbcWcI'),
+                         'https://img.youtube.com/vi/u_pDEnbcWcI/0.jpg')
+
+    def test_not_a_video(self):
+        self.assertEqual(self.resolver.resolve('https://apod.nasa.gov/apod/image/1703/a.mp4'), '')
+
+    @patch('apod.thumbs.upstream.get')
+    def test_vimeo_is_cached(self, mock_get):
+        mock_get.return_value = _vimeo_response(200, 'https://i.vimeocdn.com/video/1_640.jpg')
+        url = 'https://player.vimeo.com/video/101463926?title=0'
+        self.assertEqual(self.resolver.resolve(url), 'https://i.vimeocdn.com/video/1_640.jpg')
+        self.assertEqual(self.resolver.resolve(url), 'https://i.vimeocdn.com/video/1_640.jpg')
+        mock_get.assert_called_once_with('https://vimeo.com/api/v2/video/101463926.json', service='vimeo')
+
+    @patch('apod.thumbs.upstream.get')
+    def test_missing_vimeo_video(self, mock_get):
+        mock_get.return_value = _vimeo_response(404)
+        self.assertEqual(self.resolver.resolve('https://player.vimeo.com/video/1'), '')
+        self.clock.now = 3600
+        self.assertEqual(self.resolver.resolve('https://player.vimeo.com/video/1'), '')
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('apod.thumbs.upstream.get')
+    def test_failed_lookup_is_negatively_cached(self, mock_get):
+        mock_get.return_value = _vimeo_response(503)
+        with self.assertRaises(thumbs.ThumbnailError):
+            self.resolver.resolve('https://player.vimeo.com/video/1')
+        with self.assertRaises(thumbs.ThumbnailError):
+            self.resolver.resolve('https://player.vimeo.com/video/1')
+        self.assertEqual(mock_get.call_count, 1)
+
+        # tried again once the failure has expired
+        self.clock.now = 61
+        mock_get.return_value = _vimeo_response(200, 'https://i.vimeocdn.com/video/1_640.jpg')
+        self.assertEqual(self.resolver.resolve('https://player.vimeo.com/video/1'),
+                         'https://i.vimeocdn.com/video/1_640.jpg')
+        self.assertEqual(self.resolver.stats(), {'entries': 1, 'lookups': 2, 'failures': 1})
+
+    @patch('apod.thumbs.upstream.get')
+    def test_resolve_many(self, mock_get):
+        mock_get.return_value = _vimeo_response(200, 'https://i.vimeocdn.com/video/1_640.jpg')
+        urls = ['https://player.vimeo.com/video/1', 'https://player.vimeo.com/video/1',
+                'https://www.youtube.com/embed/u_pDEnbcWcI']
+        mapped = []
+
+        def recording_map(fn, items):
+            mapped.append(items)
+            return map(fn, items)
+
+        thumbnails = self.resolver.resolve_many(urls, recording_map)
+        self.assertEqual(thumbnails['https://player.vimeo.com/video/1'], 'https://i.vimeocdn.com/video/1_640.jpg')
+        self.assertEqual(len(thumbnails), 2)
+        self.assertEqual(len(mapped[0]), 2)
+        mock_get.assert_called_once()
+
+
+class TestThumbnailFailures(unittest.TestCase):
+    """Test entries of videos whose thumbnail cannot be looked up."""
+
+    @patch('apod.thumbs.upstream.get')
+    def test_entry_without_thumbnail(self, mock_get):
+        mock_get.return_value = _vimeo_response(503)
+        with open(os.path.join(PAGES_DIR, 'ap140818.html'), 'rb') as f:
+            html = f.read().decode('latin1')
+        with patch('apod.utility.THUMBNAILS', thumbs.ThumbnailResolver()):
+            props = utility.parse_apod_page(html, date(2014, 8, 18), thumbs='true')
+        self.assertEqual(props['media_type'], 'video')
+        self.assertNotIn('thumbnail_url', props)
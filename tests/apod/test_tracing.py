@@ -0,0 +1,83 @@
+#!/bin/sh/python
+# coding= utf-8
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from apod import tracing
+
+
+@tracing.traced()
+def _stage():
+    with tracing.span('inner'):
+        return 42
+
+
+class TestTracing(unittest.TestCase):
+    """Test the recording of request traces."""
+
+    def test_untraced(self):
+        self.assertIsNone(tracing.current())
+        self.assertEqual(_stage(), 42)
+
+    def test_spans(self):
+        trace = tracing.start('test')
+        try:
+            _stage()
+            _stage()
+        finally:
+            tracing.stop(trace)
+        self.assertIsNone(tracing.current())
+        self.assertEqual([name for name, _, _ in trace.timings()], ['inner', 'stage'])
+        self.assertEqual([count for _, _, count in trace.timings()], [2, 2])
+        header = trace.server_timing()
+        self.assertTrue(header.startswith('total;dur='))
+        self.assertIn('stage;dur=', header)
+        self.assertIn(';desc="x2"', header)
+
+    def test_bind(self):
+        trace = tracing.start('test')
+        try:
+            thread = threading.Thread(target=tracing.bind(_stage))
+            thread.start()
+            thread.join()
+        finally:
+            tracing.stop(trace)
+        self.assertEqual(len(trace.spans), 2)
+        self.assertNotEqual(trace.spans[0]['thread'], threading.current_thread().name)
+
+
+class TestTracer(unittest.TestCase):
+    """Test which requests are traced, and where the traces go."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_wanted(self):
+        tracer = tracing.Tracer(token='s3cret', profile_dir=self.dir)
+        self.assertTrue(tracer.enabled)
+        self.assertEqual(tracer.wanted(None), (False, False))
+        self.assertEqual(tracer.wanted('guess'), (False, False))
+        self.assertEqual(tracer.wanted('s3cret'), (True, False))
+        self.assertEqual(tracer.wanted('s3cret; profile'), (True, True))
+        self.assertEqual(tracer.wanted(u'caf\xe9'), (False, False))
+        self.assertEqual(tracing.Tracer(token=u'caf\xe9').wanted(u'caf\xe9'), (True, False))
+        self.assertFalse(tracing.Tracer().enabled)
+        self.assertEqual(tracing.Tracer(sample_rate=1.0).wanted(None), (True, False))
+
+    def test_record(self):
+        trace_file = os.path.join(self.dir, 'traces.jsonl')
+        tracer = tracing.Tracer(token='s3cret', trace_file=trace_file, profile_dir=self.dir)
+        trace = tracing.start('test', profile=True)
+        _stage()
+        tracer.record(tracing.stop(trace), path='/v1/apod/')
+
+        with open(trace_file) as f:
+            recorded = json.loads(f.read())
+        self.assertEqual(recorded['id'], trace.id)
+        self.assertEqual(recorded['path'], '/v1/apod/')
+        self.assertEqual([span['name'] for span in recorded['spans']], ['stage', 'inner'])
+        self.assertEqual(len([name for name in os.listdir(self.dir) if name.endswith('.prof')]), 1)
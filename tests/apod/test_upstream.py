@@ -0,0 +1,48 @@
+#!/bin/sh/python
+# coding= utf-8
+import unittest
+from apod import upstream
+from tests.apod.helpers import QuietHandler, start_server, stop_server
+
+
+class StubHandler(QuietHandler):
+    """Fails the first request for /flaky.html, 404s /missing.html."""
+
+    hits = {}
+
+    def do_GET(self):
+        StubHandler.hits[self.path] = StubHandler.hits.get(self.path, 0) + 1
+        if self.path == '/missing.html':
+            self.send_response(404)
+        elif self.path == '/flaky.html' and StubHandler.hits[self.path] == 1:
+            self.send_response(503)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+
+class TestUpstream(unittest.TestCase):
+    """Test the shared upstream client against a local stub."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base = start_server(StubHandler)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    def test_gateway_errors_are_retried(self):
+        res = upstream.get(self.base + 'flaky.html')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(StubHandler.hits['/flaky.html'], 2)
+
+    def test_not_found_is_not_retried(self):
+        res = upstream.get(self.base + 'missing.html')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(StubHandler.hits['/missing.html'], 1)
+
+    def test_session_is_shared(self):
+        self.assertIs(upstream.session(), upstream.session())
@@ -0,0 +1,81 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date, timedelta
+from apod import cache, warmstart
+
+TODAY = date(2017, 3, 22)
+PLAIN = (False, False)
+
+
+def _entry(dt):
+    return {'date': dt.isoformat(), 'title': 'Entry of ' + dt.isoformat(), 'media_type': 'image'}
+
+
+class TestWarmStart(unittest.TestCase):
+    """Test the snapshot of the hot entries of the results cache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'warm.jsonl')
+        self.results = cache.ResultCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fill(self):
+        for days in range(60):
+            dt = TODAY - timedelta(days=days)
+            self.results.put((dt, PLAIN), _entry(dt))
+        for _ in range(3):
+            self.results.get((date(2017, 2, 1), PLAIN))
+        self.results.get((date(2017, 2, 2), PLAIN))
+        self.results.put((TODAY, (True, False)), dict(_entry(TODAY), concepts=['a', 'b']))
+        # neither the latest entry nor a partial one is kept
+        self.results.put((None, PLAIN), _entry(TODAY), ttl=300)
+        self.results.put((date(2016, 1, 1), PLAIN), {'date': '2016-01-01'}, fields=frozenset(['date']))
+
+    def test_select(self):
+        self._fill()
+        kept = warmstart.select(self.results.entries(), TODAY, recent_days=7, top=1)
+        self.assertEqual([key for key, _ in kept],
+                         [(date(2017, 2, 1), PLAIN)] +
+                         [(TODAY - timedelta(days=days), PLAIN) for days in range(6, 0, -1)] +
+                         [(TODAY, PLAIN), (TODAY, (True, False))])
+        self.assertEqual(len(warmstart.select(self.results.entries(), TODAY, recent_days=7, top=0)), 8)
+
+    def test_save_and_load(self):
+        self._fill()
+        saved = warmstart.WarmStart(self.path, recent_days=7, top=10).save(self.results, TODAY)
+        self.assertEqual(saved, 18)
+
+        results = cache.ResultCache(max_entries=9)
+        self.assertEqual(warmstart.WarmStart(self.path).load(results), 18)
+        # the coldest went first
+        self.assertEqual(len(results), 9)
+        self.assertIsNone(results.get((date(2017, 2, 2), PLAIN)))
+        self.assertEqual(results.get((date(2017, 2, 1), PLAIN))['title'], 'Entry of 2017-02-01')
+        self.assertEqual(results.get((TODAY, (True, False)))['concepts'], ['a', 'b'])
+
+    def test_missing_or_damaged(self):
+        warm = warmstart.WarmStart(self.path)
+        self.assertEqual(warm.load(self.results), 0)
+
+        self.results.put((TODAY, PLAIN), _entry(TODAY))
+        warm.save(self.results, TODAY)
+        with open(self.path, 'a') as f:
+            f.write('["2017-03-21", false, fal')
+        results = cache.ResultCache()
+        self.assertEqual(warm.load(results), 1)
+        self.assertEqual(results.get((TODAY, PLAIN))['date'], '2017-03-22')
+
+        with open(self.path, 'w') as f:
+            f.write('{"version": 0}\n["2017-03-22", false, false, {}]\n')
+        self.assertEqual(warm.load(cache.ResultCache()), 0)
+
+    def test_unwritable(self):
+        warm = warmstart.WarmStart(os.path.join(self.tmpdir, 'missing', 'warm.jsonl'))
+        self.assertEqual(warm.save(self.results), 0)